@@ -5,6 +5,8 @@ from django.template import RequestContext, loader
 from mailshareapp import email_utils
 from mailshareapp.search import Search
 from mailshareapp.search import get_mail_id_search
+from mailshareapp import search_cache
+from django.conf import settings
 
 class MailsFeed(Feed):
     description = "Updates on changes."
@@ -25,7 +27,9 @@ class MailsFeed(Feed):
         return ("Mailshare Mails " + self.search.get_title())
 
     def items(self):       
-        return self.search.get_query_set()
+        # feed readers ask again and again, so the newest page of results comes from the cache
+        mail_ids = search_cache.get_results(self.search).get_mail_ids(settings.MAILSHARE_SEARCH_PAGE_SIZE)
+        return Mail.objects.filter(id__in=mail_ids)
 
     def item_link(self, item):
         return("http://"+self.request_host+get_mail_id_search(item.id).get_url_path())
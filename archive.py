@@ -0,0 +1,57 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Maintain the archive of downloaded emails at MAILSHARE_ARCHIVE_PATH.
+
+python archive.py convert mailfile   copy an old style mailfile into the archive
+python archive.py compact            drop records that are no longer indexed from old segments
+python archive.py reindex            rebuild the Message-ID index by scanning the segments
+python archive.py get <message-id>   print an archived email
+python archive.py replay [restart]   add archived emails to the database
+python archive.py replay-mailfile mailfile [restart]
+                                     add emails in an old style mailfile to the database
+
+Replays carry on from where the last one stopped unless 'restart' is given. Stop the poller
+first: only one process can open the archive at a time.
+"""
+
+# load the Django environment
+from django.core.management import setup_environ
+import settings
+setup_environ(settings)
+
+import sys
+from mailshareapp import mail_archive
+from mailshareapp import process_emails
+
+
+def main(args):
+    try:
+        archive = mail_archive.get_archive()
+    except mail_archive.ArchiveInUseError, e:
+        print e
+        return
+    if len(args) == 2 and args[0] == 'convert':
+        input_file = open(args[1], 'rb')
+        print 'Converted ' + str(mail_archive.convert_mailfile(input_file, archive)) + ' emails'
+    elif len(args) == 1 and args[0] == 'compact':
+        print 'Dropped ' + str(archive.compact_all()) + ' records'
+    elif len(args) == 1 and args[0] == 'reindex':
+        archive.rebuild_index()
+    elif len(args) in [1, 2] and args[0] == 'replay':
+        process_emails.replay_archive(args[1:] == ['restart'])
+    elif len(args) in [2, 3] and args[0] == 'replay-mailfile':
+        process_emails.replay_mailfile(args[1], args[2:] == ['restart'])
+    elif len(args) == 2 and args[0] == 'get':
+        message_data = archive.get(args[1])
+        if message_data == None:
+            print 'Not found'
+        else:
+            print message_data
+    else:
+        print __doc__
+    archive.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,22 @@
 #!/bin/bash
 mysql -u root -p << eof
 USE mailshare;
+-- the tables are InnoDB, which won't drop a table others have foreign keys to
+SET FOREIGN_KEY_CHECKS = 0;
 DROP TABLE mailshareapp_mail;
 DROP TABLE mailshareapp_mail_to;
 DROP TABLE mailshareapp_mail_cc;
 DROP TABLE mailshareapp_mail_tags;
+DROP TABLE mailshareapp_teamtagdaycount;
+DROP TABLE mailshareapp_teamsenderdaycount;
+DROP TABLE mailshareapp_textquery;
+DROP TABLE mailshareapp_textqueryscore;
+SET FOREIGN_KEY_CHECKS = 1;
 eof
 python manage.py syncdb
+# empty the search indexes in MAILSHARE_SEARCH_INDEX_PATH and MAILSHARE_TRIGRAM_INDEX_PATH
+python rebuild_search_index.py
+# make the web server forget the search results it has cached
+python -c "from django.core.management import setup_environ; import settings; setup_environ(settings); \
+from mailshareapp import search_cache; search_cache.mails_changed(); search_cache.mail_tags_changed()"
 
@@ -1,4 +1,4 @@
-from mailshareapp.models import Mail, Contact, Tag
+from mailshareapp.models import Mail, Contact, Tag, AutotagJob
 from django.contrib import admin
 
 class MailAdmin(admin.ModelAdmin):
@@ -23,3 +23,26 @@ class TagAdmin(admin.ModelAdmin):
     list_display_links = ['name']
 
 admin.site.register(Tag, TagAdmin)
+
+
+class AutotagJobAdmin(admin.ModelAdmin):
+    list_display = ('tag', 'state', 'progress', 'mails_tagged', 'created', 'updated')
+    list_filter = ['state']
+    readonly_fields = ('tag', 'last_mail_id', 'mails_tagged', 'created', 'updated')
+    actions = ['cancel_jobs', 'resume_jobs']
+
+    def progress(self, job):
+        last_mail = Mail.objects.order_by('-id')[:1]
+        if job.state == AutotagJob.DONE or len(last_mail) == 0:
+            return '100%'
+        return str(job.last_mail_id * 100 / last_mail[0].id) + '%'
+
+    def cancel_jobs(self, request, queryset):
+        queryset.filter(state=AutotagJob.QUEUED).update(state=AutotagJob.CANCELLED)
+    cancel_jobs.short_description = 'Cancel selected jobs'
+
+    def resume_jobs(self, request, queryset):
+        queryset.filter(state=AutotagJob.CANCELLED).update(state=AutotagJob.QUEUED)
+    resume_jobs.short_description = 'Resume selected jobs'
+
+admin.site.register(AutotagJob, AutotagJobAdmin)
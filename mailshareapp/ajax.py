@@ -10,6 +10,8 @@ from views import get_expanded_html
 import tags
 import search
 import tag_cloud_cache
+import search_cache
+import completion
 
 # Naming convention: calls from browser to server are prefixed with 'fetch';
 # calls from server to browser are prefixed with 'update'.
@@ -40,11 +42,41 @@ def fetch_mail_tags(request, email_id, url):
     return dajax.json()
 
 
+@dajaxice_register
+def fetch_mails_tags(request, email_ids, url):
+    dajax = Dajax()
+    search_object = search.get_search_from_url(url)
+    tags_html = tags.mails_tags_to_html_lists(email_ids, search_object)
+    dajax.add_data({'tags_html':tags_html}, 'update_mails_tags')
+    return dajax.json()
+
+
 def update_tag_cloud(dajax, search_object):
-    tag_cloud_html = tags.search_results_to_tag_cloud_html(search_object.get_query_set(), search_object)
+    f = search_cache.get_results(search_object).get_facets(settings.MAILSHARE_FACET_ROW_LIMIT)
+    tag_cloud_html = tags.tags_histogram_to_tag_cloud_html(f.get_tag_histogram(), search_object)
     dajax.add_data({'tag_cloud_html':tag_cloud_html}, 'update_tag_cloud')
 
 
+def update_tag_cloud_delta(dajax, search_object, tag, change):
+    """
+    Tell the browser that the number of mails in the search results with the specified tag has
+    changed by change, so that it can adjust the tag cloud it is already showing. If the change
+    could move mails in or out of the results the whole tag cloud is sent instead.
+    """
+    if tag.id in search_object.get_tag_ids() or settings.MAILSHARE_FACET_ROW_LIMIT:
+        update_tag_cloud(dajax, search_object)
+    elif change != 0:
+        tag_html = tags.tag_to_html(tag, search_object)
+        dajax.add_data({'tag_id':tag.id, 'change':change, 'tag_html':tag_html}, 'update_tag_cloud_delta')
+
+
+@dajaxice_register
+def fetch_tag_cloud(request, url):
+    dajax = Dajax()
+    update_tag_cloud(dajax, search.get_search_from_url(url))
+    return dajax.json()
+
+
 @dajaxice_register
 def fetch_add_tag(request, email_id, tag, url):
     dajax = Dajax()
@@ -52,10 +84,10 @@ def fetch_add_tag(request, email_id, tag, url):
     mails = Mail.objects.filter(id=email_id)
     if len(mails) > 0:
         t = tags.get_or_create_tag(tag)
-        mails[0].tags.add(t)
+        change = tags.add_tag_to_mails(t, [mails[0].id])
+        update_tag_cloud_delta(dajax, search_object, t, change)
     tags_html = tags.mail_tags_to_html_list(mails[0], search_object)
     dajax.add_data({'email_id':email_id, 'tags_html':tags_html, 'propagate':True}, 'update_tags')
-    update_tag_cloud(dajax, search_object)
     return dajax.json()
 
 
@@ -68,12 +100,12 @@ def fetch_delete_tag(request, email_id, tag_id, url):
     except (Mail.DoesNotExist, Mail.MultipleObjectsReturned, Tag.DoesNotExist, Tag.MultipleObjectsReturned):
         pass
     else:
-        mail.tags.remove(tag)
+        change = -tags.remove_tag_from_mails(tag, [mail.id])
         search_object = search.get_search_from_url(url)
         tags_html = tags.mail_tags_to_html_list(mail, search_object)
         tags_html += tags.undo_delete_html(mail.id, tag)
         dajax.add_data({'email_id':email_id, 'tags_html':tags_html, 'propagate':True}, 'update_tags')
-        update_tag_cloud(dajax, search_object)
+        update_tag_cloud_delta(dajax, search_object, tag, change)
     return dajax.json()
 
 
@@ -82,16 +114,10 @@ def fetch_multi_add_tag(request, selected_mails, tag, url):
     dajax = Dajax()
     search_object = search.get_search_from_url(url)
     t = tags.get_or_create_tag(tag)
-    for mail_id in selected_mails:
-        try:
-            m = Mail.objects.get(id=mail_id)
-        except:
-            pass
-        else:
-            m.tags.add(t)
+    change = tags.add_tag_to_mails(t, selected_mails)
     result = tags.mail_tags_multibar_html(search_object, selected_mails, True)
     dajax.add_data({'tags_html':result, 'tags_only':True, 'tags_changed':True, 'propagate':True}, 'update_multibar')
-    update_tag_cloud(dajax, search_object)
+    update_tag_cloud_delta(dajax, search_object, t, change)
     return dajax.json()
 
 
@@ -104,30 +130,17 @@ def fetch_multi_delete_tag(request, selected_mails, tag_id, url):
     except(Tag.DoesNotExist, Tag.MultipleObjectsReturned):
         tag = None
     else:
-        for mail_id in selected_mails:
-            try:
-                mail = Mail.objects.get(id=mail_id)
-            except(Mail.DoesNotExist, Mail.MultipleObjectsReturned):
-                pass
-            else:
-                mail.tags.remove(tag)
+        change = -tags.remove_tag_from_mails(tag, selected_mails)
+        update_tag_cloud_delta(dajax, search_object, tag, change)
     result = tags.mail_tags_multibar_html(search_object, selected_mails, True)
     dajax.add_data({'tags_html':result, 'tags_only':True, 'tags_changed':True, 'propagate':True}, 'update_multibar')
-    update_tag_cloud(dajax, search_object)
     return dajax.json()
 
 
 @dajaxice_register
 def fetch_tag_completion(request, text):
     dajax = Dajax()
-    tags = None
-    if len(text) == 1:
-        tags = Tag.objects.filter(name__istartswith=text)
-    else:
-        tags = Tag.objects.filter(name__icontains=text)
-    response = []
-    for tag in tags:
-        response.append(tag.name)
+    response = completion.tag_completion.lookup(text)
     dajax.add_data({'tags':response}, 'update_tag_completion')
     return dajax.json()
 
@@ -135,14 +148,7 @@ def fetch_tag_completion(request, text):
 @dajaxice_register
 def fetch_contact_completion(request, text):
     dajax = Dajax()
-    contacts = None
-    if len(text) == 1:
-        contacts = Contact.objects.filter(name__istartswith=text)
-    else:
-        contacts = Contact.objects.filter(name__icontains=text)
-    response = []
-    for contact in contacts:
-        response.append(contact.name)
+    response = completion.contact_completion.lookup(text)
     dajax.add_data({'contacts':response}, 'update_contact_completion')
     return dajax.json()
 
@@ -0,0 +1,120 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Finds all the autotags that appear in an email with one pass over its text.
+
+Autotags used to be found with one MySQL FULLTEXT query per tag per email. Django's __search
+lookup is a boolean mode MATCH ... AGAINST, which for a tag name without operators matches any
+row containing, as a whole word and ignoring case, any of the words in the name that are at
+least the minimum word length. So to keep the same results we split each tag name into words
+and keep a dictionary from word to tags; an email is then scanned once, splitting it into words
+the same way and looking each one up. Unlike MySQL we don't ignore stopwords.
+"""
+
+import re
+import generation
+import models
+
+# This must match ft_min_word_len in mysql/mailshare.cnf
+FULLTEXT_MIN_WORD_LENGTH = 3
+
+_word_compiled = re.compile(r"[\w']+", re.UNICODE)
+
+
+def get_words(text):
+    """Return the set of lower case words in text, split as MySQL FULLTEXT would."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    words = set()
+    for word in _word_compiled.findall(text.lower()):
+        word = word.strip("'")
+        if len(word) >= FULLTEXT_MIN_WORD_LENGTH:
+            words.add(word)
+    return words
+
+
+class AutotagMatcher(object):
+    """A dictionary of the words of every autotag, kept up to date as tags change."""
+
+    def __init__(self):
+        self._words_by_tag_id = {}
+        self._tag_ids_by_word = {}
+        self._generation = None
+
+
+    def add(self, tag_id, name):
+        """Add an autotag, or update it if its name has changed."""
+        self.remove(tag_id)
+        words = get_words(name)
+        self._words_by_tag_id[tag_id] = words
+        for word in words:
+            self._tag_ids_by_word.setdefault(word, set()).add(tag_id)
+
+
+    def remove(self, tag_id):
+        """Remove an autotag if it is present."""
+        words = self._words_by_tag_id.pop(tag_id, set())
+        for word in words:
+            tag_ids = self._tag_ids_by_word[word]
+            tag_ids.discard(tag_id)
+            if len(tag_ids) == 0:
+                del self._tag_ids_by_word[word]
+
+
+    def rebuild(self):
+        """Load all the autotags from the database."""
+        self._words_by_tag_id = {}
+        self._tag_ids_by_word = {}
+        self._generation = generation.get('tags')
+        for (tag_id, name) in models.Tag.objects.filter(auto=True).values_list('id', 'name'):
+            self.add(tag_id, name)
+
+
+    def refresh(self):
+        """Rebuild if another process has changed the tags since we last looked."""
+        if self._generation != generation.get('tags'):
+            self.rebuild()
+
+
+    def tag_changed(self, tag_id, name, auto):
+        """Update the matcher for a tag that has just been saved, and tell other processes."""
+        self.refresh()
+        if auto:
+            self.add(tag_id, name)
+        elif tag_id in self._words_by_tag_id:
+            self.remove(tag_id)
+        else:
+            # an ordinary tag was saved; no autotags have changed
+            return
+        self._generation = generation.bump('tags')
+
+
+    def tag_deleted(self, tag_id):
+        """Update the matcher for a tag that has just been deleted, and tell other processes."""
+        self.refresh()
+        if tag_id in self._words_by_tag_id:
+            self.remove(tag_id)
+            self._generation = generation.bump('tags')
+
+
+    def match(self, *texts):
+        """Return the set of ids of the autotags appearing in any of the texts."""
+        self.refresh()
+        tag_ids = set()
+        for text in texts:
+            for word in get_words(text):
+                if word in self._tag_ids_by_word:
+                    tag_ids |= self._tag_ids_by_word[word]
+        return tag_ids
+
+
+def matches(name, *texts):
+    """Return True if any of the texts contain the tag name, as AutotagMatcher.match would find."""
+    words = get_words(name)
+    for text in texts:
+        if not words.isdisjoint(get_words(text)):
+            return True
+    return False
+
+
+matcher = AutotagMatcher()
@@ -0,0 +1,77 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Functions to write many rows of a many-to-many relation at once. Django's related managers
+add and remove relations one row at a time, which is too slow for ingesting and tagging
+emails in bulk. Note that these bypass the m2m_changed signal.
+"""
+
+from django.db import connection, transaction
+
+
+def _get_m2m_table(model, field_name):
+    # Return the quoted table and column names of the through table of a ManyToManyField.
+    field = model._meta.get_field(field_name)
+    qn = connection.ops.quote_name
+    return (qn(field.m2m_db_table()), qn(field.m2m_column_name()), qn(field.m2m_reverse_name()))
+
+
+def _placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def get_existing_relations(model, field_name, pairs):
+    """Return the subset of the (model id, related id) pairs that are already related."""
+    pairs = set(pairs)
+    if len(pairs) == 0:
+        return set()
+    (table, column, reverse_column) = _get_m2m_table(model, field_name)
+    ids = list(set(pair[0] for pair in pairs))
+    related_ids = list(set(pair[1] for pair in pairs))
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT ' + column + ', ' + reverse_column + ' FROM ' + table +
+        ' WHERE ' + column + ' IN (' + _placeholders(ids) + ')' +
+        ' AND ' + reverse_column + ' IN (' + _placeholders(related_ids) + ')',
+        ids + related_ids)
+    return set(cursor.fetchall()) & pairs
+
+
+def insert_relations(model, field_name, pairs):
+    """
+    Relate each (model id, related id) pair through the named ManyToManyField of model using
+    one multi-row INSERT. Pairs that are already related are skipped.
+    Returns a list of the pairs that were inserted.
+    """
+    pairs = set(pairs)
+    new_pairs = sorted(pairs - get_existing_relations(model, field_name, pairs))
+    if len(new_pairs) > 0:
+        (table, column, reverse_column) = _get_m2m_table(model, field_name)
+        cursor = connection.cursor()
+        cursor.executemany(
+            'INSERT INTO ' + table + ' (' + column + ', ' + reverse_column + ') VALUES (%s, %s)',
+            new_pairs)
+        transaction.commit_unless_managed()
+    return new_pairs
+
+
+def delete_relations(model, field_name, pairs):
+    """
+    Remove the relations between each (model id, related id) pair through the named
+    ManyToManyField of model, using one DELETE for each distinct related id.
+    Returns a list of the pairs that were deleted.
+    """
+    old_pairs = sorted(get_existing_relations(model, field_name, pairs))
+    if len(old_pairs) > 0:
+        (table, column, reverse_column) = _get_m2m_table(model, field_name)
+        ids_by_related_id = {}
+        for (model_id, related_id) in old_pairs:
+            ids_by_related_id.setdefault(related_id, []).append(model_id)
+        cursor = connection.cursor()
+        for (related_id, ids) in ids_by_related_id.iteritems():
+            cursor.execute(
+                'DELETE FROM ' + table + ' WHERE ' + reverse_column + ' = %s' +
+                ' AND ' + column + ' IN (' + _placeholders(ids) + ')',
+                [related_id] + ids)
+        transaction.commit_unless_managed()
+    return old_pairs
@@ -0,0 +1,269 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+In-memory indexes for completing tag and contact names as the user types, so that each
+keystroke is answered without scanning the Tag or Contact tables.
+
+Each index maps two character sequences to the objects whose names contain them. The lists
+are ordered most used first, so a lookup only has to read until it has found enough results.
+Counting how much each object is used takes grouped queries over every mail, so the polling
+process ranks the objects with write_rankings and the web server loads the ranking from
+MAILSHARE_CACHE_PATH.
+"""
+
+import os
+import time
+import marshal
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+import models
+import settings
+
+# Marks the start of a string so that single characters can be looked up as prefixes.
+_START = '\n'
+
+
+def _get_grams(key):
+    key = _START + key
+    return set(key[i:i+2] for i in range(len(key) - 1))
+
+
+class CompletionIndex(object):
+    """
+    Finds the values of entries with a key that contains the text typed so far, or starts
+    with it if only one character has been typed. Entries added earlier rank higher.
+    """
+    def __init__(self):
+        self._keys = {}
+        self._values = {}
+        self._grams = {}
+
+
+    def add(self, entry_id, value, keys):
+        """Add an entry with the specified id, returning value when any of the keys match."""
+        if entry_id in self._keys:
+            self.remove(entry_id)
+        keys = [key.lower() for key in keys]
+        self._keys[entry_id] = keys
+        self._values[entry_id] = value
+        grams = set()
+        for key in keys:
+            grams |= _get_grams(key)
+        for gram in grams:
+            self._grams.setdefault(gram, []).append(entry_id)
+
+
+    def remove(self, entry_id):
+        """Remove an entry. Its place in the lists is skipped until the index is rebuilt."""
+        self._keys.pop(entry_id, None)
+        self._values.pop(entry_id, None)
+
+
+    def lookup(self, text, limit):
+        """Return a list of up to limit distinct values matching text, highest ranked first."""
+        text = text.lower()
+        if len(text) == 0:
+            return []
+        if len(text) == 1:
+            candidates = self._grams.get(_START + text, [])
+        else:
+            # every match contains all of the text's pairs of characters, so only the
+            # entries with the rarest of them need to be checked
+            candidates = min([self._grams.get(text[i:i+2], []) for i in range(len(text) - 1)], key=len)
+
+        results = []
+        seen = set()
+        for entry_id in candidates:
+            keys = self._keys.get(entry_id)
+            if keys == None:
+                continue
+            if len(text) == 1:
+                matched = any(key.startswith(text) for key in keys)
+            else:
+                matched = any(text in key for key in keys)
+            value = self._values[entry_id]
+            if matched and value and value not in seen:
+                seen.add(value)
+                results.append(value)
+                if len(results) >= limit:
+                    break
+        return results
+
+
+def _get_tag_usage():
+    # Return a dictionary mapping tag ids to the number of mails with the tag.
+    counts = models.Mail.tags.through.objects.values('tag').annotate(mails=Count('mail'))
+    return dict((row['tag'], row['mails']) for row in counts)
+
+
+def _get_contact_usage():
+    # Return a dictionary mapping contact ids to the number of mails they sent or received.
+    counts = list(models.Mail.objects.values_list('sender').annotate(mails=Count('id')).order_by())
+    for through in [models.Mail.to.through, models.Mail.cc.through]:
+        counts += list(through.objects.values_list('contact').annotate(mails=Count('mail')))
+    usage = {}
+    for (contact_id, mails) in counts:
+        usage[contact_id] = usage.get(contact_id, 0) + mails
+    return usage
+
+
+def _get_value(values):
+    # Complete to the first of the values that isn't empty, e.g. a contact's address if it
+    # has no name.
+    for value in values:
+        if value:
+            return value
+    return None
+
+
+class ModelCompletion(object):
+    """
+    Keeps a CompletionIndex of the objects of a model, completing the first of fields that
+    isn't empty and matching any of them. The index is ranked by get_usage, a function
+    returning a dictionary mapping object ids to how much they are used.
+
+    The ranked objects are written to a file by write_ranking, which the polling process
+    calls every MAILSHARE_COMPLETION_REBUILD_SECONDS, and the index is rebuilt from the file
+    whenever it changes. Until there is a file the objects are ranked oldest first. Objects
+    saved by this process are indexed straight away by the saved and deleted signal handlers.
+    Objects created since the ranking was written, such as by the mail poller, are picked up
+    by looking for new ids every MAILSHARE_COMPLETION_REFRESH_SECONDS.
+    """
+    def __init__(self, name, model, fields, get_usage):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.get_usage = get_usage
+        self.index = None
+        self._max_id = 0
+        self._ranking_version = None
+        self._refreshed = 0
+
+
+    def _get_ranking_filename(self, temp=False):
+        filename = os.path.join(settings.MAILSHARE_CACHE_PATH, 'completion_' + self.name)
+        if temp:
+            filename += '_tmp_' + str(os.getpid())
+        return filename
+
+
+    def _get_ranking_version(self):
+        try:
+            stat = os.stat(self._get_ranking_filename())
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_ino)
+
+
+    def get_ranking_age(self):
+        """Return how many seconds ago the ranking was written, or None if it never has been."""
+        version = self._get_ranking_version()
+        if version == None:
+            return None
+        return time.time() - version[0]
+
+
+    def write_ranking(self):
+        """Rank the objects by get_usage and write them to a file for the web server to load."""
+        usage = self.get_usage()
+        rows = list(self.model.objects.values_list('id', *self.fields))
+        rows.sort(key=lambda row: (-usage.get(row[0], 0), row[0]))
+        temp_filename = self._get_ranking_filename(True)
+        ranking_file = open(temp_filename, 'wb')
+        marshal.dump(rows, ranking_file)
+        ranking_file.close()
+        os.rename(temp_filename, self._get_ranking_filename())
+
+
+    def _load_ranking(self):
+        # Return the rows written by write_ranking, or None if there aren't any.
+        try:
+            ranking_file = open(self._get_ranking_filename(), 'rb')
+        except IOError:
+            return None
+        try:
+            return marshal.load(ranking_file)
+        finally:
+            ranking_file.close()
+
+
+    def _add_rows(self, index, rows):
+        for row in rows:
+            index.add(row[0], _get_value(row[1:]), row[1:])
+            self._max_id = max(self._max_id, row[0])
+
+
+    def _add_new_rows(self):
+        # Index the objects created since the index was built. Objects saved by this process
+        # don't move _max_id on, since other processes may have created some with lower ids.
+        rows = self.model.objects.filter(id__gt=self._max_id).order_by('id').values_list('id', *self.fields)
+        self._add_rows(self.index, rows)
+
+
+    def rebuild(self):
+        version = self._get_ranking_version()
+        rows = None
+        if version != None:
+            rows = self._load_ranking()
+        if rows == None:
+            version = None
+            rows = self.model.objects.order_by('id').values_list('id', *self.fields)
+        self.index = CompletionIndex()
+        self._max_id = 0
+        self._add_rows(self.index, rows)
+        self._add_new_rows()
+        self._ranking_version = version
+        self._refreshed = time.time()
+
+
+    def refresh(self):
+        now = time.time()
+        if self.index == None:
+            self.rebuild()
+        elif now - self._refreshed > settings.MAILSHARE_COMPLETION_REFRESH_SECONDS:
+            if self._get_ranking_version() != self._ranking_version:
+                self.rebuild()
+            else:
+                self._add_new_rows()
+                self._refreshed = now
+
+
+    def lookup(self, text, limit=None):
+        """Return a list of up to limit names matching text, most used first."""
+        if limit == None:
+            limit = settings.MAILSHARE_COMPLETION_RESULTS
+        self.refresh()
+        return self.index.lookup(text, limit)
+
+
+    def saved(self, sender, instance, **kwargs):
+        if self.index != None:
+            values = [getattr(instance, field) for field in self.fields]
+            self.index.add(instance.id, _get_value(values), values)
+
+
+    def deleted(self, sender, instance, **kwargs):
+        if self.index != None:
+            self.index.remove(instance.id)
+
+
+tag_completion = ModelCompletion('tags', models.Tag, ['name'], _get_tag_usage)
+contact_completion = ModelCompletion('contacts', models.Contact, ['name', 'address'], _get_contact_usage)
+
+post_save.connect(tag_completion.saved, sender=models.Tag)
+post_delete.connect(tag_completion.deleted, sender=models.Tag)
+post_save.connect(contact_completion.saved, sender=models.Contact)
+post_delete.connect(contact_completion.deleted, sender=models.Contact)
+
+
+def write_rankings(verbose=False):
+    """
+    Rank the tags and contacts for completion if they were last ranked more than
+    MAILSHARE_COMPLETION_REBUILD_SECONDS ago. Called by the polling process between batches.
+    """
+    for model_completion in [tag_completion, contact_completion]:
+        age = model_completion.get_ranking_age()
+        if age == None or age > settings.MAILSHARE_COMPLETION_REBUILD_SECONDS:
+            model_completion.write_ranking()
+            if verbose:
+                print 'Ranked ' + model_completion.name + ' for completion'
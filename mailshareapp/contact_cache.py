@@ -0,0 +1,92 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+A process-wide cache mapping email addresses to Contact ids, so that the addresses on a new
+email can be resolved with at most one query, plus one bulk insert for any new contacts.
+"""
+
+from collections import OrderedDict
+from django.db import connection, transaction
+from mailshareapp.models import Contact
+import settings
+
+# normalised address -> contact id, least recently used first
+_contact_ids = OrderedDict()
+
+
+def normalise_address(address):
+    """Email addresses are considered to be case insensitive for now."""
+    return address.strip().lower()
+
+
+def _remember(key, contact_id):
+    if key in _contact_ids:
+        del _contact_ids[key]
+    _contact_ids[key] = contact_id
+    while len(_contact_ids) > settings.MAILSHARE_CONTACT_CACHE_SIZE:
+        _contact_ids.popitem(last=False)
+
+
+def _recall(key):
+    # look up a cached id, marking it as recently used
+    contact_id = _contact_ids.pop(key, None)
+    if contact_id != None:
+        _contact_ids[key] = contact_id
+    return contact_id
+
+
+def clear():
+    """Forget all cached contacts, e.g. after a transaction that created some was rolled back."""
+    _contact_ids.clear()
+
+
+def _find_contacts(names_and_addresses, result):
+    # Look up all the addresses with one IN query. The MySQL collation makes this case
+    # insensitive; we also ask for the addresses as written to cope with other databases.
+    # Where an address has several contacts, use the oldest, as the rest are duplicates.
+    addresses = set(names_and_addresses.keys())
+    addresses |= set(address for (name, address) in names_and_addresses.values())
+    matches = Contact.objects.filter(address__in=list(addresses)).values_list('id', 'address').order_by('-id')
+    for (contact_id, address) in matches:
+        key = normalise_address(address)
+        if key in names_and_addresses:
+            result[key] = contact_id
+    for key in names_and_addresses.keys():
+        if key in result:
+            _remember(key, result[key])
+            del names_and_addresses[key]
+
+
+def _insert_contacts(names_and_addresses):
+    # Add all the new contacts with one multi-row INSERT.
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO ' + Contact._meta.db_table + ' (name, address) VALUES (%s, %s)',
+        names_and_addresses.values())
+    transaction.commit_unless_managed()
+
+
+def get_contact_ids(names_and_addresses):
+    """
+    Return a dictionary mapping the normalised form of each address to its Contact id.
+    names_and_addresses: a list of (name, address) tuples; names must already be decoded.
+    Contacts that are not in the Contact table are added to it.
+    """
+    result = {}
+    missing = {}
+    for (name, address) in names_and_addresses:
+        key = normalise_address(address)
+        if key in result or key in missing:
+            continue
+        contact_id = _recall(key)
+        if contact_id != None:
+            result[key] = contact_id
+        else:
+            missing[key] = (name, address)
+
+    if len(missing) > 0:
+        _find_contacts(missing, result)
+    if len(missing) > 0:
+        _insert_contacts(missing)
+        _find_contacts(missing, result)
+    return result
@@ -0,0 +1,114 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Summaries of a set of search results, such as tag counts and top senders, worked out by the
+database with grouped queries rather than by loading every mail.
+"""
+
+from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
+from operator import itemgetter
+import models
+
+
+class Facets(object):
+    """
+    Computes facets of the mails in a queryset. Each facet is counted by one grouped query
+    joining its table to the query selecting the mails, so the ids of the mails never leave
+    the database. If limit is given, only the most recent limit mails are used. Each facet is
+    computed when first asked for.
+    """
+    def __init__(self, queryset, limit=None):
+        self._queryset = queryset
+        self._limit = limit
+        self._tag_histogram = None
+        self._sender_counts = None
+        self._recipient_counts = None
+        self._day_histogram = None
+
+
+    def _get_mails_sql(self):
+        # Return the SQL and parameters of a query selecting the ids of the mails, or None if
+        # there can't be any.
+        ids = self._queryset.values('id')
+        if self._limit:
+            ids = ids[:self._limit]
+        else:
+            ids = ids.order_by()
+        try:
+            return ids.query.get_compiler(using=ids.db).as_sql()
+        except EmptyResultSet:
+            return None
+
+
+    def _count(self, table, mail_column, group_column, group_function=None):
+        # Return a dictionary from each value of group_column in the table, or of the SQL
+        # function group_function applied to it, to the number of the mails it appears with,
+        # joining on mail_column. MySQL can't use LIMIT in an IN subquery, so the mails are
+        # joined as a derived table.
+        mails_sql = self._get_mails_sql()
+        if mails_sql == None:
+            return {}
+        (sql, params) = mails_sql
+        qn = connection.ops.quote_name
+        group = 'f.' + qn(group_column)
+        if group_function:
+            group = group_function + '(' + group + ')'
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT ' + group + ', COUNT(*) FROM ' + qn(table) + ' f' +
+            ' INNER JOIN (' + sql + ') m ON f.' + qn(mail_column) + ' = m.' + qn('id') +
+            ' GROUP BY ' + group,
+            params)
+        return dict(cursor.fetchall())
+
+
+    def _count_m2m(self, field_name):
+        field = models.Mail._meta.get_field(field_name)
+        return self._count(field.m2m_db_table(), field.m2m_column_name(), field.m2m_reverse_name())
+
+
+    def get_tag_histogram(self):
+        """Return a list of (tag, frequency) tuples sorted by tag name."""
+        if self._tag_histogram == None:
+            self._tag_histogram = []
+            frequencies = self._count_m2m('tags')
+            if len(frequencies) > 0:
+                tags = models.Tag.objects.in_bulk(frequencies.keys())
+                self._tag_histogram = [(tag, frequencies[tag_id]) for (tag_id, tag) in tags.items()]
+                self._tag_histogram.sort(key=lambda entry: entry[0].name)
+        return self._tag_histogram
+
+
+    def _get_contacts(self, contact_counts, number):
+        # Turn a dictionary of contact id to count into a list of the number (contact, count)
+        # tuples with the highest count.
+        top = sorted(contact_counts.iteritems(), key=itemgetter(1), reverse=True)[:number]
+        contacts = models.Contact.objects.in_bulk([contact_id for (contact_id, count) in top])
+        return [(contacts[contact_id], count) for (contact_id, count) in top if contact_id in contacts]
+
+
+    def get_top_senders(self, number=5):
+        """Return a list of up to number (contact, mails sent) tuples, most mails first."""
+        if self._sender_counts == None:
+            sender = models.Mail._meta.get_field('sender')
+            self._sender_counts = self._count(models.Mail._meta.db_table, 'id', sender.column)
+        return self._get_contacts(self._sender_counts, number)
+
+
+    def get_top_recipients(self, number=5):
+        """Return a list of up to number (contact, mails received) tuples, most mails first."""
+        if self._recipient_counts == None:
+            self._recipient_counts = {}
+            for field_name in ['to', 'cc']:
+                for (contact_id, mails) in self._count_m2m(field_name).items():
+                    self._recipient_counts[contact_id] = self._recipient_counts.get(contact_id, 0) + mails
+        return self._get_contacts(self._recipient_counts, number)
+
+
+    def get_day_histogram(self):
+        """Return a list of (date, number of mails) tuples, oldest first, for days with mails."""
+        if self._day_histogram == None:
+            counts = self._count(models.Mail._meta.db_table, 'id', 'date', 'DATE')
+            self._day_histogram = sorted(counts.items())
+        return self._day_histogram
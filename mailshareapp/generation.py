@@ -0,0 +1,50 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Generation numbers shared between the web server and the polling process through files in
+MAILSHARE_CACHE_PATH. Whenever something changes that another process may have cached, the
+matching generation is bumped; a process compares the generation it last saw with the
+current one to find out whether its cache is stale.
+"""
+
+import os
+import random
+from django.conf import settings
+
+
+def _get_filename(name, temp=False):
+    filename = settings.MAILSHARE_CACHE_PATH + '/generation_' + name
+    if temp:
+        filename += '_tmp_' + str(os.getpid())
+    return filename
+
+
+def get(name):
+    """Return the current generation of the named data, as an opaque string."""
+    try:
+        generation_file = open(_get_filename(name), 'r')
+    except IOError:
+        return '0'
+    generation = generation_file.read().strip()
+    generation_file.close()
+    return generation
+
+
+def bump(name):
+    """Record that the named data has changed and return the new generation."""
+    count = get(name).split(' ')[0]
+    try:
+        count = int(count) + 1
+    except ValueError:
+        count = 1
+    # the random part makes sure two processes bumping at once still produce a change
+    generation = str(count) + ' ' + str(random.randint(0, 1000000))
+    temp_filename = _get_filename(name, True)
+    try:
+        temp_file = open(temp_filename, 'w')
+        temp_file.write(generation)
+        temp_file.close()
+        os.rename(temp_filename, _get_filename(name))
+    except (IOError, OSError):
+        pass
+    return generation
@@ -0,0 +1,310 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+An archive of the raw text of every email Mailshare has downloaded, so that the database can be
+rebuilt from it after the emails have been expunged from the IMAP mailbox.
+
+The archive is a directory of numbered segment files. Each email is compressed separately and
+appended to the newest segment as a record:
+
+    <compressed length> <message id>\n<zlib compressed message>\n
+
+When the newest segment grows beyond MAILSHARE_ARCHIVE_SEGMENT_SIZE bytes a new one is started.
+A sidecar index maps each Message-ID to the segment and offset of its record, so any email can
+be read back without scanning. Records that are no longer indexed, because the email was
+archived again or removed, are dropped when a segment is compacted.
+
+Only one process at a time can open the archive, since the index and the segments are not
+safe to write from two. The poller keeps it open, so it must be stopped before archive.py
+is used.
+"""
+
+import anydbm
+import email.parser
+import fcntl
+import mmap
+import os
+import zlib
+import settings
+
+SEGMENT_PREFIX = 'segment_'
+INDEX_NAME = 'index'
+LOCK_NAME = 'lock'
+
+
+class ArchiveInUseError(Exception):
+    """Raised when opening an archive that another process has open."""
+    pass
+
+
+def get_message_id(message_data):
+    """Return the Message-ID of the raw RFC822 message text, or '' if it has none."""
+    headers = email.parser.HeaderParser().parsestr(message_data, True)
+    message_id = headers.get('Message-ID')
+    if message_id == None:
+        return ''
+    return message_id
+
+
+def _get_key(message_id):
+    # Message-IDs can be folded over several lines; the key must fit on the record header line.
+    key = ' '.join(message_id.split())
+    if key == '':
+        key = '-'
+    return key
+
+
+def _read_record(segment_file):
+    # Read the record at the current position. Returns (key, message_data), or None at the end.
+    header = segment_file.readline()
+    if header == '':
+        return None
+    (length, key) = header.rstrip('\n').split(' ', 1)
+    compressed = segment_file.read(int(length))
+    segment_file.readline()
+    return (key, zlib.decompress(compressed))
+
+
+def _write_record(segment_file, key, message_data):
+    # Append a record and return its offset.
+    compressed = zlib.compress(message_data, settings.MAILSHARE_ARCHIVE_COMPRESSION_LEVEL)
+    segment_file.seek(0, os.SEEK_END)
+    offset = segment_file.tell()
+    segment_file.write(str(len(compressed)) + ' ' + key + '\n')
+    segment_file.write(compressed)
+    segment_file.write('\n')
+    return offset
+
+
+class MailArchive(object):
+    """A directory of segment files holding archived emails, with an index by Message-ID."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # the lock is released when the file is closed, including when the process dies
+        self._lock_file = open(os.path.join(path, LOCK_NAME), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lock_file.close()
+            raise ArchiveInUseError('The archive at ' + path + ' is in use by another process; '
+                                    'stop the poller first')
+        self._index = anydbm.open(os.path.join(path, INDEX_NAME), 'c')
+        self._segment_file = None
+        self._segment_number = None
+
+
+    def close(self):
+        """Close the archive, making sure everything written is on disk."""
+        self.flush()
+        if self._segment_file != None:
+            self._segment_file.close()
+            self._segment_file = None
+        self._index.close()
+        self._lock_file.close()
+
+
+    def flush(self):
+        """Write out buffered records and index entries."""
+        if self._segment_file != None:
+            self._segment_file.flush()
+        if hasattr(self._index, 'sync'):
+            self._index.sync()
+
+
+    def get_segment_numbers(self):
+        """Return the numbers of all the segments in the archive, oldest first."""
+        numbers = []
+        for filename in os.listdir(self.path):
+            if filename.startswith(SEGMENT_PREFIX) and filename[len(SEGMENT_PREFIX):].isdigit():
+                numbers.append(int(filename[len(SEGMENT_PREFIX):]))
+        numbers.sort()
+        return numbers
+
+
+    def _get_segment_filename(self, number):
+        return os.path.join(self.path, SEGMENT_PREFIX + '%06d' % number)
+
+
+    def _get_current_segment(self):
+        # Return the segment file to append to, starting a new segment if it has grown too big.
+        if self._segment_file == None:
+            numbers = self.get_segment_numbers()
+            self._segment_number = 1
+            if len(numbers) > 0:
+                self._segment_number = numbers[-1]
+            self._segment_file = open(self._get_segment_filename(self._segment_number), 'ab+')
+        self._segment_file.seek(0, os.SEEK_END)
+        if self._segment_file.tell() >= settings.MAILSHARE_ARCHIVE_SEGMENT_SIZE:
+            self._segment_file.close()
+            self._segment_number += 1
+            self._segment_file = open(self._get_segment_filename(self._segment_number), 'ab+')
+        return self._segment_file
+
+
+    def append(self, message_id, message_data):
+        """Archive the raw RFC822 text of an email with the specified Message-ID."""
+        key = _get_key(message_id)
+        segment_file = self._get_current_segment()
+        offset = _write_record(segment_file, key, message_data)
+        if key != '-':
+            self._index[key] = str(self._segment_number) + ' ' + str(offset)
+
+
+    def get(self, message_id):
+        """Return the raw text of the archived email with the specified Message-ID, or None."""
+        key = _get_key(message_id)
+        if not self._index.has_key(key):
+            return None
+        (number, offset) = self._index[key].split()
+        if self._segment_file != None:
+            self._segment_file.flush()
+        segment_file = open(self._get_segment_filename(int(number)), 'rb')
+        try:
+            segment_file.seek(int(offset))
+            record = _read_record(segment_file)
+        finally:
+            segment_file.close()
+        # if the index is out of date, don't return some other email
+        if record == None or record[0] != key:
+            return None
+        return record[1]
+
+
+    def remove(self, message_id):
+        """Remove an email from the index. Its record is dropped when its segment is compacted."""
+        key = _get_key(message_id)
+        if self._index.has_key(key):
+            del self._index[key]
+
+
+    def iter_segment(self, number, start_offset=0):
+        """
+        Yield (offset, next_offset, key, message_data) for each record in a segment, starting
+        at start_offset. The segment is memory mapped so that only the records being
+        processed are held in memory.
+        """
+        segment_file = open(self._get_segment_filename(number), 'rb')
+        try:
+            if os.fstat(segment_file.fileno()).st_size == 0:
+                return
+            mapped_file = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                mapped_file.seek(start_offset)
+                while True:
+                    offset = mapped_file.tell()
+                    record = _read_record(mapped_file)
+                    if record == None:
+                        break
+                    yield (offset, mapped_file.tell(), record[0], record[1])
+            finally:
+                mapped_file.close()
+        finally:
+            segment_file.close()
+
+
+    def iter_messages(self, start_position=(1, 0)):
+        """
+        Yield a (position, message_data) tuple for every archived email, oldest first, starting
+        at start_position. position is a (segment number, offset) tuple that can be passed back
+        in as start_position to resume after the email.
+        """
+        self.flush()
+        (start_number, start_offset) = start_position
+        for number in self.get_segment_numbers():
+            if number < start_number:
+                continue
+            offset = 0
+            if number == start_number:
+                offset = start_offset
+            for (offset, next_offset, key, message_data) in self.iter_segment(number, offset):
+                yield ((number, next_offset), message_data)
+
+
+    def _is_live(self, number, offset, key):
+        # A record is live if the index points at it. Records without a Message-ID can't be
+        # indexed, so they are always kept.
+        if key == '-':
+            return True
+        return self._index.has_key(key) and self._index[key] == str(number) + ' ' + str(offset)
+
+
+    def compact(self, number):
+        """
+        Rewrite a segment without the records that are no longer indexed. The newest segment,
+        which is still being appended to, can't be compacted. Returns the number of records dropped.
+        """
+        numbers = self.get_segment_numbers()
+        if number not in numbers or number == numbers[-1]:
+            return 0
+        filename = self._get_segment_filename(number)
+        temp_filename = filename + '_tmp'
+        temp_file = open(temp_filename, 'wb')
+        moved = {}
+        dropped = 0
+        for (offset, next_offset, key, message_data) in self.iter_segment(number):
+            if self._is_live(number, offset, key):
+                new_offset = _write_record(temp_file, key, message_data)
+                if key != '-':
+                    moved[key] = str(number) + ' ' + str(new_offset)
+            else:
+                dropped += 1
+        temp_file.close()
+        os.rename(temp_filename, filename)
+        for key in moved:
+            self._index[key] = moved[key]
+        self.flush()
+        return dropped
+
+
+    def compact_all(self):
+        """Compact every segment except the newest. Returns the number of records dropped."""
+        dropped = 0
+        for number in self.get_segment_numbers():
+            dropped += self.compact(number)
+        return dropped
+
+
+    def rebuild_index(self):
+        """Rebuild the index by scanning every segment. Later copies of an email win."""
+        for key in self._index.keys():
+            del self._index[key]
+        for number in self.get_segment_numbers():
+            for (offset, next_offset, key, message_data) in self.iter_segment(number):
+                if key != '-':
+                    self._index[key] = str(number) + ' ' + str(offset)
+        self.flush()
+
+
+def read_mailfile_data(input_file):
+    """Yield the raw text of each message in a mailfile written by poll_imap_email.write_part."""
+    while True:
+        line = input_file.readline()
+        if line == '':
+            break
+        length = int(line)
+        message_data = input_file.read(length)
+        input_file.readline()
+        yield message_data
+
+
+def convert_mailfile(input_file, archive):
+    """Copy every message in an old style mailfile into the archive. Returns the number copied."""
+    count = 0
+    for message_data in read_mailfile_data(input_file):
+        archive.append(get_message_id(message_data), message_data)
+        count += 1
+    archive.flush()
+    return count
+
+
+_archive = None
+
+def get_archive():
+    """Return the MailArchive at MAILSHARE_ARCHIVE_PATH, opening it if needed."""
+    global _archive
+    if _archive == None:
+        _archive = MailArchive(settings.MAILSHARE_ARCHIVE_PATH)
+    return _archive
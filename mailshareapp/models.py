@@ -1,7 +1,12 @@
 # License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 import tags
+import rollups
+import text_index
+import trigram_index
+import search_cache
 
 class Tag(models.Model):
     MAX_TAG_NAME_LENGTH=128
@@ -12,7 +17,7 @@ class Tag(models.Model):
     def save(self, *args, **kwargs):
         self.name = self.name.lower()
         super(Tag, self).save(*args, **kwargs)
-        tags.apply_autotag(self)
+        tags.tag_saved(self)
     class Meta:
         ordering = ['name']
 
@@ -39,3 +44,77 @@ class Mail(models.Model):
         return self.date.isoformat() + ' ' + self.sender.address[0:20] + ' ' + self.subject[0:30]
     class Meta:
         ordering = ['-date']
+
+class AutotagJob(models.Model):
+    """
+    A queued job to add an autotag to the existing mails that contain it. Jobs are run in the
+    background a chunk of mails at a time; last_mail_id records how far a job has got so that
+    it can carry on after a restart.
+    """
+    QUEUED = 'queued'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+    STATE_CHOICES = ((QUEUED, 'Queued'), (DONE, 'Done'), (CANCELLED, 'Cancelled'), (FAILED, 'Failed'))
+    tag = models.ForeignKey(Tag, related_name='autotag_jobs')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=QUEUED)
+    last_mail_id = models.IntegerField(default=0)
+    mails_tagged = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    def __unicode__(self):
+        return self.tag.name + ' ' + self.state
+    class Meta:
+        ordering = ['-created']
+
+class TeamTagDayCount(models.Model):
+    """
+    The number of mails with a tag received by a team on a day, maintained by rollups. team
+    is the Contact id of the team, or rollups.ALL_TEAMS to count every mail.
+    """
+    team = models.IntegerField()
+    tag = models.ForeignKey(Tag)
+    day = models.DateField()
+    mails = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ('team', 'tag', 'day')
+
+class TeamSenderDayCount(models.Model):
+    """The number of mails from a sender received by a team on a day, maintained by rollups."""
+    team = models.IntegerField()
+    sender = models.ForeignKey(Contact)
+    day = models.DateField()
+    mails = models.IntegerField(default=0)
+    class Meta:
+        unique_together = ('team', 'sender', 'day')
+
+class TextQuery(models.Model):
+    """
+    The text queries of a search answered by Mailshare's search index, whose combined scores
+    are kept in TextQueryScore so that the search can join to the matching mails instead of
+    listing their ids. key identifies the queries; version is the version of the index the
+    scores are up to date with and last_mail_id the highest mail id they cover; created is
+    when they were last all stored. Maintained by text_scores.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    version = models.IntegerField()
+    last_mail_id = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+class TextQueryScore(models.Model):
+    """The relevance of a mail matching a TextQuery."""
+    query = models.ForeignKey(TextQuery)
+    mail_id = models.IntegerField()
+    score = models.FloatField()
+    class Meta:
+        unique_together = ('query', 'mail_id')
+
+post_delete.connect(tags.tag_deleted, sender=Tag)
+m2m_changed.connect(rollups.mail_tags_changed, sender=Mail.tags.through)
+pre_delete.connect(rollups.mail_deleted, sender=Mail)
+post_delete.connect(text_index.mail_deleted, sender=Mail)
+post_delete.connect(trigram_index.mail_deleted, sender=Mail)
+post_delete.connect(search_cache.mails_changed, sender=Mail)
+post_delete.connect(search_cache.mail_tags_changed, sender=Tag)
+post_save.connect(search_cache.tag_saved, sender=Tag)
+m2m_changed.connect(search_cache.mail_tags_changed, sender=Mail.tags.through)
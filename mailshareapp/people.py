@@ -2,23 +2,30 @@
 
 import models
 import search
-from operator import itemgetter
-
-def search_results_to_top_senders_html(query_set, current_search):
-    senders_dict = {}
-    for m in query_set:
-        if m.sender in senders_dict:
-            senders_dict[m.sender] = senders_dict[m.sender] + 1
-        else:
-            senders_dict[m.sender] = 1
-    senders_list = sorted(senders_dict.iteritems(), key=itemgetter(1), reverse=True)
-    top_senders = senders_list[:5]
+import facets
 
+def contact_counts_to_html(contact_counts, current_search, search_function):
+    """
+    Render a list of (contact, number of mails) tuples as an ordered list of links to the search
+    returned by search_function for each contact, ANDed with current_search.
+    """
     html = '<ol>'
-    for sender, number in top_senders:
-        sender_search = current_search.add_and(search.get_sender_id_search(sender.id))
-        html += '<li><a href="' + sender_search.get_url_path()
-        html += '" title="' + sender.address + '">'
-        html += sender.name + '</a> : ' + str(number) + '</li>'
+    for contact, number in contact_counts:
+        contact_search = current_search.add_and(search_function(contact.id))
+        html += '<li><a href="' + contact_search.get_url_path()
+        html += '" title="' + contact.address + '">'
+        html += contact.name + '</a> : ' + str(number) + '</li>'
     html += '</ol>'
     return html
+
+
+def top_senders_to_html(top_senders, current_search):
+    return contact_counts_to_html(top_senders, current_search, search.get_sender_id_search)
+
+
+def top_recipients_to_html(top_recipients, current_search):
+    return contact_counts_to_html(top_recipients, current_search, search.get_recipient_id_search)
+
+
+def search_results_to_top_senders_html(query_set, current_search):
+    return top_senders_to_html(facets.Facets(query_set).get_top_senders(5), current_search)
@@ -1,52 +1,350 @@
 # License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
 
 import imaplib
+import mmap
+import os
+import select
+import socket
+import time
 import settings # TODO make this work: from django.conf import settings
 import email
 
 _server = None
+_uidvalidity = None
 
 def get_server_connection():
     """Logs in to the server if needed, Returns an IMAP4 object."""
     global _server
+    global _uidvalidity
     if _server == None:
         _server = imaplib.IMAP4_SSL(settings.MAILSHARE_IMAP_HOST)
         _server.login(settings.MAILSHARE_IMAP_USER, settings.MAILSHARE_IMAP_PASSWORD)
         _server.select(settings.MAILSHARE_IMAP_MAILBOX)
+        # SELECT always reports UIDVALIDITY. If it changes, previously seen UIDs are meaningless.
+        typ, data = _server.response('UIDVALIDITY')
+        if data[0] != None:
+            _uidvalidity = data[0]
+        # the message count SELECT reports is not new mail
+        _pop_new_mail_responses(_server)
     return _server
 
 
+def _get_checkpoint_filename(temp=False):
+    filename = settings.MAILSHARE_CACHE_PATH + '/imap_checkpoint'
+    if temp:
+        filename += '_tmp'
+    return filename
+
+
+def _get_mailbox_identity():
+    # The checkpoint is only valid for the same mailbox on the same server.
+    return settings.MAILSHARE_IMAP_HOST + ' ' + settings.MAILSHARE_IMAP_USER + ' ' + \
+        settings.MAILSHARE_IMAP_MAILBOX
+
+
+def load_checkpoint():
+    """
+    Return the highest UID already processed from the current mailbox, or 0 if there is no
+    checkpoint or the checkpoint was taken with a different UIDVALIDITY.
+    """
+    try:
+        checkpoint_file = open(_get_checkpoint_filename(), 'r')
+    except IOError:
+        return 0
+    lines = checkpoint_file.read().split('\n')
+    checkpoint_file.close()
+    if len(lines) < 3 or lines[0] != _get_mailbox_identity() or lines[1] != str(_uidvalidity):
+        return 0
+    try:
+        return int(lines[2])
+    except ValueError:
+        return 0
+
+
+def save_checkpoint(last_uid):
+    """Record that all messages up to and including last_uid have been processed."""
+    temp_filename = _get_checkpoint_filename(True)
+    temp_file = open(temp_filename, 'w')
+    temp_file.write(_get_mailbox_identity() + '\n' + str(_uidvalidity) + '\n' + str(last_uid) + '\n')
+    temp_file.close()
+    # rename so that a crash never leaves a half written checkpoint behind
+    os.rename(temp_filename, _get_checkpoint_filename())
+
+
+def mark_processed(uids):
+    """Advance the checkpoint past the specified UIDs once their messages are safely stored."""
+    if len(uids) == 0:
+        return
+    last_uid = max(int(uid) for uid in uids)
+    if last_uid > load_checkpoint():
+        save_checkpoint(last_uid)
+
+
+def get_processed_uids(uids, missing_uids):
+    """
+    Return the UIDs of a batch that can be checkpointed and expunged, given the UIDs of the
+    new messages in it that were not stored, e.g. because fetching them failed. Nothing from
+    the first missing UID on counts, so that the checkpoint never moves past a message that
+    was not stored and a restart fetches it again.
+    """
+    if len(missing_uids) == 0:
+        return list(uids)
+    first_missing = min(int(uid) for uid in missing_uids)
+    return [uid for uid in uids if int(uid) < first_missing]
+
+
+def search_uids(server, max_messages=10):
+    """
+    Return a list of up to max_messages UIDs of messages in the mailbox that arrived since the
+    last checkpoint, oldest first.
+    """
+    last_uid = load_checkpoint()
+    typ, uid_data = server.uid('search', None, 'UID ' + str(last_uid + 1) + ':*')
+    # uid_data is a list with one item, so it looks like this:
+    # [b'1 2 3 4 5']
+    # 'n:*' always matches the highest UID in the mailbox even when it is below n, so
+    # filter out anything we have already seen.
+    uids = [int(uid) for uid in uid_data[0].split() if int(uid) > last_uid]
+    uids.sort()
+    return [str(uid) for uid in uids[0:max_messages]]
+
+
+def uid_set(uids):
+    """
+    Return an IMAP sequence set string for the list of UIDs, collapsing runs of consecutive
+    UIDs into ranges so that a large batch still makes a short command, e.g. '1:5,8,10:12'.
+    """
+    numbers = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    start = None
+    previous = None
+    for number in numbers:
+        if start == None:
+            start = number
+        elif number != previous + 1:
+            ranges.append((start, previous))
+            start = number
+        previous = number
+    if start != None:
+        ranges.append((start, previous))
+
+    parts = []
+    for (first, last) in ranges:
+        if first == last:
+            parts.append(str(first))
+        else:
+            parts.append(str(first) + ':' + str(last))
+    return ','.join(parts)
+
+
+def _get_fetch_uid(text):
+    # Return the UID in part of a FETCH response such as '12 (UID 345 RFC822 {5678}' or
+    # ' UID 345)', or None if it has none.
+    words = text.replace('(', ' ').replace(')', ' ').split()
+    for i in range(len(words) - 1):
+        if words[i].upper() == 'UID':
+            return words[i+1]
+    return None
+
+
+def _iter_fetch_parts(message_data):
+    # Yield a (uid, data) tuple for each message in the data returned by imaplib for a UID
+    # FETCH of one literal per message. Each message is a (header, literal) tuple followed by
+    # a string holding the rest of its response, and servers may put the UID in either.
+    part = None
+    for item in message_data:
+        if isinstance(item, tuple):
+            if part != None:
+                yield part
+            part = (_get_fetch_uid(item[0]), item[1])
+        elif part != None:
+            if part[0] == None:
+                part = (_get_fetch_uid(item), part[1])
+            yield part
+            part = None
+    if part != None:
+        yield part
+
+
+def _iter_fetch_uid_parts(message_data):
+    # As _iter_fetch_parts, skipping any message the server sent without a UID.
+    for (uid, data) in _iter_fetch_parts(message_data):
+        if uid == None:
+            print 'Ignoring fetched message without a UID'
+            continue
+        yield (uid, data)
+
+
+def iter_fetch_uids(server, uids, output_file=None):
+    """
+    Fetch the messages with the specified UIDs using a single UID FETCH command and
+    yield a (uid, message_data) tuple for each one, where message_data is the raw RFC822
+    text. Parts are yielded in the order the server returned them.
+    output_file: a file to append email data to
+    """
+    if len(uids) == 0:
+        return
+    try:
+        typ, message_data = server.uid('fetch', uid_set(uids), '(RFC822)')
+    except (imaplib.IMAP4.error, socket.error), e:
+        # the caller finds which messages are missing from those yielded
+        print 'Exception fetching messages ' + uid_set(uids) + ': ' + str(e)
+        return
+    for (uid, data) in _iter_fetch_uid_parts(message_data):
+        if output_file != None:
+            write_part(output_file, data)
+        yield (uid, data)
+
+
+def fetch_message_ids(server, uids):
+    """
+    Return a dictionary mapping each of the specified UIDs to the Message-ID header of its
+    message, fetching only that header so that messages can be screened before downloading
+    them. Messages without a Message-ID map to None.
+    """
+    message_ids = {}
+    if len(uids) == 0:
+        return message_ids
+    typ, message_data = server.uid('fetch', uid_set(uids), '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+    for (uid, data) in _iter_fetch_uid_parts(message_data):
+        headers = email.message_from_string(data)
+        message_ids[uid] = headers.get('Message-ID')
+    return message_ids
+
+
+def delete_uids(server, uids):
+    """Flag all the messages with the specified UIDs as deleted and expunge them in one go."""
+    if len(uids) == 0:
+        return
+    typ, response = server.uid('store', uid_set(uids), '+FLAGS', '(\\Deleted)')
+    typ, response = server.expunge()
+
+
+def supports_idle(server):
+    """Return True if the server advertises the IDLE extension (RFC 2177)."""
+    return 'IDLE' in server.capabilities
+
+
+def _has_buffered_data(server):
+    # Data that has already been read from the socket doesn't show up in select: lines
+    # imaplib's file object has buffered but not yet returned, and data already decrypted by
+    # the SSL layer.
+    buffer = getattr(getattr(server, 'file', None), '_rbuf', None)
+    if buffer != None and len(buffer.getvalue()) > 0:
+        return True
+    sslobj = getattr(server, 'sslobj', None)
+    return sslobj != None and sslobj.pending() > 0
+
+
+def _wait_until_readable(server, deadline):
+    # Wait for the server to send something, returning False if the time.time() deadline
+    # passes first.
+    if _has_buffered_data(server):
+        return True
+    timeout = deadline - time.time()
+    if timeout <= 0:
+        return False
+    readable, writable, errors = select.select([server.socket()], [], [], timeout)
+    return len(readable) > 0
+
+
+def _is_exists_response(line):
+    # New mail is announced with an untagged response such as '* 23 EXISTS'
+    words = line.split()
+    return len(words) == 3 and words[0] == '*' and words[2].upper() == 'EXISTS'
+
+
+def _pop_new_mail_responses(server):
+    # imaplib keeps the untagged responses to earlier commands until they are asked for, so
+    # an EXISTS or RECENT sent with the response to a STORE or EXPUNGE waits there and is not
+    # sent again during IDLE. Return whether there was one, forgetting it.
+    exists = server.untagged_responses.pop('EXISTS', None)
+    recent = server.untagged_responses.pop('RECENT', None)
+    return exists != None or (recent != None and len([count for count in recent if count != '0']) > 0)
+
+
+def idle(server, timeout):
+    """
+    Issue an IMAP IDLE command and wait up to timeout seconds for the server to report that
+    a message has arrived. Returns True if new mail was reported, False on timeout.
+
+    The mailbox must already be selected and the server must support IDLE.
+    """
+    if _pop_new_mail_responses(server):
+        return True
+    tag = server._new_tag()
+    server.send(tag + ' IDLE\r\n')
+    line = server.readline()
+    if not line.startswith('+'):
+        raise imaplib.IMAP4.error('IDLE rejected: ' + line.strip())
+
+    # other untagged responses, such as keepalives, don't put the deadline back
+    deadline = time.time() + timeout
+    new_mail = False
+    while not new_mail and _wait_until_readable(server, deadline):
+        line = server.readline()
+        if line == '':
+            raise imaplib.IMAP4.abort('connection closed during IDLE')
+        new_mail = _is_exists_response(line)
+
+    server.send('DONE\r\n')
+    while True:
+        line = server.readline()
+        if line == '':
+            raise imaplib.IMAP4.abort('connection closed ending IDLE')
+        if line.startswith(tag + ' '):
+            break
+        if _is_exists_response(line):
+            new_mail = True
+    if not line.startswith(tag + ' OK'):
+        raise imaplib.IMAP4.error('IDLE failed: ' + line.strip())
+    return new_mail
+
+
+def next_poll_delay(delay, messages_found):
+    """
+    Return how many seconds to sleep before polling a server without IDLE again. The delay
+    is reset to the minimum when mail arrives and doubles, up to the maximum, while the
+    mailbox is quiet.
+    """
+    if messages_found > 0:
+        return settings.MAILSHARE_POLL_MIN_INTERVAL
+    return min(delay * 2, settings.MAILSHARE_POLL_MAX_INTERVAL)
+
+
+def wait_for_new_mail(server, delay, messages_found):
+    """
+    Block until it is worth polling the mailbox again and return the delay to pass in next
+    time. Servers that support IDLE wake us as soon as mail arrives; for the others we sleep
+    with an adaptive delay.
+    """
+    if settings.MAILSHARE_IMAP_USE_IDLE and supports_idle(server):
+        idle(server, settings.MAILSHARE_IMAP_IDLE_TIMEOUT)
+        return settings.MAILSHARE_POLL_MIN_INTERVAL
+    delay = next_poll_delay(delay, messages_found)
+    time.sleep(delay)
+    return delay
+
+
 def fetch_messages(max_messages=10, output_file=None, expunge=False):
     """Return a list of email.message.Message objects representing some messages in the IMAP mailbox.
     max_messages: the maximum number of messages to fetch this call
     output_file:  a file to append email data to
+
+    The checkpoint is advanced past the returned messages, so the next call returns newer ones.
     """
     messages = []
 
     server = get_server_connection()
-    typ, message_ids = server.search(None, 'ALL')
+    uids = search_uids(server, max_messages)
+    fetched_uids = []
+    for (uid, message_data) in iter_fetch_uids(server, uids, output_file):
+        messages.append(email.message_from_string(message_data))
+        fetched_uids.append(uid)
+    mark_processed(fetched_uids)
 
-    # message_ids is a list with one item, so it looks like this:
-    # [b'1 2 3 4 5']
-    # To get a maximum number of mails we need to split it out into a list of
-    # ids.
-    message_ids_to_fetch = message_ids[0].split()[0:max_messages]
-
-    for message_id in message_ids_to_fetch:
-        try:
-            typ, message_data = server.fetch(message_id, '(RFC822)')
-        except:
-            print 'Exception processing message ' + str(message_id)
-            continue
-        for part in message_data:
-            if isinstance(part, tuple):
-                if output_file != None:
-                    write_part(output_file, part[1])
-                message = email.message_from_string(part[1])
-                messages.append(message)
-        if expunge and settings.MAILSHARE_IMAP_ENABLE_EXPUNGE:
-            typ, response = server.store(message_id, '+FLAGS', '\\Deleted')
-            typ, response = server.expunge()
+    if expunge and settings.MAILSHARE_IMAP_ENABLE_EXPUNGE:
+        delete_uids(server, fetched_uids)
 
     return messages
 
@@ -58,21 +356,36 @@ def write_part(output_file, message_data):
     output_file.write('\n')
 
 
-def read_messages(input_file):
+def iter_mailfile(input_file, start_offset=0):
     """
-    Read up to max_messages messages from input_file. Reads messages previously written to the
-    output_file specified in a call to fetch_messages. This enable replaying of messages into the
-    database that have been deleted from the IMAP mailbox.
+    Yield a (next_offset, message_data) tuple for each message previously written to
+    input_file by write_part, starting at the byte offset start_offset. next_offset is the
+    offset of the following message, so it can be passed back in to resume after this one.
+    The file is memory mapped, so only the messages being processed are held in memory.
     """
-    messages = []
-    while True:
-        line = input_file.readline()
-        if line == '':
-            break
-        length = int(line)
-        message_data = input_file.read(length)
-        input_file.readline()
-        message = email.message_from_string(message_data)
-        messages.append(message)
+    if os.fstat(input_file.fileno()).st_size == 0:
+        return
+    mapped_file = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = start_offset
+        while offset < len(mapped_file):
+            line_end = mapped_file.find('\n', offset)
+            if line_end == -1:
+                break
+            length = int(mapped_file[offset:line_end])
+            message_start = line_end + 1
+            message_data = mapped_file[message_start:message_start + length]
+            offset = message_start + length + 1
+            yield (offset, message_data)
+    finally:
+        mapped_file.close()
 
-    return messages
+
+def read_messages(input_file):
+    """
+    Yield email.message.Message objects for the messages in input_file. Reads messages previously
+    written to the output_file specified in a call to fetch_messages. This enable replaying of
+    messages into the database that have been deleted from the IMAP mailbox.
+    """
+    for (offset, message_data) in iter_mailfile(input_file):
+        yield email.message_from_string(message_data)
@@ -4,11 +4,23 @@ import email
 import datetime
 import warnings
 import sys
+import os
+import itertools
 import time
+import multiprocessing
+from django.db import connection, transaction, DatabaseError
 import poll_imap_email
-from mailshare.mailshareapp.models import Mail, Contact, Tag
-from tags import add_tags_to_mail, add_regex_tags_to_mail
+import contact_cache
+import mail_archive
+from mailshare.mailshareapp.models import Mail, Tag
+import tags
+import bulk_relations
 import tag_cloud_cache
+import rollups
+import text_index
+import trigram_index
+import search_cache
+import completion
 import settings
 
 def get_body(message):
@@ -43,21 +55,14 @@ def get_body(message):
 def get_or_add_contact(name, address):
     """
     Looks up the email address in the Contact table. If the address does not exist in the table
-    it is added. In both cases the matching Contact object is returned.
+    it is added. In both cases the id of the matching Contact is returned.
 
     Email addresses are considered to be case insensitive for now. While not strictly true,
     this seems more useful than the alternative.
     """
-    contact_list = Contact.objects.filter(address__iexact=address)
-    result = None
-    if len(contact_list) == 0:
-        name = convert_name_to_utf8(name)
-        contact = Contact(name=name, address=address)
-        contact.save()
-        result = contact
-    else:
-        result = contact_list[0]
-    return result
+    name = convert_name_to_utf8(name)
+    contact_ids = contact_cache.get_contact_ids([(name, address)])
+    return contact_ids[contact_cache.normalise_address(address)]
 
 
 def strip_strange_whitespace(addresses):
@@ -92,22 +97,28 @@ def convert_name_to_utf8(name):
     return unicode_binary.encode('utf-8')
 
 
-def add_contacts_to_mail(address_field, address_headers):
+def parse_addresses(address_headers):
     """
-    Parse out email addresses and add them to the Mail table.
-    address_field: a ManyToManyField linked to the Contact table
-    address_header: headers retrieved with email.email.Message.get_all
-    Returns a set of added contacts.
+    Parse email addresses out of headers retrieved with email.email.Message.get_all and
+    return a list of (name, address) tuples with the names converted to utf-8.
     """
-    contact_set = set()
-    if address_headers != None:
-        address_headers = strip_strange_whitespace(address_headers)
-        addresses = email.utils.getaddresses(address_headers)
-        for (name, address) in addresses:
-            contact = get_or_add_contact(name, address)
-            address_field.add(contact)
-            contact_set.add(contact)
-    return contact_set
+    if address_headers == None:
+        return []
+    address_headers = strip_strange_whitespace(address_headers)
+    addresses = email.utils.getaddresses(address_headers)
+    return [(convert_name_to_utf8(name), address) for (name, address) in addresses]
+
+
+def get_contact_id_set(addresses, contact_ids):
+    """
+    Return the set of contact ids for a list of addresses.
+    addresses: a list of (name, address) tuples returned by parse_addresses
+    contact_ids: the result of contact_cache.get_contact_ids for the addresses
+    """
+    contact_id_set = set()
+    for (name, address) in addresses:
+        contact_id_set.add(contact_ids[contact_cache.normalise_address(address)])
+    return contact_id_set
 
 
 def datetime_from_email_date(email_date):
@@ -133,38 +144,215 @@ def get_if_present(message, header):
     return value
 
 
-def add_message_to_database(message):
+def parse_message_object(message):
+    """
+    Extract everything needed to store an email.message.Message in the database and return
+    it as a dictionary. This does not touch the database, so it can run in a worker process.
+    """
+    (content_type, body) = get_body(message)
+    subject = message.get('Subject')
+    return {
+        'message_id': get_if_present(message, 'Message-ID'),
+        'sender': parse_addresses([message.get('from', '')])[0],
+        'to': parse_addresses(message.get_all('to')),
+        'cc': parse_addresses(message.get_all('cc')),
+        'subject': subject,
+        'date': datetime_from_email_date(message.get('Date')),
+        'thread_index': get_if_present(message, 'Thread-Index'),
+        'in_reply_to': get_if_present(message, 'In-Reply-To'),
+        'references': get_if_present(message, 'References'),
+        'content_type': content_type,
+        'body': body,
+        'text_tag_names': tags.get_text_tag_names(subject, body, content_type),
+    }
+
+
+def parse_message(message_data):
+    """Parse raw RFC822 message text with parse_message_object."""
+    return parse_message_object(email.message_from_string(message_data))
+
+
+_parse_pool = None
+
+def parse_messages(messages_data):
+    """
+    Return a list of parse_message results for a list of raw RFC822 message texts, in the
+    same order. The parsing is spread over MAILSHARE_PARSE_WORKERS processes.
+    """
+    global _parse_pool
+    if settings.MAILSHARE_PARSE_WORKERS <= 1 or len(messages_data) <= 1:
+        return [parse_message(message_data) for message_data in messages_data]
+    if _parse_pool == None:
+        # the workers never use the database, so don't let them inherit our connection
+        connection.close()
+        _parse_pool = multiprocessing.Pool(settings.MAILSHARE_PARSE_WORKERS)
+    chunk_size = max(1, len(messages_data) / (settings.MAILSHARE_PARSE_WORKERS * 4))
+    return _parse_pool.map(parse_message, messages_data, chunk_size)
+
+
+def new_relations():
+    """
+    Return an empty collection of the relation rows for a batch of new mails. The rows are
+    written with one INSERT per table by write_relations.
+    """
+    return {'to': set(), 'cc': set(), 'tags': set(), 'mails': []}
+
+
+def write_relations(relations):
+    """Write the To, Cc and tag relations collected for a batch of mails and run the new email hooks."""
+    for field_name in ['to', 'cc', 'tags']:
+        bulk_relations.insert_relations(Mail, field_name, relations[field_name])
+    rollups.mails_added([m.id for m in relations['mails']])
+    text_index.add_mails(relations['mails'])
+    trigram_index.add_mails(relations['mails'])
+    for m in relations['mails']:
+        for hook in settings.MAILSHARE_NEW_EMAIL_HOOKS:
+            hook(m)
+
+
+def add_parsed_message_to_database(parsed, relations=None):
     """
-    Add the message to the database if it is unique according to its Message-ID field.
+    Add a message returned by parse_message to the database if it is unique according to
+    its Message-ID field.
+
+    relations: the result of new_relations, to which the mail's To, Cc and tag rows are
+    added for writing later along with the rest of the batch. If None, they are written now.
 
-    Returns a set of contacts who are recipients of the message.
+    Returns a set of ids of contacts who are recipients of the message.
     """
-    message_id = message.get('Message-ID')
-    matching_messages = Mail.objects.filter(message_id__exact=message_id)
+    write_now = (relations == None)
+    if write_now:
+        relations = new_relations()
+
+    # messages without a Message-ID can't be recognised as duplicates so are always added
+    matching_messages = []
+    if parsed['message_id'] != '':
+        matching_messages = Mail.objects.filter(message_id__exact=parsed['message_id'])
     contact_set = set()
     if len(matching_messages) == 0:
+        # resolve every address on the message with one query
+        contact_ids = contact_cache.get_contact_ids([parsed['sender']] + parsed['to'] + parsed['cc'])
         m = Mail()
-        m.sender = get_or_add_contact(*email.utils.parseaddr(message.get('from')))
-        m.subject = message.get('Subject')
-        m.date = datetime_from_email_date(message.get('Date'))
-        m.message_id = get_if_present(message, 'Message-ID')
-        m.thread_index = get_if_present(message, 'Thread-Index')
-        m.in_reply_to = get_if_present(message, 'In-Reply-To')
-        m.references = get_if_present(message, 'References')
-        (m.content_type, m.body) = get_body(message)
+        m.sender_id = contact_ids[contact_cache.normalise_address(parsed['sender'][1])]
+        m.subject = parsed['subject']
+        m.date = parsed['date']
+        m.message_id = parsed['message_id']
+        m.thread_index = parsed['thread_index']
+        m.in_reply_to = parsed['in_reply_to']
+        m.references = parsed['references']
+        m.content_type = parsed['content_type']
+        m.body = parsed['body']
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
             m.save()
-        contacts = add_contacts_to_mail(m.to, message.get_all('to'))
-        contact_set |= contacts
-        contacts = add_contacts_to_mail(m.cc, message.get_all('cc'))
-        contact_set |= contacts
-        add_tags_to_mail(m)
-        for hook in settings.MAILSHARE_NEW_EMAIL_HOOKS:
-            hook(m)
+        to_ids = get_contact_id_set(parsed['to'], contact_ids)
+        cc_ids = get_contact_id_set(parsed['cc'], contact_ids)
+        relations['to'] |= set((m.id, contact_id) for contact_id in to_ids)
+        relations['cc'] |= set((m.id, contact_id) for contact_id in cc_ids)
+        tag_ids = tags.get_tag_ids_for_mail(m, parsed['text_tag_names'])
+        relations['tags'] |= set((m.id, tag_id) for tag_id in tag_ids)
+        relations['mails'].append(m)
+        contact_set = to_ids | cc_ids
+
+    if write_now:
+        write_relations(relations)
     return contact_set
 
 
+def add_parsed_messages_to_database(parsed_messages, verbose=False):
+    """
+    Add a batch of messages returned by parse_messages to the database, in order.
+
+    Returns a set of ids of contacts who are recipients of the messages.
+    """
+    contact_set = set()
+    relations = new_relations()
+    for parsed in parsed_messages:
+        if verbose:
+            print_parsed_message_headers(parsed)
+        contact_set |= add_parsed_message_to_database(parsed, relations)
+    write_relations(relations)
+    return contact_set
+
+
+_transactional = None
+
+def tables_are_transactional():
+    """
+    Return True if all of Mailshare's tables can roll back a transaction. MyISAM tables keep
+    whatever was written before an error, so a batch that failed half way through can't be
+    retried: the mails already stored would be skipped, losing their recipients and tags.
+    """
+    global _transactional
+    if _transactional == None:
+        cursor = connection.cursor()
+        cursor.execute('SELECT ENGINE FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() '
+                       'AND TABLE_NAME LIKE %s', ['mailshareapp\\_%'])
+        engines = set(row[0].upper() for row in cursor.fetchall() if row[0] != None)
+        _transactional = engines <= set(['INNODB'])
+        if not _transactional:
+            print 'Mailshare tables are not all InnoDB; failed batches will not be retried'
+    return _transactional
+
+
+def store_parsed_messages(parsed_messages, verbose=False):
+    """
+    Add a batch of messages returned by parse_messages to the database in a single
+    transaction, so a batch is either stored completely or not at all. If the database
+    reports an error the transaction is rolled back and the batch is retried up to
+    MAILSHARE_INGEST_RETRIES times before giving up and raising the error. Batches are only
+    retried if tables_are_transactional.
+
+    Returns a set of ids of contacts who are recipients of the messages.
+    """
+    retries = 0
+    if tables_are_transactional():
+        retries = settings.MAILSHARE_INGEST_RETRIES
+    attempt = 0
+    while True:
+        try:
+            with transaction.commit_on_success():
+                contact_set = add_parsed_messages_to_database(parsed_messages, verbose)
+            text_index.write_pending()
+            trigram_index.write_pending()
+            search_cache.mails_changed()
+            return contact_set
+        except DatabaseError:
+            # contacts and mails added by the rolled back transaction no longer exist
+            contact_cache.clear()
+            text_index.discard_pending()
+            trigram_index.discard_pending()
+            attempt += 1
+            if attempt > retries:
+                raise
+            print 'Database error storing batch; retrying (attempt ' + str(attempt) + ')'
+            # start again with a fresh connection in case the old one was lost
+            connection.close()
+            time.sleep(attempt)
+
+
+def add_message_to_database(message):
+    """
+    Add the email.message.Message to the database if it is unique according to its Message-ID field.
+
+    Returns a set of ids of contacts who are recipients of the message.
+    """
+    return add_parsed_message_to_database(parse_message_object(message))
+
+
+def screen_new_uids(server, uids):
+    """
+    Return the subset of the IMAP UIDs whose messages are not already in the database,
+    checking only their Message-ID headers so that duplicates are never downloaded.
+    """
+    message_ids = poll_imap_email.fetch_message_ids(server, uids)
+    known_ids = [message_id for message_id in message_ids.values() if message_id != None]
+    existing_ids = set()
+    if len(known_ids) > 0:
+        existing_ids = set(Mail.objects.filter(message_id__in=known_ids).values_list('message_id', flat=True))
+    return [uid for uid in uids if message_ids.get(uid) not in existing_ids]
+
+
 def print_message_headers(message):
     """Given an email.message.Message object, print out some interesting headers."""
     print "To: " + message.get('To')
@@ -172,6 +360,21 @@ def print_message_headers(message):
     print "Subject: " + message.get('Subject')
     print "Date: " + message.get('Date')
 
+def print_parsed_message_headers(parsed):
+    """Given a parse_message result, print out some interesting headers."""
+    print "To: " + ', '.join([address for (name, address) in parsed['to']])
+    print "From: " + parsed['sender'][1]
+    print "Subject: " + parsed['subject']
+    print "Date: " + parsed['date'].isoformat()
+
+
+def print_throughput(action, count, seconds):
+    """Print how fast a stage of processing a batch of emails went."""
+    rate = ''
+    if seconds > 0:
+        rate = ' (%.1f emails/s)' % (count / seconds)
+    print '%s %d emails in %.3fs%s' % (action, count, seconds, rate)
+
 mail_file_name = 'mailfile'
 
 def quick_test(from_file=False, num_emails=10):
@@ -189,31 +392,219 @@ def test_email(n):
     """Test the nth email in the file."""
     mail_file = open(mail_file_name, 'r')
     messages = poll_imap_email.read_messages(mail_file)
-    print_message_headers(messages[n])
-    (content_type, body) = get_body(messages[n])
+    message = next(itertools.islice(messages, n, None))
+    print_message_headers(message)
+    (content_type, body) = get_body(message)
     print "Content type: " + content_type
     print body
-    return messages[n]
+    return message
+
+
+def load_replay_checkpoint(checkpoint_filename):
+    """Return the position saved by save_replay_checkpoint, or None if there isn't one."""
+    try:
+        checkpoint_file = open(checkpoint_filename, 'r')
+    except IOError:
+        return None
+    position = checkpoint_file.read().split()
+    checkpoint_file.close()
+    return [int(value) for value in position]
+
+
+def save_replay_checkpoint(checkpoint_filename, position):
+    """Record the position of the next message to replay. position is a list of numbers."""
+    temp_filename = checkpoint_filename + '_tmp'
+    temp_file = open(temp_filename, 'w')
+    temp_file.write(' '.join([str(value) for value in position]) + '\n')
+    temp_file.close()
+    os.rename(temp_filename, checkpoint_filename)
 
 
-def apply_all_regex_tags(test_mode):
-    mails = Mail.objects.all()
-    for mail in mails:
-        add_regex_tags_to_mail(mail, test_mode)
+def replay_messages(messages, checkpoint_filename, verbose=False):
+    """
+    Add messages to the database in batches of MAILSHARE_IMAP_BATCH_SIZE.
+    messages: an iterator of (position, message_data) tuples, where position is a list of
+              numbers that resumes the replay after message_data.
+    After each batch is committed its position is saved to checkpoint_filename, so an
+    interrupted replay can be resumed. Progress is printed after each batch.
+
+    Returns the number of messages replayed.
+    """
+    start = time.time()
+    count = 0
+    batch = []
+    position = None
+    for (position, message_data) in messages:
+        batch.append(message_data)
+        if len(batch) == settings.MAILSHARE_IMAP_BATCH_SIZE:
+            store_parsed_messages(parse_messages(batch), verbose)
+            save_replay_checkpoint(checkpoint_filename, position)
+            count += len(batch)
+            batch = []
+            print_throughput('Replayed', count, time.time() - start)
+    if len(batch) > 0:
+        store_parsed_messages(parse_messages(batch), verbose)
+        save_replay_checkpoint(checkpoint_filename, position)
+        count += len(batch)
+        print_throughput('Replayed', count, time.time() - start)
+    return count
+
+
+def replay_mailfile(filename=mail_file_name, restart=False, verbose=False):
+    """
+    Replay the messages in a mailfile written by poll_imap_email.write_part into the database,
+    resuming from where the last replay of the file stopped unless restart is True.
+    """
+    checkpoint_filename = filename + '.replay'
+    start_offset = 0
+    position = load_replay_checkpoint(checkpoint_filename)
+    if position != None and not restart:
+        start_offset = position[0]
+    mail_file = open(filename, 'rb')
+    messages = (([offset], message_data) for (offset, message_data) in
+                poll_imap_email.iter_mailfile(mail_file, start_offset))
+    count = replay_messages(messages, checkpoint_filename, verbose)
+    mail_file.close()
+    return count
+
+
+def replay_archive(restart=False, verbose=False):
+    """
+    Replay all the messages in the archive at MAILSHARE_ARCHIVE_PATH into the database, resuming
+    from where the last replay stopped unless restart is True.
+    """
+    archive = mail_archive.get_archive()
+    checkpoint_filename = os.path.join(settings.MAILSHARE_ARCHIVE_PATH, 'replay_checkpoint')
+    start_position = (1, 0)
+    position = load_replay_checkpoint(checkpoint_filename)
+    if position != None and not restart:
+        start_position = tuple(position)
+    messages = ((list(position), message_data) for (position, message_data) in
+                archive.iter_messages(start_position))
+    return replay_messages(messages, checkpoint_filename, verbose)
+
+
+def get_regex_tags_for_mails(mail_ids):
+    """
+    Return a list of (mail id, set of tag names) tuples for the mails with the specified ids
+    that match any of MAILSHARE_TAGS_REGEX. Runs in a worker process of apply_all_regex_tags.
+    """
+    result = []
+    mails = Mail.objects.filter(id__in=mail_ids).values_list('id', 'subject', 'body')
+    for (mail_id, subject, body) in mails:
+        tag_names = tags.get_regex_tag_names(subject, body)
+        if len(tag_names) > 0:
+            result.append((mail_id, tag_names))
+    return result
+
+
+def _get_regex_tag_id(tag_name, dry_run):
+    # In a dry run, tags that don't exist yet are not created and have the id None.
+    if not dry_run:
+        return tags.get_or_create_tag(tag_name).id
+    tag_ids = Tag.objects.filter(name=tag_name).values_list('id', flat=True)
+    if len(tag_ids) == 0:
+        return None
+    return tag_ids[0]
+
+
+def apply_all_regex_tags(dry_run=False, workers=None, chunk_size=500):
+    """
+    Apply MAILSHARE_TAGS_REGEX to every mail in the database, for when the expressions have
+    changed. Chunks of chunk_size mails are scanned by a pool of worker processes, by default
+    MAILSHARE_PARSE_WORKERS of them, and the new tags written with one INSERT per chunk.
+    If dry_run is True nothing is written; instead the tags that would be added are reported.
+    """
+    if workers == None:
+        workers = settings.MAILSHARE_PARSE_WORKERS
+    mail_ids = list(Mail.objects.order_by('id').values_list('id', flat=True))
+    chunks = [mail_ids[i:i + chunk_size] for i in range(0, len(mail_ids), chunk_size)]
+    # each worker must open its own database connection
+    connection.close()
+    pool = multiprocessing.Pool(max(1, workers))
+
+    start = time.time()
+    scanned = 0
+    tag_ids_by_name = {}
+    added = 0
+    for results in pool.imap(get_regex_tags_for_mails, chunks):
+        pairs = set()
+        for (mail_id, tag_names) in results:
+            for tag_name in tag_names:
+                tag_name = tag_name.strip().lower()
+                if tag_name not in tag_ids_by_name:
+                    tag_ids_by_name[tag_name] = _get_regex_tag_id(tag_name, dry_run)
+                pairs.add((mail_id, tag_ids_by_name[tag_name], tag_name))
+        if dry_run:
+            existing = bulk_relations.get_existing_relations(Mail, 'tags',
+                [(mail_id, tag_id) for (mail_id, tag_id, tag_name) in pairs if tag_id != None])
+            for (mail_id, tag_id, tag_name) in sorted(pairs):
+                if (mail_id, tag_id) not in existing:
+                    print 'Mail ' + str(mail_id) + ' would add tag ' + tag_name
+                    added += 1
+        else:
+            with transaction.commit_on_success():
+                inserted = bulk_relations.insert_relations(Mail, 'tags',
+                    [(mail_id, tag_id) for (mail_id, tag_id, tag_name) in pairs])
+                rollups.tags_added(inserted)
+                added += len(inserted)
+            if len(inserted) > 0:
+                search_cache.mail_tags_changed()
+        scanned += chunk_size
+        print_throughput('Scanned', min(scanned, len(mail_ids)), time.time() - start)
+    pool.close()
+
+    if dry_run:
+        print str(added) + ' tags would be added to mails'
+    else:
+        print str(added) + ' tags added to mails'
+    return added
 
 
 def poll_emails(verbose=False):
-    mail_file = open(mail_file_name, 'a')
+    archive = mail_archive.get_archive()
+    delay = settings.MAILSHARE_POLL_MIN_INTERVAL
     while True:
         contact_set = set()
-        messages = poll_imap_email.fetch_messages(10, mail_file, True)
-        for message in messages:
+        server = poll_imap_email.get_server_connection()
+        uids = poll_imap_email.search_uids(server, settings.MAILSHARE_IMAP_BATCH_SIZE)
+        new_uids = screen_new_uids(server, uids)
+        if verbose and len(new_uids) < len(uids):
+            print 'Skipping ' + str(len(uids) - len(new_uids)) + ' messages already in the database'
+        messages_data = []
+        fetched_uids = set()
+        for (uid, message_data) in poll_imap_email.iter_fetch_uids(server, new_uids):
+            archive.append(mail_archive.get_message_id(message_data), message_data)
+            messages_data.append(message_data)
+            fetched_uids.add(uid)
+        # duplicates count as processed so they are checkpointed and expunged with the rest,
+        # but only up to the first new message that could not be fetched
+        missing_uids = [uid for uid in new_uids if uid not in fetched_uids]
+        if len(missing_uids) > 0:
+            print 'Failed to fetch messages ' + poll_imap_email.uid_set(missing_uids) + '; will retry'
+        processed_uids = poll_imap_email.get_processed_uids(uids, missing_uids)
+        if len(messages_data) > 0:
+            start = time.time()
+            parsed_messages = parse_messages(messages_data)
+            parsed = time.time()
+            contact_set = store_parsed_messages(parsed_messages, verbose)
             if verbose:
-                print_message_headers(message)
-            contacts = add_message_to_database(message)
-            contact_set |= contacts
-        tag_cloud_cache.update_cached_tag_clouds_by_contacts(contact_set, verbose)
-        time.sleep(10)
+                print_throughput('Parsed', len(parsed_messages), parsed - start)
+                print_throughput('Stored', len(parsed_messages), time.time() - parsed)
+        # only move the checkpoint on and expunge once the batch has been committed, so that
+        # a restart resumes with the first message that was not stored
+        archive.flush()
+        poll_imap_email.mark_processed(processed_uids)
+        if settings.MAILSHARE_IMAP_ENABLE_EXPUNGE:
+            poll_imap_email.delete_uids(server, processed_uids)
+        tag_cloud_cache.update_cached_tag_clouds_by_contact_ids(contact_set, verbose)
+        # new autotags are added to old mails between batches, without holding up new mail
+        jobs_queued = tags.run_autotag_jobs(settings.MAILSHARE_AUTOTAG_JOB_SECONDS)
+        completion.write_rankings(verbose)
+        # a full batch means there is a backlog so carry straight on with the next one; after
+        # a failed fetch wait before trying again
+        if (len(uids) < settings.MAILSHARE_IMAP_BATCH_SIZE or len(missing_uids) > 0) and not jobs_queued:
+            delay = poll_imap_email.wait_for_new_mail(server, delay, len(processed_uids))
 
 if __name__ == '__main__':
     verbose = False
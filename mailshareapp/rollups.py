@@ -0,0 +1,167 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Per-day counts of mails by team and tag and by team and sender, kept up to date as mails are
+added and tagged, so that the index page statistics for any number of days cost one small
+grouped query instead of a pass over every mail in that time.
+
+A mail counts towards a team if the team's address is in its To or Cc list. Every mail also
+counts towards ALL_TEAMS.
+"""
+
+import datetime
+from django.db import connection, transaction
+from django.db.models import Sum
+from operator import itemgetter
+import models
+
+ALL_TEAMS = 0
+
+
+def get_team_ids():
+    """Return the contact ids of the configured teams that have been seen in the database."""
+    # teams looks up the team contacts when it is imported, so it can't be imported while
+    # the models are still being set up.
+    import teams
+    return [team_id for team_id in teams.teams_by_contact_id.keys() if team_id > 0]
+
+
+def _get_mail_teams(mail_ids):
+    # Return a dictionary mapping each mail id to the set of teams it counts towards.
+    mail_teams = dict((mail_id, set([ALL_TEAMS])) for mail_id in mail_ids)
+    team_ids = get_team_ids()
+    if len(team_ids) > 0:
+        for through in [models.Mail.to.through, models.Mail.cc.through]:
+            rows = through.objects.filter(mail__in=mail_ids, contact__in=team_ids).values_list('mail', 'contact')
+            for (mail_id, team_id) in rows:
+                mail_teams[mail_id].add(team_id)
+    return mail_teams
+
+
+def _add_counts(model, field_name, counts):
+    # counts maps (team, related id, day) to the change in the number of mails. Rows are
+    # created as needed and updated in place with one statement for the whole batch.
+    rows = [(team, related_id, day, change) for ((team, related_id, day), change) in counts.iteritems() if change != 0]
+    if len(rows) == 0:
+        return
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    column = qn(model._meta.get_field(field_name).column)
+    cursor = connection.cursor()
+    cursor.executemany(
+        'INSERT INTO ' + table + ' (team, ' + column + ', day, mails) VALUES (%s, %s, %s, %s)' +
+        ' ON DUPLICATE KEY UPDATE mails = mails + VALUES(mails)',
+        rows)
+    if min(row[3] for row in rows) < 0:
+        cursor.execute('DELETE FROM ' + table + ' WHERE mails <= 0')
+    transaction.commit_unless_managed()
+
+
+def _count(mail_ids, tag_pairs, count_senders, change):
+    # Add change to the counts for the (mail id, tag id) pairs and, if count_senders is True,
+    # for the senders of the mails.
+    mail_ids = list(set(mail_ids) | set(mail_id for (mail_id, tag_id) in tag_pairs))
+    if len(mail_ids) == 0:
+        return
+    mail_teams = _get_mail_teams(mail_ids)
+    mail_days = {}
+    sender_counts = {}
+    for (mail_id, sender_id, date) in models.Mail.objects.filter(id__in=mail_ids).values_list('id', 'sender', 'date'):
+        mail_days[mail_id] = date.date()
+        if count_senders:
+            for team in mail_teams[mail_id]:
+                key = (team, sender_id, date.date())
+                sender_counts[key] = sender_counts.get(key, 0) + change
+
+    tag_counts = {}
+    for (mail_id, tag_id) in tag_pairs:
+        if mail_id in mail_days:
+            for team in mail_teams[mail_id]:
+                key = (team, tag_id, mail_days[mail_id])
+                tag_counts[key] = tag_counts.get(key, 0) + change
+
+    _add_counts(models.TeamSenderDayCount, 'sender', sender_counts)
+    _add_counts(models.TeamTagDayCount, 'tag', tag_counts)
+
+
+def _get_tag_pairs(mail_ids):
+    return list(models.Mail.tags.through.objects.filter(mail__in=mail_ids).values_list('mail', 'tag'))
+
+
+def mails_added(mail_ids):
+    """Count newly stored mails, with their senders and tags. Their To and Cc must be stored."""
+    _count(mail_ids, _get_tag_pairs(mail_ids), True, 1)
+
+
+def tags_added(pairs):
+    """Count tags newly added to mails. pairs is a list of (mail id, tag id) tuples."""
+    _count([], pairs, False, 1)
+
+
+def tags_removed(pairs):
+    """Stop counting tags removed from mails. pairs is a list of (mail id, tag id) tuples."""
+    _count([], pairs, False, -1)
+
+
+def mail_tags_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """Keep the counts up to date when tags are added or removed through Django's related managers."""
+    if action == 'pre_clear':
+        if reverse:
+            pairs = instance.mails.through.objects.filter(tag=instance).values_list('mail', 'tag')
+        else:
+            pairs = instance.tags.through.objects.filter(mail=instance).values_list('mail', 'tag')
+        tags_removed(list(pairs))
+    elif action in ['post_add', 'post_remove'] and pk_set:
+        if reverse:
+            pairs = [(mail_id, instance.id) for mail_id in pk_set]
+        else:
+            pairs = [(instance.id, tag_id) for tag_id in pk_set]
+        if action == 'post_add':
+            tags_added(pairs)
+        else:
+            tags_removed(pairs)
+
+
+def mail_deleted(sender, instance, **kwargs):
+    """Stop counting a mail that is about to be deleted, while its relations still exist."""
+    _count([instance.id], _get_tag_pairs([instance.id]), True, -1)
+
+
+def rebuild(chunk_size=1000, verbose=False):
+    """Throw away all the counts and count every mail in the database again."""
+    with transaction.commit_on_success():
+        models.TeamTagDayCount.objects.all().delete()
+        models.TeamSenderDayCount.objects.all().delete()
+        mail_ids = list(models.Mail.objects.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(mail_ids), chunk_size):
+            mails_added(mail_ids[start:start + chunk_size])
+            if verbose:
+                print 'Counted ' + str(min(start + chunk_size, len(mail_ids))) + ' of ' + str(len(mail_ids)) + ' mails'
+
+
+def _get_window(team_id, days):
+    start_date = datetime.date.today() - datetime.timedelta(days)
+    return {'team': team_id, 'day__gte': start_date}
+
+
+def get_tag_histogram(team_id, days):
+    """
+    Return a list of (tag, frequency) tuples, sorted by tag name, counting the team's mails
+    from the last days days, in the same form as facets.Facets.get_tag_histogram.
+    """
+    counts = models.TeamTagDayCount.objects.filter(**_get_window(team_id, days)).values('tag').annotate(
+        frequency=Sum('mails'))
+    frequencies = dict((row['tag'], int(row['frequency'])) for row in counts)
+    tags = models.Tag.objects.in_bulk(frequencies.keys())
+    histogram = [(tag, frequencies[tag_id]) for (tag_id, tag) in tags.items()]
+    histogram.sort(key=lambda entry: entry[0].name)
+    return histogram
+
+
+def get_top_senders(team_id, days, number=5):
+    """Return a list of up to number (contact, mails sent) tuples for the team's mails from the last days days."""
+    counts = models.TeamSenderDayCount.objects.filter(**_get_window(team_id, days)).values('sender').annotate(
+        mails=Sum('mails'))
+    top = sorted(((row['sender'], int(row['mails'])) for row in counts), key=itemgetter(1), reverse=True)[:number]
+    contacts = models.Contact.objects.in_bulk([sender_id for (sender_id, mails) in top])
+    return [(contacts[sender_id], mails) for (sender_id, mails) in top if sender_id in contacts]
@@ -3,19 +3,31 @@
 # License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
 
 import datetime
+from django.db import connection
 from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.http import QueryDict
 from django.utils.http import urlquote
 from django.utils.html import escape
 import models
 import email_utils
 import tags
+import text_index
+import text_scores
+import trigram_index
+import facets
+import settings
 
 
 class _Parameter(object):
     # Represents a type of search parameter. Each type of search parameter can be
     # represented in various ways. This class also helps keep track of the index value so that
     # GET URLs can be constructed with unique parameter names.
+
+    # The rough cost of filtering by this type of parameter. Filters are applied cheapest
+    # first; see Search.get_plan.
+    cost = 50
+
     def __init__(self, value, index, search):
         self.string_value = value
         self.index = index
@@ -52,6 +64,10 @@ class _Parameter(object):
         return html
 
 
+    def get_cost(self):
+        return self.cost
+
+
     def get_hidden_form_html(self):
         html = '<input type="hidden" name="'
         html += self.get_url_parameter_name()
@@ -63,19 +79,51 @@ class _Parameter(object):
 
 class _FullTextParameter(_Parameter):
     parameter_name = 'query'
+    cost = 60
 
     def __init__(self, value, index, search):
         super(_FullTextParameter, self).__init__(value, index, search)
+        self._scores = None
+
+
+    def get_scores(self):
+        """
+        Return a dictionary mapping the ids of matching mails to their relevance, or None if
+        text queries are handled by MySQL.
+        """
+        if self._scores == None and text_index.is_enabled():
+            self._scores = text_index.get_index().search(self.string_value)
+        return self._scores
+
+
+    def get_cost(self):
+        # the search index has already found the matching mails, so they are just joined to
+        if text_index.is_enabled():
+            return 5
+        return self.cost
 
 
     def get_query(self):
+        if text_index.is_enabled():
+            return None
         return Q(subject__search=self.string_value) | Q(body__search=self.string_value)
 
 
+    def filter_query_set(self, query_set):
+        # The mails matching all of the search's text queries are found by joining to their
+        # combined scores, so only the first text query adds the join.
+        if self.search.get_text_parameters()[0] is not self:
+            return query_set
+        return text_scores.join_scores(query_set, self.search.get_text_query_id())
+
+
     def get_html(self):
         html = 'Emails matching text query: <a href="'
         html += get_full_text_search(self.string_value).get_url_path()
         html += '">' + self.string_value + '</a>'
+        if text_index.is_enabled() and self.search.get_order() != _OrderParameter.RELEVANCE:
+            relevance_search = self.search.add_and(get_order_search(_OrderParameter.RELEVANCE))
+            html += ' [<a href="' + relevance_search.get_url_path() + '">sort by relevance</a>]'
         html += ' ' + self.get_remove_html()
         return html
 
@@ -84,15 +132,54 @@ class _FullTextParameter(_Parameter):
         return html
 
 
-class _ExactBodyTextParameter(_Parameter):
-    parameter_name = 'exactbody'
+class _SubstringParameter(_Parameter):
+    # Matches mails whose field_name field matches the text using lookup, such as 'icontains'.
+    # If the trigram index is on only its candidates need to be checked, which is cheap.
+    field_name = None
+    lookup = None
 
     def __init__(self, value, index, search):
-        super(_ExactBodyTextParameter, self).__init__(value, index, search)
+        super(_SubstringParameter, self).__init__(value, index, search)
+        self._candidates = None
+        self._found_candidates = False
+
+
+    def get_candidates(self):
+        """
+        Return the set of ids of the mails that the trigram index says might match, or None if
+        it is off, can't narrow the text down or finds too many to list.
+        """
+        if not self._found_candidates:
+            if trigram_index.is_enabled():
+                self._candidates = trigram_index.get_index().get_candidates(
+                    self.field_name, self.string_value, settings.MAILSHARE_TRIGRAM_CANDIDATE_LIMIT)
+            self._found_candidates = True
+        return self._candidates
+
+
+    def get_cost(self):
+        if self.get_candidates() != None:
+            return 5
+        return self.cost
 
 
     def get_query(self):
-        return Q(body__icontains=self.string_value)
+        q = Q(**{self.field_name + '__' + self.lookup: self.string_value})
+        candidates = self.get_candidates()
+        if candidates != None:
+            q = Q(id__in=list(candidates)) & q
+        return q
+
+
+class _ExactBodyTextParameter(_SubstringParameter):
+    parameter_name = 'exactbody'
+    # a substring match has to read the body of every mail left
+    cost = 80
+    field_name = 'body'
+    lookup = 'icontains'
+
+    def __init__(self, value, index, search):
+        super(_ExactBodyTextParameter, self).__init__(value, index, search)
 
 
     def get_html(self):
@@ -107,8 +194,11 @@ class _ExactBodyTextParameter(_Parameter):
         return html
 
 
-class _ExactSubjectTextParameter(_Parameter):
+class _ExactSubjectTextParameter(_SubstringParameter):
     parameter_name = 'exactsubject'
+    cost = 70
+    field_name = 'subject'
+    lookup = 'icontains'
     html_text = 'Emails with exact text in subject'
 
     def __init__(self, value, index, search):
@@ -116,10 +206,6 @@ class _ExactSubjectTextParameter(_Parameter):
         self.html_search_function = get_exact_subject_text_search
 
 
-    def get_query(self):
-        return Q(subject__icontains=self.string_value)
-
-
     def get_html(self):
         html = self.html_text + ': <a href="'
         html += self.html_search_function(self.string_value).get_url_path()
@@ -134,6 +220,7 @@ class _ExactSubjectTextParameter(_Parameter):
 
 class _SubjectEndsWithParameter(_ExactSubjectTextParameter):
     parameter_name='subjectends'
+    lookup = 'iendswith'
     html_text = 'Emails with subjects ending with'
 
 
@@ -142,13 +229,10 @@ class _SubjectEndsWithParameter(_ExactSubjectTextParameter):
         self.html_search_function = get_subject_ends_with_search
 
 
-    def get_query(self):
-        return Q(subject__iendswith=self.string_value)
-
-
 
 class _TagParameter(_Parameter):
     parameter_name = 'tag_id'
+    cost = 10
 
 
     def __init__(self, value, index, search):
@@ -165,6 +249,8 @@ class _TagParameter(_Parameter):
 
 
     def get_query(self):
+        # a join, since a mail has each tag at most once; MySQL before 5.6 runs an IN
+        # subquery once for every mail
         return Q(tags__id=self.tid)
 
 
@@ -201,10 +287,12 @@ class _TagParameter(_Parameter):
 
 class _NotTagParameter(_TagParameter):
     parameter_name = 'ntag_id'
+    # most mails don't have any one tag, so this rarely narrows the results much
+    cost = 45
 
 
     def get_query(self):
-        return (~Q(tags__id=self.tid))
+        return ~_get_related_mails_query(models.Mail.tags.through, 'tag', self.tid)
 
 
     def get_html(self):
@@ -221,6 +309,7 @@ class _NotTagParameter(_TagParameter):
 
 class _ContactParameter(_Parameter):
     parameter_name = 'contact'
+    cost = 30
 
 
     def __init__(self, value, index, search):
@@ -228,7 +317,8 @@ class _ContactParameter(_Parameter):
         try:
             self.cid = int(value)
         except ValueError:
-            matching_contacts = models.Contact.objects.filter(name__iexact=value)
+            # completions give the address of contacts without a name
+            matching_contacts = models.Contact.objects.filter(Q(name__iexact=value) | Q(address__iexact=value))
             if len(matching_contacts) > 0:
                 self.cid = matching_contacts[0].id
             else:
@@ -257,7 +347,7 @@ class _ContactParameter(_Parameter):
 
 
     def get_query(self):
-        return Q(sender__id=self.cid) | Q(to__id=self.cid) | Q(cc__id=self.cid)
+        return Q(sender__id=self.cid) | _get_recipient_query(self.cid)
 
 
     def get_html(self):
@@ -276,6 +366,7 @@ class _ContactParameter(_Parameter):
 
 class _SenderParameter(_ContactParameter):
     parameter_name = 'sender'
+    cost = 20
 
 
     def get_query(self):
@@ -303,7 +394,7 @@ class _RecipientParameter(_ContactParameter):
 
 
     def get_query(self):
-        return Q(to__id=self.cid) | Q(cc__id=self.cid)
+        return _get_recipient_query(self.cid)
 
 
     def get_html(self):
@@ -324,6 +415,7 @@ class _RecipientParameter(_ContactParameter):
 
 class _MailParameter(_Parameter):
     parameter_name = 'mail_id'
+    cost = 0
 
 
     def __init__(self, value, index, search):
@@ -347,6 +439,7 @@ class _MailParameter(_Parameter):
 
 class _AgeInDaysParameter(_Parameter):
     parameter_name = 'days'
+    cost = 40
 
 
     def __init__(self, value, index, search):
@@ -404,6 +497,58 @@ class _AgeInDaysParameter(_Parameter):
         return html
 
 
+class _OrderParameter(_Parameter):
+    parameter_name = 'order'
+    # this only orders the results, so it goes after all the filters
+    cost = 100
+    RELEVANCE = 'relevance'
+    DATE = 'date'
+
+
+    def get_query(self):
+        return None
+
+
+    def filter_query_set(self, query_set):
+        # Order by relevance using the scores joined by the text queries. Mails are otherwise
+        # ordered by date.
+        if self.string_value != self.RELEVANCE or self.search.get_text_query_id() == None:
+            return query_set
+        return text_scores.order_by_score(query_set)
+
+
+    def get_html(self):
+        html = 'Emails sorted by ' + self.string_value
+        if self.string_value != self.DATE:
+            html += ' [' + self.get_option_link_html(get_order_search(self.DATE), 'date')
+        else:
+            html += ' [date'
+        if self.string_value != self.RELEVANCE:
+            html += '|' + self.get_option_link_html(get_order_search(self.RELEVANCE), 'relevance')
+        else:
+            html += '|relevance'
+        html += ']'
+        html += self.get_remove_html()
+        return html
+
+    def get_title(self):
+        html = 'Sorted by: ' + self.string_value + '; '
+        return html
+
+
+def _get_related_mails_query(through, field_name, related_id):
+    # Return a Q object matching the mails related to related_id by the many-to-many table
+    # through, as a subquery rather than a join so that each mail matches at most once and
+    # the results don't need to be made distinct. MySQL 5.6 or later is needed to run these
+    # efficiently; earlier versions run the subquery once for every mail.
+    return Q(id__in=through.objects.filter(**{field_name: related_id}).values('mail'))
+
+
+def _get_recipient_query(contact_id):
+    return _get_related_mails_query(models.Mail.to.through, 'contact', contact_id) | \
+        _get_related_mails_query(models.Mail.cc.through, 'contact', contact_id)
+
+
 # When parsing a URL, we want to create Parameter objects of different sub-classes
 # depending on the name in the URL.
 _parameters_map = {
@@ -418,9 +563,14 @@ _parameters_map = {
     _RecipientParameter.parameter_name: _RecipientParameter,
     _MailParameter.parameter_name: _MailParameter,
     _AgeInDaysParameter.parameter_name: _AgeInDaysParameter,
+    _OrderParameter.parameter_name: _OrderParameter,
 }
 
 
+# A GET parameter asking for the plan of a search to be shown alongside its results.
+EXPLAIN_PARAMETER = 'explain'
+
+
 def _get_parameter_name_and_index(field_name):
     # In a GET request, all the parameter names must be unique. So we append a hyphen and
     # an index number to the root name. Here we parse out the name and index.
@@ -438,6 +588,9 @@ def _expand_search_parameters(search_parameters):
     result = []
     for (key, value) in search_parameters:
         (name, index) = _get_parameter_name_and_index(key)
+        # the page of results being viewed is not part of the search, and nor is explaining it
+        if name in ResultsPage.page_parameters or name == EXPLAIN_PARAMETER:
+            continue
         # filter out recipient=0 searches which result from selecting "All" teams
         if name != 'recipient' or value != '0':
             result.append((name, index, value))
@@ -488,6 +641,7 @@ class Search:
         self._hidden_form_html = None
         self._url_path = None
         self._parameter = None
+        self._text_query_id = None
 
         # Each Search object manages only one _Parameter object. To AND together several parameters,
         # we recursively link to more Search objects.
@@ -511,29 +665,75 @@ class Search:
             self._and = Search(search_parameters[1:], self.root_search, True)
 
 
-    def _filter_results(self, results):
-        # Apply the filter for our _Parameter object and recursively apply the filter for ANDed parameters.
-        q = None
+    def _get_parameters(self):
+        # Return the _Parameter objects of this search and the searches ANDed with it.
+        parameters = []
         if self._parameter:
-            q = self._parameter.get_query()
-            if q:
-                results = results.filter(q).distinct()
-            else:
-                results = self._parameter.filter_query_set(results)
-
+            parameters.append(self._parameter)
         if self._and:
-            results = self._and._filter_results(results)
-        return results
+            parameters += self._and._get_parameters()
+        return parameters
+
+
+    def get_plan(self):
+        """
+        Return the parameters of this search in the order their filters are applied to the
+        query: the cheapest and most selective first, from a single mail id through tags,
+        contacts and dates to text queries. Parameters of equal cost stay in URL order.
+        """
+        return sorted(self._get_parameters(), key=lambda parameter: parameter.get_cost())
 
 
     def get_query_set(self):
         """Return a Django query set representing the results of this search."""
         if self._query_set == None:
-            self._query_set = self._filter_results(models.Mail.objects.all())
+            results = models.Mail.objects.all()
+            for parameter in self.get_plan():
+                q = parameter.get_query()
+                if q:
+                    results = results.filter(q)
+                else:
+                    results = parameter.filter_query_set(results)
+            self._query_set = results
 
         return self._query_set
 
 
+    def explain(self):
+        """
+        Return a list of lines describing how the results of this search are found: the
+        filters in the order they are applied, the SQL query and MySQL's plan for running it.
+        """
+        lines = []
+        for (number, parameter) in enumerate(self.get_plan()):
+            lines.append(str(number + 1) + '. ' + parameter.parameter_name + '=' + parameter.string_value +
+                         ' (cost ' + str(parameter.get_cost()) + ')')
+        query_set = self.get_query_set()
+        try:
+            (sql, params) = query_set.query.get_compiler(query_set.db).as_sql()
+        except EmptyResultSet:
+            lines.append('No query is needed: the filters cannot match any mails.')
+            return lines
+        lines.append(sql)
+        if len(params) > 0:
+            lines.append('Parameters: ' + ', '.join(repr(param) for param in params))
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        lines.append(' | '.join(column[0] for column in cursor.description))
+        for row in cursor.fetchall():
+            lines.append(' | '.join(str(value) for value in row))
+        return lines
+
+
+    def get_key(self):
+        """
+        Return a key that is the same for every search with the same parameters, whatever
+        their indexes or order in the URL.
+        """
+        return tuple(sorted((parameter.parameter_name, parameter.string_value)
+                            for parameter in self._get_parameters()))
+
+
     def get_html(self):
         """Return HTML representing the parameters of this search."""
         if self._html == None:
@@ -588,6 +788,64 @@ class Search:
         return url_path
 
 
+    def get_order(self):
+        """Return the value of the order parameter of this search, or None if it has none."""
+        if isinstance(self._parameter, _OrderParameter):
+            return self._parameter.string_value
+        if self._and:
+            return self._and.get_order()
+        return None
+
+
+    def get_text_parameters(self):
+        """Return the text query parameters of this search answered by the search index."""
+        if not text_index.is_enabled():
+            return []
+        return [parameter for parameter in self._get_parameters() if isinstance(parameter, _FullTextParameter)]
+
+
+    def get_text_query_id(self):
+        """
+        Return the id of the models.TextQuery holding the combined scores of the mails matching
+        the text queries of this search, or None if there are no text queries or they are
+        handled by MySQL.
+        """
+        if self._text_query_id == None:
+            texts = [parameter.string_value for parameter in self.get_text_parameters()]
+            if len(texts) > 0:
+                self._text_query_id = text_scores.get_query_id(texts, self.get_text_scores)
+        return self._text_query_id
+
+
+    def get_text_scores(self):
+        """
+        Return a dictionary mapping the ids of mails matching the text queries of this search
+        to their total relevance, or None if there are no text queries or they are handled by
+        MySQL.
+        """
+        scores = None
+        if isinstance(self._parameter, _FullTextParameter) and self._parameter.get_scores() != None:
+            scores = dict(self._parameter.get_scores())
+        if self._and:
+            and_scores = self._and.get_text_scores()
+            if scores == None:
+                scores = and_scores
+            elif and_scores != None:
+                scores = dict((mail_id, score + and_scores[mail_id])
+                              for (mail_id, score) in scores.iteritems() if mail_id in and_scores)
+        return scores
+
+
+    def get_tag_ids(self):
+        """Return the set of ids of the tags this search includes or excludes mails by."""
+        tag_ids = set()
+        if isinstance(self._parameter, _TagParameter):
+            tag_ids.add(self._parameter.tid)
+        if self._and:
+            tag_ids |= self._and.get_tag_ids()
+        return tag_ids
+
+
     def get_url_path(self):
         """Return a URL path that links to this search."""
         if self._url_path == None:
@@ -693,6 +951,190 @@ class Search:
         return highest_so_far
 
 
+class ResultsPage(object):
+    """
+    One page of the results of a search, for listing in a table.
+
+    Results are ordered by date, newest first, and then by id. Pages are found by keyset
+    rather than by offset: the page after a key is the mails older than the (date, id) of the
+    last mail on the current page, and the page before is the mails newer than the first, so
+    each page costs the same however far through the results it is. When the search orders
+    results by relevance, the key is instead the position in the results.
+
+    Only the columns shown in the table are loaded, with the sender joined in the same query.
+    Each row is a dictionary with id, date, subject, sender (the address) and sender_name keys.
+    """
+    page_parameters = ['before', 'after']
+    columns = ['id', 'date', 'subject', 'sender__name', 'sender__address']
+
+    def __init__(self, search, size, before=None, after=None):
+        self.search = search
+        self.size = size
+        self.previous_key = None
+        self.next_key = None
+        if search.get_order() == _OrderParameter.RELEVANCE and search.get_text_query_id() != None:
+            self.rows = self._get_ranked_rows(before, after)
+        else:
+            self.rows = self._get_dated_rows(before, after)
+        for row in self.rows:
+            row['sender'] = row.pop('sender__address')
+            row['sender_name'] = row.pop('sender__name')
+
+
+    def _get_ranked_rows(self, before, after):
+        start = 0
+        if after:
+            start = int(after)
+        elif before:
+            start = max(int(before) - self.size, 0)
+        rows = list(self.search.get_query_set().values(*self.columns)[start:start + self.size + 1])
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            self.next_key = str(start + self.size)
+        if start > 0:
+            self.previous_key = str(start)
+        return rows
+
+
+    def _get_dated_rows(self, before, after):
+        query_set = self.search.get_query_set().values(*self.columns)
+        if before:
+            (date, mail_id) = _parse_page_key(before)
+            query_set = query_set.filter(Q(date__gt=date) | Q(date=date, id__gt=mail_id)).order_by('date', 'id')
+        else:
+            if after:
+                (date, mail_id) = _parse_page_key(after)
+                query_set = query_set.filter(Q(date__lt=date) | Q(date=date, id__lt=mail_id))
+            query_set = query_set.order_by('-date', '-id')
+        # fetch one extra row to find out if there is another page
+        rows = list(query_set[:self.size + 1])
+        more = (len(rows) > self.size)
+        rows = rows[:self.size]
+        if before:
+            rows.reverse()
+            if more:
+                self.previous_key = _get_page_key(rows[0])
+            if len(rows) > 0:
+                self.next_key = _get_page_key(rows[-1])
+        else:
+            if more:
+                self.next_key = _get_page_key(rows[-1])
+            if after and len(rows) > 0:
+                self.previous_key = _get_page_key(rows[0])
+        return rows
+
+
+    def _get_url(self, name, key):
+        if key == None:
+            return None
+        url_path = self.search.get_url_path()
+        if not url_path.endswith('?'):
+            url_path += '&'
+        return url_path + name + '=' + urlquote(key)
+
+
+    def get_next_url(self):
+        """Return a URL path for the next page, or None if this is the last page."""
+        return self._get_url('after', self.next_key)
+
+
+    def get_previous_url(self):
+        """Return a URL path for the previous page, or None if this is the first page."""
+        return self._get_url('before', self.previous_key)
+
+
+class SearchResults(object):
+    """
+    The results of a search, so that the page listed, the count and the facets share what has
+    already been fetched and each query is run at most once. A SearchResults can be kept and
+    reused for later requests of the same search; see search_cache.
+
+    When a page holds all of the results it also gives the count and the mail ids. Otherwise
+    the count is worked out by fetching the ids of up to count_limit + 1 matching mails,
+    which costs the same however many mails match, and above count_limit the count is only a
+    lower bound. With no count_limit a COUNT query is used instead.
+    """
+    def __init__(self, search, count_limit=None):
+        self.search = search
+        self.count_limit = count_limit
+        self._count = None
+        # a (list of mail ids, True if they are all of the results) tuple, set in one go so
+        # that requests sharing these results never see one without the other
+        self._mail_ids = None
+        self._facets = None
+
+
+    def get_page(self, size, before=None, after=None):
+        """Return a ResultsPage of the results. Raises ValueError if before or after is mangled."""
+        page = ResultsPage(self.search, size, before, after)
+        # a page before or after a key can come back empty, with no neighbours, e.g. when the
+        # mails around the key have been deleted since
+        if not before and not after and page.previous_key == None and page.next_key == None:
+            self._mail_ids = ([row['id'] for row in page.rows], True)
+        return page
+
+
+    def get_mail_ids(self, limit=None):
+        """
+        Return a list of the ids of up to limit matching mails, or all of them if limit is
+        None, in the order of the results. They are only fetched if the ids already fetched
+        don't cover them.
+        """
+        if self._mail_ids == None or (not self._mail_ids[1] and (limit == None or limit > len(self._mail_ids[0]))):
+            ids = self.search.get_query_set().values_list('id', flat=True)
+            if limit:
+                ids = ids[:limit]
+            ids = list(ids)
+            self._mail_ids = (ids, limit == None or len(ids) < limit)
+        if limit:
+            return self._mail_ids[0][:limit]
+        return self._mail_ids[0]
+
+
+    def _get_count(self):
+        # The count and whether it is exact, as a tuple for the same reason as _mail_ids.
+        if self._count == None:
+            if self._mail_ids != None and self._mail_ids[1]:
+                self._count = (len(self._mail_ids[0]), True)
+            elif self.count_limit:
+                count = len(self.get_mail_ids(self.count_limit + 1))
+                self._count = (min(count, self.count_limit), count <= self.count_limit)
+            else:
+                self._count = (self.search.get_query_set().count(), True)
+        return self._count
+
+
+    def get_count(self):
+        """Return the number of matching mails, or count_limit if there are more than that."""
+        return self._get_count()[0]
+
+
+    def is_count_exact(self):
+        """Return False if there are more matching mails than get_count returns."""
+        return self._get_count()[1]
+
+
+    def get_facets(self, limit=None):
+        """Return a facets.Facets of the most recent limit matching mails, or all of them if limit is None."""
+        if self._facets == None:
+            self._facets = facets.Facets(self.search.get_query_set(), limit)
+        return self._facets
+
+
+    def clear_facets(self):
+        """Forget the facets, so that they are worked out again after the mails' tags have changed."""
+        self._facets = None
+
+
+def _get_page_key(row):
+    return row['date'].strftime('%Y-%m-%dT%H:%M:%S') + '_' + str(row['id'])
+
+
+def _parse_page_key(key):
+    (date, mail_id) = key.split('_')
+    return (datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S'), int(mail_id))
+
+
 def get_full_text_search(query):
     """Return a new Search object representing a full text search for the specified string."""
     return Search([(_FullTextParameter.parameter_name, query)])
@@ -743,6 +1185,11 @@ def get_recipient_id_search(contact_id):
     return Search([(_RecipientParameter.parameter_name, str(contact_id))])
 
 
+def get_order_search(order):
+    """Return a new Search object representing the ordering of search results by order, 'relevance' or 'date'."""
+    return Search([(_OrderParameter.parameter_name, order)])
+
+
 def get_days_search(days):
     """Return new Search object representing a search for emails received in the last days days."""
     return Search([(_AgeInDaysParameter.parameter_name, str(days))])
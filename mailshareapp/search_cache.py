@@ -0,0 +1,104 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+A cache of search results, so that searches run again and again, such as the team searches
+linked from the index page, searches polled by RSS readers and the searches re-parsed from the
+page URL by every ajax call, reuse the ids, count and facets worked out the first time.
+
+Results are keyed by the parameters of the search, ignoring their indexes and order, and by
+the date, since searches for the last few days change at midnight. Each entry remembers the
+generations of the mails and of their tags it was worked out from. When mails are stored or
+deleted every entry is stale. When mails are tagged or untagged, or a tag is renamed or
+deleted, the entries for searches by tag are stale, and the rest only need their facets worked
+out again.
+
+At most MAILSHARE_SEARCH_CACHE_SIZE entries are kept; the least recently used is dropped to
+make room for a new one.
+"""
+
+import datetime
+import threading
+import generation
+import search
+import settings
+
+MAILS_GENERATION = 'mails'
+MAIL_TAGS_GENERATION = 'mail_tags'
+
+
+class _Entry(object):
+    def __init__(self, results, mails_generation, mail_tags_generation):
+        self.results = results
+        self.mails_generation = mails_generation
+        self.mail_tags_generation = mail_tags_generation
+        self.used = 0
+
+
+class SearchCache(object):
+    """A bounded cache of search.SearchResults, dropping the least recently used first."""
+    def __init__(self, size):
+        self.size = size
+        self._entries = {}
+        self._uses = 0
+        self._lock = threading.Lock()
+
+
+    def get_results(self, search_object):
+        """Return the SearchResults for a search, reusing cached results if they are still current."""
+        if self.size <= 0:
+            return search.SearchResults(search_object, settings.MAILSHARE_SEARCH_COUNT_LIMIT)
+        key = (search_object.get_key(), datetime.date.today())
+        mails_generation = generation.get(MAILS_GENERATION)
+        mail_tags_generation = generation.get(MAIL_TAGS_GENERATION)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry != None and entry.mails_generation == mails_generation:
+                if entry.mail_tags_generation != mail_tags_generation:
+                    if len(search_object.get_tag_ids()) > 0:
+                        entry = None
+                    else:
+                        entry.results.clear_facets()
+                        entry.mail_tags_generation = mail_tags_generation
+            else:
+                entry = None
+            if entry == None:
+                results = search.SearchResults(search_object, settings.MAILSHARE_SEARCH_COUNT_LIMIT)
+                entry = _Entry(results, mails_generation, mail_tags_generation)
+                if len(self._entries) >= self.size and key not in self._entries:
+                    oldest_key = min(self._entries, key=lambda entry_key: self._entries[entry_key].used)
+                    del self._entries[oldest_key]
+                self._entries[key] = entry
+            self._uses += 1
+            entry.used = self._uses
+            return entry.results
+
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+_cache = SearchCache(settings.MAILSHARE_SEARCH_CACHE_SIZE)
+
+
+def get_results(search_object):
+    """Return the search.SearchResults for a search from the cache."""
+    return _cache.get_results(search_object)
+
+
+def mails_changed(*args, **kwargs):
+    """Record that mails have been stored or deleted. Also a signal handler."""
+    generation.bump(MAILS_GENERATION)
+
+
+def mail_tags_changed(*args, **kwargs):
+    """Record that mails have been tagged or untagged. Also a signal handler."""
+    # m2m_changed is sent before and after each change; once is enough
+    if kwargs.get('action', 'post_').startswith('post_'):
+        generation.bump(MAIL_TAGS_GENERATION)
+
+
+def tag_saved(sender, instance, created, **kwargs):
+    """Signal handler for a saved tag. A renamed tag changes the facets of every search."""
+    if not created:
+        generation.bump(MAIL_TAGS_GENERATION)
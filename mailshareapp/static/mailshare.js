@@ -172,16 +172,106 @@ function update_multibar(data) {
 }
 
 function fetch_open_mail_tags() {
+    var email_ids = [];
     $('span[id^="taglist_"]').each(function(i) {
-        var email_id = parseInt(this.id.substr(8));
-	Dajaxice.mailshare.mailshareapp.fetch_mail_tags(Dajax.process,{'email_id':email_id, 'url':location.href});
+        email_ids.push(parseInt(this.id.substr(8)));
     });
+    if(email_ids.length > 0) {
+        Dajaxice.mailshare.mailshareapp.fetch_mails_tags(Dajax.process,{'email_ids':email_ids, 'url':location.href});
+    }
+}
+
+function update_mails_tags(data) {
+    for(var email_id in data.tags_html) {
+        $("#taglist_" + email_id).html(data.tags_html[email_id]);
+    }
 }
 
 function update_tag_cloud(data) {
     $(".tag_cloud").html(data.tag_cloud_html);
 }
 
+/* These must match MIN_FONT_SIZE and MAX_FONT_SIZE in tags.py */
+var TAG_CLOUD_MIN_FONT_SIZE = 8;
+var TAG_CLOUD_MAX_FONT_SIZE = 24;
+
+function get_tag_cloud_size(freq, max_freq, min_freq) {
+    /* the same calculation as tags.get_tag_cloud_size */
+    min_freq = min_freq - 0.5;
+    max_freq = max_freq + 0.5;
+    freq -= min_freq;
+    max_freq -= min_freq;
+    var proportion = Math.sqrt(freq) / Math.sqrt(max_freq);
+    var font_size = ((TAG_CLOUD_MAX_FONT_SIZE-TAG_CLOUD_MIN_FONT_SIZE) * proportion) + TAG_CLOUD_MIN_FONT_SIZE;
+    return Math.floor(font_size);
+}
+
+function fetch_tag_cloud() {
+    Dajaxice.mailshare.mailshareapp.fetch_tag_cloud(Dajax.process,{'url':location.href});
+}
+
+function get_tag_cloud_range(spans) {
+    var range = null;
+    spans.each(function(i) {
+        var frequency = parseInt($(this).attr("data-frequency"));
+        if(range == null) {
+            range = {'min':frequency, 'max':frequency};
+        }
+        else {
+            range.min = Math.min(range.min, frequency);
+            range.max = Math.max(range.max, frequency);
+        }
+    });
+    return range;
+}
+
+function update_tag_cloud_delta(data) {
+    /* Adjust the frequency of one tag in the cloud. The other tags only need resizing if
+       the smallest or largest frequency changes, in which case fetch the whole cloud. */
+    var cloud = $(".tag_cloud");
+    var spans = cloud.find("span[data-tag-id]");
+    var span = spans.filter('[data-tag-id="' + data.tag_id + '"]');
+    var others = spans.not(span);
+    var frequency = data.change;
+    if(span.length > 0) {
+        frequency += parseInt(span.attr("data-frequency"));
+    }
+    var old_range = get_tag_cloud_range(spans);
+    var new_range = get_tag_cloud_range(others);
+    if(frequency > 0) {
+        if(new_range == null) {
+            new_range = {'min':frequency, 'max':frequency};
+        }
+        new_range.min = Math.min(new_range.min, frequency);
+        new_range.max = Math.max(new_range.max, frequency);
+    }
+    if(cloud.length == 0 || old_range == null || new_range == null ||
+       old_range.min != new_range.min || old_range.max != new_range.max) {
+        fetch_tag_cloud();
+        return;
+    }
+    if(frequency <= 0) {
+        span.remove();
+        return;
+    }
+    if(span.length == 0) {
+        /* keep the cloud sorted by tag name */
+        span = $('<span data-tag-id="' + data.tag_id + '">' + data.tag_html + ' </span>');
+        var name = span.find("a").text();
+        var next = others.filter(function(i) { return $(this).find("a").text() > name; }).first();
+        if(next.length > 0) {
+            next.before(span);
+        }
+        else {
+            cloud.append(span);
+        }
+    }
+    var size = get_tag_cloud_size(frequency, new_range.max, new_range.min);
+    span.attr("data-frequency", frequency);
+    span.css({'font-size':size + 'px', 'padding':Math.floor(size/4) + 'px'});
+    span.attr("title", frequency + " occurrence" + (frequency != 1 ? "s" : ""));
+}
+
 function checkbox_clicked(checkbox, mail_id) {
     if(checkbox.checked) {
 	select_email(mail_id);
@@ -5,20 +5,22 @@ import people
 import search
 import os
 import teams
+import rollups
 
 def _get_tag_cloud_html(team_id):
-    team_search = search.get_team_search(team_id, 7)
-    team_emails = team_search.get_query_set()
-    month_search = search.get_team_search(team_id, 30)
+    if int(team_id) == rollups.ALL_TEAMS:
+        month_search = search.get_days_search(30)
+    else:
+        month_search = search.get_team_search(team_id, 30)
     tag_cloud_html = '<div id="tag_cloud" class="tag_cloud">'
-    tag_cloud_html += tags.search_results_to_tag_cloud_html(team_emails, month_search)
+    tag_cloud_html += tags.tags_histogram_to_tag_cloud_html(rollups.get_tag_histogram(team_id, 7), month_search)
     tag_cloud_html += '</div>'
 
     # it's untidy to put top senders code in the tag cloud cache like this, but it gets us
     # going for now.
     # TODO - tidy this up; possibly just search and replace "tag_cloud" with "index_page_stats" in this file.
     tag_cloud_html += '<p>Top senders in the last week:</p>'
-    tag_cloud_html += people.search_results_to_top_senders_html(team_emails, month_search)
+    tag_cloud_html += people.top_senders_to_html(rollups.get_top_senders(team_id, 7), month_search)
 
     return tag_cloud_html
 
@@ -54,14 +56,14 @@ def update_cached_tag_cloud(team_id):
     return html
 
 
-def update_cached_tag_clouds_by_contacts(contacts, verbose=False):
-    """Update all the caches affected by the specified set of contacts."""
+def update_cached_tag_clouds_by_contact_ids(contact_ids, verbose=False):
+    """Update all the caches affected by the specified set of contact ids."""
     at_least_one_team_updated = False
-    for contact in contacts:
-        if contact.id in teams.teams_by_contact_id:
+    for contact_id in contact_ids:
+        if contact_id in teams.teams_by_contact_id:
             if verbose:
-                print "Updating tag cloud cache for team " + teams.teams_by_contact_id[contact.id].name
-            update_cached_tag_cloud(contact.id)
+                print "Updating tag cloud cache for team " + teams.teams_by_contact_id[contact_id].name
+            update_cached_tag_cloud(contact_id)
             at_least_one_team_updated = True
 
     if at_least_one_team_updated:
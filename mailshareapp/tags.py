@@ -2,9 +2,18 @@
 
 import re
 import math
-from django.db.models import Q
+import time
+import datetime
+import traceback
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F, Count
 import models
 import search
+import autotag_matcher
+import bulk_relations
+import facets
+import rollups
+import search_cache
 import settings
 
 def get_or_create_tag(tag_name):
@@ -22,21 +31,9 @@ def get_or_create_tag(tag_name):
     return tag
 
 
-def add_tag_by_name(m, tag_name):
-    """Add the named tag to the specified email."""
-    m.tags.add(get_or_create_tag(tag_name))
-
-
-def add_autotags_to_mail(m):
-    """Search the mail for each autotag and add it if found"""
-    tags = models.Tag.objects.filter(auto=True)
-    mail_as_queryset = models.Mail.objects.filter(id=m.id)
-    for t in tags:
-        matches = mail_as_queryset.filter(
-            Q(subject__search=t.name) |
-            Q(body__search=t.name))
-        if len(matches) > 0:
-            m.tags.add(t)
+def get_autotag_ids(m):
+    """Search the mail for each autotag and return the set of ids of those found."""
+    return autotag_matcher.matcher.match(m.subject, m.body)
 
 
 user_tags_expression = r'tags?:\s*([,;\-\.\w ]*)'
@@ -46,63 +43,236 @@ html_entity = re.compile(r'&\w*;')
 tag_split_expression = r'([\-\.\w ]+)[,;]'
 tag_split_compiled = re.compile(tag_split_expression)
 
-def add_usertags_to_mail(m):
-    body = m.body
+def get_usertag_names(body, content_type):
+    """Return a list of the tag names typed by the user after "tags:" in an email body."""
     # strip html tags from HTML emails before parsing out Mailshare tags
-    if m.content_type.find('html') != -1:
+    if content_type.find('html') != -1:
         body = re.sub(outlook_linefeed, '', body)
         body = re.sub(html_entity, '', body)
+    tag_names = []
     taglists = re.findall(user_tags_compiled, body)
     for taglist in taglists:
         tags = re.split(tag_split_compiled, taglist)
         for tag in tags:
             tag = tag.strip()
             if len(tag) <= models.Tag.MAX_TAG_NAME_LENGTH and len(tag) > 0:
-                add_tag_by_name(m, tag)
+                tag_names.append(tag)
+    return tag_names
 
 
+html_tag = re.compile(r'<[^>]*?>')
+
 regex_tags_compiled = []
 for regex_tag in settings.MAILSHARE_TAGS_REGEX:
     regex_tag_compiled = re.compile(regex_tag, re.IGNORECASE)
     regex_tags_compiled.append(regex_tag_compiled)
 
 
-def add_regex_tags_to_mail(m, test=False):
-    global regex_tags_compiled
+# expressions that can't be renumbered into a combined expression: backreferences, named
+# groups and inline flags, which apply to the whole expression
+_uncombinable = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?[iLmsux]')
+
+# (patterns, combined expression, group holding each expression's tag) for regex_tags_compiled
+_combined_regex_tags = (None, None, None)
+
+
+def _combine_regex_tags(regexes):
+    # Combine the expressions into one that finditer tries once at each position of the text,
+    # with a lookahead per expression so that tags matched by different expressions can
+    # overlap. The leading alternation lets the regular expression engine skip positions where
+    # none of them match. Return (None, None) if the expressions can't be combined.
+    for regex in regexes:
+        if _uncombinable.search(regex.pattern):
+            return (None, None)
+    group = sum(regex.groups for regex in regexes)
+    parts = ['(?=' + '|'.join('(?:' + regex.pattern + ')' for regex in regexes) + ')']
+    tag_groups = []
+    for regex in regexes:
+        group += 1
+        # as with findall, the tag is the first group if the expression has any
+        tag_groups.append(group + min(regex.groups, 1))
+        parts.append('(?:(?=(' + regex.pattern + ')))?')
+        group += regex.groups
+    return (re.compile(''.join(parts), re.IGNORECASE), tag_groups)
+
+
+def _get_combined_regex_tags():
+    global _combined_regex_tags
+    patterns = [regex.pattern for regex in regex_tags_compiled]
+    if _combined_regex_tags[0] != patterns:
+        _combined_regex_tags = (patterns,) + _combine_regex_tags(regex_tags_compiled)
+    return _combined_regex_tags[1:]
+
+
+def _find_regex_tags(text, combined, tag_groups, tags_to_add):
+    # Each expression's matches don't overlap each other, as with findall, so a match is
+    # skipped if it starts before the end of the last one used for the same expression.
+    ends = [0] * len(tag_groups)
+    for match in combined.finditer(text):
+        for (i, group) in enumerate(tag_groups):
+            start = match.start(group)
+            if start >= ends[i]:
+                ends[i] = match.end(group)
+                if ends[i] > start:
+                    tags_to_add.add(match.group(group))
+
+
+def get_regex_tag_names(subject, body):
+    """Return the set of strings in the subject or body matching any MAILSHARE_TAGS_REGEX."""
+    if len(regex_tags_compiled) == 0:
+        return set()
     # this regular expression is from django.utils.html.strip_tags but we need to replace tags
     # with spaces to avoid running strings together in, e.g. '<p>one</p><p>two</p>'.
-    body = re.sub(r'<[^>]*?>', ' ', m.body)
+    body = html_tag.sub(' ', body)
     tags_to_add = set()
+    (combined, tag_groups) = _get_combined_regex_tags()
+    if combined != None:
+        _find_regex_tags(subject, combined, tag_groups, tags_to_add)
+        _find_regex_tags(body, combined, tag_groups, tags_to_add)
+        return tags_to_add
     for regex in regex_tags_compiled:
-        regex_matches = re.findall(regex, m.subject)
-        regex_matches += re.findall(regex, body)
-        for match in regex_matches:
-            tags_to_add.add(match)
-        if test and len(tags_to_add) > 0:
-            print 'Mail ' + str(m.id) + ' would add tag ' + str(tags_to_add)
-        else:
-            for tag in tags_to_add:
-                add_tag_by_name(m, tag)
-
-
-def add_tags_to_mail(m):
-    """Add tags to a mailshareapp.models.Mail object. This includes tags that appear in
-    the email subject or body that have their auto attribute set, and tags added by
-    the user by typing "tags:" in an email."""
-    add_autotags_to_mail(m)
-    add_usertags_to_mail(m)
-    add_regex_tags_to_mail(m)
-
-
-def apply_autotag(tag):
-    """For a new tag, find all the emails that contain it and add it to them."""
+        for match in regex.findall(subject) + regex.findall(body):
+            if isinstance(match, tuple):
+                match = match[0]
+            if match:
+                tags_to_add.add(match)
+    return tags_to_add
+
+
+def get_text_tag_names(subject, body, content_type):
+    """
+    Return the set of tag names that can be worked out from the text of an email alone,
+    without the database: tags typed by the user and tags matching MAILSHARE_TAGS_REGEX.
+    """
+    tag_names = set(get_usertag_names(body, content_type))
+    tag_names |= get_regex_tag_names(subject, body)
+    return tag_names
+
+
+def get_tag_ids_for_mail(m, text_tag_names=None):
+    """Return the set of ids of the tags for the saved mail: autotags that appear in the
+    subject or body, tags typed by the user after "tags:" and tags matching
+    MAILSHARE_TAGS_REGEX. Creates any tags that don't exist yet.
+
+    text_tag_names: the result of get_text_tag_names for the mail, if already known."""
+    tag_ids = get_autotag_ids(m)
+    if text_tag_names == None:
+        text_tag_names = get_text_tag_names(m.subject, m.body, m.content_type)
+    for tag in text_tag_names:
+        tag_ids.add(get_or_create_tag(tag).id)
+    return tag_ids
+
+
+def add_tag_to_mails(tag, mail_ids):
+    """
+    Add the tag to all the mails with the specified ids in one transaction, using a single
+    INSERT. Returns the number of mails that did not already have the tag.
+    """
+    with transaction.commit_on_success():
+        mail_ids = models.Mail.objects.filter(id__in=list(mail_ids)).values_list('id', flat=True)
+        added = bulk_relations.insert_relations(models.Mail, 'tags', [(mail_id, tag.id) for mail_id in mail_ids])
+        rollups.tags_added(added)
+    if len(added) > 0:
+        search_cache.mail_tags_changed()
+    return len(added)
+
+
+def remove_tag_from_mails(tag, mail_ids):
+    """
+    Remove the tag from all the mails with the specified ids in one transaction, using a
+    single DELETE. Returns the number of mails that had the tag.
+    """
+    with transaction.commit_on_success():
+        removed = bulk_relations.delete_relations(models.Mail, 'tags', [(mail_id, tag.id) for mail_id in mail_ids])
+        rollups.tags_removed(removed)
+    if len(removed) > 0:
+        search_cache.mail_tags_changed()
+    return len(removed)
+
+
+def tag_saved(tag):
+    """Called when a tag is saved."""
+    autotag_matcher.matcher.tag_changed(tag.id, tag.name, tag.auto)
+    queue_autotag(tag)
+
+
+def tag_deleted(sender, **kwargs):
+    """Called by the post_delete signal when a tag is deleted."""
+    autotag_matcher.matcher.tag_deleted(kwargs['instance'].id)
+
+
+def queue_autotag(tag):
+    """
+    For a new or changed autotag, queue a job to add it to all the existing emails that contain
+    it. The job is run in the background by run_autotag_jobs.
+    """
     if not tag.auto:
         return
-    mails_with_tag = models.Mail.objects.filter(
-        Q(subject__search=tag.name) |
-        Q(body__search=tag.name))
-    for m in mails_with_tag:
-        m.tags.add(tag)
+    # a new job supersedes any queued for an older version of the tag
+    models.AutotagJob.objects.filter(tag=tag, state=models.AutotagJob.QUEUED).update(
+        state=models.AutotagJob.CANCELLED)
+    models.AutotagJob.objects.create(tag=tag)
+
+
+def run_autotag_job_chunk(job, chunk_size):
+    """
+    Add the job's tag to those of the next chunk_size emails, after those already done, that
+    contain it. Emails are matched by autotag_matcher, as new emails are when they are stored.
+    Returns False when the job is finished.
+    """
+    mails = list(models.Mail.objects.filter(id__gt=job.last_mail_id).order_by('id').values_list(
+        'id', 'subject', 'body')[:chunk_size])
+    mail_ids = [mail_id for (mail_id, subject, body) in mails
+                if autotag_matcher.matches(job.tag.name, subject, body)]
+    state = models.AutotagJob.QUEUED
+    if len(mails) < chunk_size:
+        state = models.AutotagJob.DONE
+    last_mail_id = job.last_mail_id
+    if len(mails) > 0:
+        last_mail_id = mails[-1][0]
+    with transaction.commit_on_success():
+        added = bulk_relations.insert_relations(models.Mail, 'tags', [(mail_id, job.tag_id) for mail_id in mail_ids])
+        rollups.tags_added(added)
+        # update rather than save so as not to undo the job being cancelled meanwhile
+        models.AutotagJob.objects.filter(id=job.id, state=models.AutotagJob.QUEUED).update(
+            state=state, last_mail_id=last_mail_id, mails_tagged=F('mails_tagged') + len(added),
+            updated=datetime.datetime.now())
+    if len(added) > 0:
+        search_cache.mail_tags_changed()
+    return state == models.AutotagJob.QUEUED
+
+
+def _fail_autotag_job(job):
+    # Mark a job whose chunk raised a database error as failed, so that it doesn't hold up
+    # the jobs queued after it. Saving the tag again queues a new job.
+    print 'Autotag job ' + str(job.id) + ' for tag ' + job.tag.name + ' failed'
+    traceback.print_exc()
+    # the error may have been the connection being lost
+    connection.close()
+    try:
+        models.AutotagJob.objects.filter(id=job.id).update(
+            state=models.AutotagJob.FAILED, updated=datetime.datetime.now())
+    except DatabaseError:
+        traceback.print_exc()
+
+
+def run_autotag_jobs(max_seconds, chunk_size=500):
+    """
+    Run queued autotag jobs, oldest first, a chunk at a time until they are all done or
+    max_seconds have passed. Jobs are reloaded before each chunk so that cancelling one takes
+    effect straight away. A job that raises a database error is marked failed and the rest
+    carry on. Returns True if there is still work queued.
+    """
+    start = time.time()
+    while time.time() - start < max_seconds:
+        jobs = models.AutotagJob.objects.filter(state=models.AutotagJob.QUEUED).order_by('id')[:1]
+        if len(jobs) == 0:
+            return False
+        try:
+            run_autotag_job_chunk(jobs[0], chunk_size)
+        except DatabaseError:
+            _fail_autotag_job(jobs[0])
+    return models.AutotagJob.objects.filter(state=models.AutotagJob.QUEUED).exists()
 
 
 def tag_to_html(t, s=None):
@@ -131,17 +301,28 @@ def undo_delete_html(mail_id, t):
     return result
 
 
+def tags_to_html_list(mail_id, tags, search_object):
+    """Render a list of a mail's tags as HTML, with delete links."""
+    tags_html_list = []
+    for t in tags:
+        tags_html_list.append(tag_to_html(t, search_object) + tag_to_delete_html(mail_id, t))
+    return ', '.join(tags_html_list)
+
+
 def mail_tags_to_html_list(m, search_object):
-    result = ''
-    tags = m.tags.all()
-    if len(tags) > 0:
-        result += tag_to_html(tags[0], search_object)
-        result += tag_to_delete_html(m.id, tags[0])
-    for t in tags[1:]:
-        result += ', '
-        result += tag_to_html(t, search_object)
-        result += tag_to_delete_html(m.id, t)
-    return result
+    return tags_to_html_list(m.id, m.tags.all(), search_object)
+
+
+def mails_tags_to_html_lists(mail_ids, search_object):
+    """
+    Return a dictionary mapping each of the mail ids to the HTML list of the mail's tags, as
+    rendered by mail_tags_to_html_list, fetching the tags of all the mails with one query.
+    """
+    mail_tags = dict((mail_id, []) for mail_id in mail_ids)
+    relations = models.Mail.tags.through.objects.filter(mail__in=mail_ids).select_related('tag').order_by('tag__name')
+    for relation in relations:
+        mail_tags[relation.mail_id].append(relation.tag)
+    return dict((mail_id, tags_to_html_list(mail_id, tags, search_object)) for (mail_id, tags) in mail_tags.items())
 
 
 def add_tag_button_html(mail_id):
@@ -168,28 +349,16 @@ def mail_tags_multibar_html(search_object, mail_ids, tags_only=False):
     result = ''
     if not tags_only:
         result += '<span id="multi_bar_tag_list">'
-    all_tags = set([])
-    common_tags = set([])
-    first_mail = True
-    for mail_id in mail_ids:
-        try:
-            m = models.Mail.objects.get(id=mail_id)
-        except:
-            pass
-        else:
-            mail_tags = set(m.tags.all())
-            all_tags = all_tags | mail_tags
-            if first_mail:
-                common_tags = mail_tags
-                first_mail = False
-            else:
-                common_tags = common_tags & mail_tags
+    # count how many of the selected mails have each tag with one grouped query
+    mail_count = models.Mail.objects.filter(id__in=mail_ids).count()
+    all_tags = models.Tag.objects.filter(mails__id__in=mail_ids).annotate(selected_mails=Count('mails'))
+    common_tags = set(tag.id for tag in all_tags if tag.selected_mails == mail_count)
 
     tags_list = sorted(all_tags, key=lambda t: t.name)
     tags_html_list = []
     for tag in tags_list:
         tag_html = ''
-        common_tag = (tag in common_tags)
+        common_tag = (tag.id in common_tags)
         if not common_tag:
             tag_html += '<span class="not_common_tag">'
         tag_html += tag_to_html(tag, search_object)
@@ -207,17 +376,7 @@ def mail_tags_multibar_html(search_object, mail_ids, tags_only=False):
 
 def build_tags_histogram(queryset):
     """Given a queryset containing Mail objects, return a sorted list of (tag, frequency) tuples."""
-    tags_dict = {}
-    for mail in queryset:
-        tags = mail.tags.all()
-        for tag in tags:
-            if tag in tags_dict:
-                tags_dict[tag] += 1
-            else:
-                tags_dict[tag] = 1
-    tags_list = tags_dict.items()
-    tags_histogram = sorted(tags_list, key=lambda entry: entry[0].name)
-    return tags_histogram
+    return facets.Facets(queryset).get_tag_histogram()
 
 
 def search_results_to_tag_list_html(queryset):
@@ -230,6 +389,7 @@ def search_results_to_tag_list_html(queryset):
     return result
 
 
+# mailshare.js resizes tag clouds using the same sizes
 MIN_FONT_SIZE = 8
 MAX_FONT_SIZE = 24
 
@@ -244,10 +404,9 @@ def get_tag_cloud_size(freq, max_freq, min_freq):
     return int(font_size)
 
 
-def search_results_to_tag_cloud_html(queryset, search=None):
-    """Given a queryset containing Mail objects, return a tag cloud rendered in HTML"""
+def tags_histogram_to_tag_cloud_html(h, search=None):
+    """Given a list of (tag, frequency) tuples, return a tag cloud rendered in HTML"""
     result = ''
-    h = build_tags_histogram(queryset)
     if len(h) > 0:
         min_freq = min(h, key=lambda entry: entry[1])[1]
         max_freq = max(h, key=lambda entry: entry[1])[1]
@@ -256,9 +415,15 @@ def search_results_to_tag_cloud_html(queryset, search=None):
             font_size = str(size)
             padding = str(size/4)
             result += '<span style="font-size: ' + font_size + 'px; padding: ' + padding + 'px;"'
+            result += ' data-tag-id="' + str(tag.id) + '" data-frequency="' + str(frequency) + '"'
             result += ' title="' + str(frequency) + ' occurrence'
             if frequency != 1:
                 result += 's'
             result += '">' + tag_to_html(tag, search) + ' '
             result += '</span>'
     return result
+
+
+def search_results_to_tag_cloud_html(queryset, search=None):
+    """Given a queryset containing Mail objects, return a tag cloud rendered in HTML"""
+    return tags_histogram_to_tag_cloud_html(build_tags_histogram(queryset), search)
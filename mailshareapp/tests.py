@@ -5,7 +5,28 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import imaplib
+import re
+import select
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
 from django.test import TestCase
+import autotag_matcher
+import completion
+import contact_cache
+import facets
+import models
+import poll_imap_email
+import search_cache
+import tags
+import text_index
+import text_scores
+import trigram_index
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +42,415 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class _FakeIMAPHandler(SocketServer.StreamRequestHandler):
+    # Speaks just enough IMAP for imaplib to log in, select a mailbox and IDLE. If the
+    # server's new_mail_delay is not None, '* 1 EXISTS' is sent that many seconds into IDLE. If
+    # its keepalive_interval is not None, '* OK' is sent that often until IDLE is ended.
+    def handle(self):
+        self.wfile.write('* OK [CAPABILITY IMAP4rev1 IDLE] fake server ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if line == '':
+                break
+            words = line.split()
+            tag = words[0]
+            command = words[1].upper()
+            if command == 'CAPABILITY':
+                self.wfile.write('* CAPABILITY IMAP4rev1 IDLE\r\n')
+                self.wfile.write(tag + ' OK CAPABILITY completed\r\n')
+            elif command == 'LOGIN':
+                self.wfile.write(tag + ' OK LOGIN completed\r\n')
+            elif command == 'SELECT':
+                self.wfile.write('* 0 EXISTS\r\n* OK [UIDVALIDITY 42] UIDs valid\r\n')
+                self.wfile.write(tag + ' OK [READ-WRITE] SELECT completed\r\n')
+            elif command == 'IDLE':
+                if self.server.new_mail_delay == 0:
+                    # both lines in one packet, so the second is buffered with the first
+                    self.wfile.write('+ idling\r\n* 1 EXISTS\r\n')
+                else:
+                    self.wfile.write('+ idling\r\n')
+                if self.server.new_mail_delay:
+                    time.sleep(self.server.new_mail_delay)
+                    self.wfile.write('* 1 EXISTS\r\n')
+                if self.server.keepalive_interval != None:
+                    while len(select.select([self.request], [], [], self.server.keepalive_interval)[0]) == 0:
+                        self.wfile.write('* OK still here\r\n')
+                self.rfile.readline()
+                self.wfile.write(tag + ' OK IDLE terminated\r\n')
+            elif command == 'NOOP':
+                # as a server might send with the response to a STORE or EXPUNGE
+                self.wfile.write('* 2 EXISTS\r\n* 1 RECENT\r\n')
+                self.wfile.write(tag + ' OK NOOP completed\r\n')
+            elif command == 'LOGOUT':
+                self.wfile.write('* BYE logging out\r\n')
+                self.wfile.write(tag + ' OK LOGOUT completed\r\n')
+                break
+            else:
+                self.wfile.write(tag + ' BAD unknown command\r\n')
+
+
+class IdleTest(TestCase):
+    def start_server(self, new_mail_delay, keepalive_interval=None):
+        fake_server = SocketServer.TCPServer(('127.0.0.1', 0), _FakeIMAPHandler)
+        fake_server.new_mail_delay = new_mail_delay
+        fake_server.keepalive_interval = keepalive_interval
+        thread = threading.Thread(target=fake_server.handle_request)
+        thread.daemon = True
+        thread.start()
+        server = imaplib.IMAP4('127.0.0.1', fake_server.server_address[1])
+        server.login('user', 'password')
+        server.select('INBOX')
+        # as get_server_connection does
+        poll_imap_email._pop_new_mail_responses(server)
+        return server
+
+    def test_idle_wakes_on_exists(self):
+        server = self.start_server(0.1)
+        self.failUnless(poll_imap_email.supports_idle(server))
+        start = time.time()
+        self.failUnless(poll_imap_email.idle(server, 10))
+        self.failUnless(time.time() - start < 5)
+        server.logout()
+
+    def test_idle_sees_buffered_exists(self):
+        server = self.start_server(0)
+        start = time.time()
+        self.failUnless(poll_imap_email.idle(server, 10))
+        self.failUnless(time.time() - start < 5)
+        server.logout()
+
+    def test_idle_times_out(self):
+        server = self.start_server(None)
+        self.failIf(poll_imap_email.idle(server, 0.2))
+        server.logout()
+
+    def test_idle_sees_pending_exists(self):
+        server = self.start_server(None)
+        server.noop()
+        start = time.time()
+        self.failUnless(poll_imap_email.idle(server, 10))
+        self.failUnless(time.time() - start < 5)
+        # the pending responses are only reported once
+        self.failIf(poll_imap_email.idle(server, 0.2))
+        server.logout()
+
+    def test_idle_keepalives_do_not_extend_timeout(self):
+        server = self.start_server(None, 0.05)
+        start = time.time()
+        self.failIf(poll_imap_email.idle(server, 0.3))
+        self.failUnless(time.time() - start < 2)
+        server.logout()
+
+
+class FetchTest(TestCase):
+    def test_uid_set(self):
+        self.failUnlessEqual(poll_imap_email.uid_set(['1', '2', '3', '5', '7', '8']), '1:3,5,7:8')
+
+    def test_uid_before_literal(self):
+        message_data = [('1 (UID 7 RFC822 {5}', 'hello'), ')', ('2 (UID 9 RFC822 {3}', 'bye'), ')']
+        self.failUnlessEqual(list(poll_imap_email._iter_fetch_parts(message_data)),
+                             [('7', 'hello'), ('9', 'bye')])
+
+    def test_uid_after_literal(self):
+        message_data = [('1 (RFC822 {5}', 'hello'), ' UID 7)', ('2 (FLAGS (\\Seen) RFC822 {3}', 'bye'),
+                        ' FLAGS (\\Seen) UID 9)']
+        self.failUnlessEqual(list(poll_imap_email._iter_fetch_parts(message_data)),
+                             [('7', 'hello'), ('9', 'bye')])
+
+    def test_missing_uid_skipped(self):
+        message_data = [('1 (RFC822 {5}', 'hello'), ')', ('2 (UID 9 RFC822 {3}', 'bye')]
+        self.failUnlessEqual(list(poll_imap_email._iter_fetch_uid_parts(message_data)), [('9', 'bye')])
+
+    def test_failed_fetch_not_processed(self):
+        class FailingServer(object):
+            def uid(self, command, *args):
+                raise imaplib.IMAP4.abort('connection lost')
+        # 5 and 9 are already in the database; 7 is new but can't be fetched
+        uids = ['5', '7', '9']
+        new_uids = ['7']
+        fetched_uids = [uid for (uid, data) in poll_imap_email.iter_fetch_uids(FailingServer(), new_uids)]
+        self.failUnlessEqual(fetched_uids, [])
+        missing_uids = [uid for uid in new_uids if uid not in fetched_uids]
+        self.failUnlessEqual(poll_imap_email.get_processed_uids(uids, missing_uids), ['5'])
+        self.failUnlessEqual(poll_imap_email.get_processed_uids(uids, []), uids)
+
+
+class AutotagMatcherTest(TestCase):
+    def test_words(self):
+        self.failUnlessEqual(autotag_matcher.get_words("Can't stop the ROCK-n-roll at 3am"),
+                             set(["can't", 'stop', 'the', 'rock', 'roll', '3am']))
+
+    def test_match(self):
+        matcher = autotag_matcher.AutotagMatcher()
+        matcher.refresh()
+        matcher.add(1, 'release')
+        matcher.add(2, 'build server')
+        self.failUnlessEqual(matcher.match('Release notes', ''), set([1]))
+        self.failUnlessEqual(matcher.match('', 'the server is down'), set([2]))
+        self.failUnlessEqual(matcher.match('releases', 'rebuild'), set())
+        matcher.remove(2)
+        self.failUnlessEqual(matcher.match('the server is down'), set())
+        matcher.add(1, 'deploy')
+        self.failUnlessEqual(matcher.match('release and deploy'), set([1]))
+
+    def test_matches(self):
+        self.failUnless(autotag_matcher.matches('build server', 'subject', 'the build is broken'))
+        self.failIf(autotag_matcher.matches('build server', 'subject', 'rebuilding'))
+
+
+class TextIndexTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = text_index.SearchIndex(self.path)
+        self.index.add([
+            (1, 'quick fox', 'the quick brown fox jumps over the lazy dog'),
+            (2, 'fox fox fox', 'a fox'),
+            (3, 'dogs', 'the lazy dog sleeps all day long while the brown fox waits and waits'),
+            (4, 'nothing', 'nothing to see here'),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_more_matches_rank_higher(self):
+        scores = self.index.search('fox')
+        self.failUnlessEqual(set(scores.keys()), set([1, 2, 3]))
+        self.failUnless(scores[2] > scores[1] > scores[3])
+
+    def test_rare_words_count_more(self):
+        scores = self.index.search('quick fox')
+        self.failUnless(scores[1] > scores[2])
+
+    def test_phrase(self):
+        self.failUnlessEqual(set(self.index.search('"lazy dog"').keys()), set([1, 3]))
+        self.failUnlessEqual(set(self.index.search('"dog lazy"').keys()), set())
+        # a phrase doesn't run on from the subject into the body
+        self.failUnlessEqual(set(self.index.search('"fox a"').keys()), set())
+
+    def test_operators(self):
+        self.failUnlessEqual(set(self.index.search('+fox -lazy').keys()), set([2]))
+        self.failUnlessEqual(set(self.index.search('+brown +fox').keys()), set([1, 3]))
+        self.failUnlessEqual(set(self.index.search('sleep*').keys()), set([3]))
+
+    def test_delete_and_merge(self):
+        self.index.add([(5, 'fox', 'another fox')])
+        self.index.delete([2])
+        self.failUnlessEqual(set(self.index.search('fox').keys()), set([1, 3, 5]))
+        self.index.merge()
+        self.failUnlessEqual(len(self.index._load_manifest()['segments']), 1)
+        self.failUnlessEqual(set(self.index.search('fox').keys()), set([1, 3, 5]))
+        self.failUnlessEqual(self.index.get_deleted(), set())
+
+    def test_merge_tiers(self):
+        # stop add merging as it goes, so that the configured factor doesn't matter
+        merge_factor = text_index.settings.MAILSHARE_SEARCH_MERGE_FACTOR
+        text_index.settings.MAILSHARE_SEARCH_MERGE_FACTOR = 100
+        try:
+            for mail_id in range(10, 19):
+                self.index.add([(mail_id, 'fox', '')])
+        finally:
+            text_index.settings.MAILSHARE_SEARCH_MERGE_FACTOR = merge_factor
+        self.index.merge_tiers(4)
+        sizes = sorted(mail_count for (name, mail_count, total_length) in self.index._load_manifest()['segments'])
+        self.failUnlessEqual(sizes, [1, 4, 4, 4])
+        self.failUnlessEqual(len(self.index.search('fox')), 12)
+
+
+class TrigramIndexTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = trigram_index.TrigramIndex(self.path)
+        self.index.add([(1, u'Caf\xe9 menu', 'Lunch is served at noon'),
+                        (2, 'Lunch', 'no menu today'),
+                        (3, 'Meeting', 'see you at the cafe')])
+        self.index.add([(4, u'Re: Caf\xe9', 'dinner is served')])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_candidates(self):
+        self.failUnlessEqual(self.index.get_candidates('subject', 'cafe', 100), set([1, 4]))
+        self.failUnlessEqual(self.index.get_candidates('body', u'CAF\xc9', 100), set([3]))
+        self.failUnlessEqual(self.index.get_candidates('body', 'is served', 100), set([1, 4]))
+        self.failUnlessEqual(self.index.get_candidates('subject', 'supper', 100), set())
+
+    def test_too_short_or_too_many(self):
+        self.failUnlessEqual(self.index.get_candidates('body', 'at', 100), None)
+        self.failUnlessEqual(self.index.get_candidates('body', 'is served', 1), None)
+
+    def test_deleted(self):
+        self.index.delete([1])
+        self.failUnlessEqual(self.index.get_candidates('body', 'is served', 100), set([4]))
+
+
+class RegexTagsTest(TestCase):
+    def setUp(self):
+        self.regex_tags_compiled = tags.regex_tags_compiled
+        tags.regex_tags_compiled = [re.compile(r'\bbug ?\d+', re.IGNORECASE),
+                                    re.compile(r'\b(\d{4,})\b', re.IGNORECASE)]
+
+    def tearDown(self):
+        tags.regex_tags_compiled = self.regex_tags_compiled
+
+    def test_overlapping_matches(self):
+        self.failUnlessEqual(tags.get_regex_tag_names('Fix for bug 12345', ''), set(['bug 12345', '12345']))
+
+    def test_html_is_stripped(self):
+        self.failUnlessEqual(tags.get_regex_tag_names('', '<p>bug</p><p>99</p>'), set())
+        self.failUnlessEqual(tags.get_regex_tag_names('', '<b>BUG 7</b>'), set(['BUG 7']))
+
+    def test_matches_of_one_expression_do_not_overlap(self):
+        tags.regex_tags_compiled = [re.compile(r'\d{3}'), re.compile(r'[a-z]+(\d)')]
+        self.failUnlessEqual(tags.get_regex_tag_names('1234567 ab9 x8', ''), set(['123', '456', '9', '8']))
+
+    def test_backreference(self):
+        # expressions that can't be combined are run one at a time
+        tags.regex_tags_compiled.append(re.compile(r'\b(\w)\1\b'))
+        self.failUnlessEqual(tags.get_regex_tag_names('bug 12345 in zz', ''), set(['bug 12345', '12345', 'z']))
+
+
+class ContactCacheTest(TestCase):
+    def setUp(self):
+        self.size = contact_cache.settings.MAILSHARE_CONTACT_CACHE_SIZE
+        contact_cache.settings.MAILSHARE_CONTACT_CACHE_SIZE = 2
+        contact_cache.clear()
+
+    def tearDown(self):
+        contact_cache.settings.MAILSHARE_CONTACT_CACHE_SIZE = self.size
+        contact_cache.clear()
+
+    def test_least_recently_used_dropped(self):
+        contact_cache._remember('a@example.com', 1)
+        contact_cache._remember('b@example.com', 2)
+        self.failUnlessEqual(contact_cache._recall('a@example.com'), 1)
+        contact_cache._remember('c@example.com', 3)
+        self.failUnlessEqual(contact_cache._recall('b@example.com'), None)
+        self.failUnlessEqual(contact_cache._recall('a@example.com'), 1)
+        self.failUnlessEqual(contact_cache._recall('c@example.com'), 3)
+
+
+class _FakeSearch(object):
+    def __init__(self, key):
+        self.key = key
+
+    def get_key(self):
+        return self.key
+
+    def get_tag_ids(self):
+        return set()
+
+
+class SearchCacheTest(TestCase):
+    def test_results_reused(self):
+        cache = search_cache.SearchCache(2)
+        results = cache.get_results(_FakeSearch('a'))
+        self.failUnless(cache.get_results(_FakeSearch('a')) is results)
+
+    def test_least_recently_used_dropped(self):
+        cache = search_cache.SearchCache(2)
+        a = cache.get_results(_FakeSearch('a'))
+        b = cache.get_results(_FakeSearch('b'))
+        cache.get_results(_FakeSearch('a'))
+        cache.get_results(_FakeSearch('c'))
+        self.failUnless(cache.get_results(_FakeSearch('a')) is a)
+        self.failIf(cache.get_results(_FakeSearch('b')) is b)
+
+    def test_disabled(self):
+        cache = search_cache.SearchCache(0)
+        self.failIf(cache.get_results(_FakeSearch('a')) is cache.get_results(_FakeSearch('a')))
+
+
+class CompletionTest(TestCase):
+    def setUp(self):
+        self.index = completion.CompletionIndex()
+        self.index.add(1, 'release', ['release'])
+        self.index.add(2, 'Rob Fisher', ['Rob Fisher', 'rob@example.com'])
+        self.index.add(3, 'prerelease', ['prerelease'])
+
+    def test_lookup(self):
+        self.failUnlessEqual(self.index.lookup('leas', 10), ['release', 'prerelease'])
+        self.failUnlessEqual(self.index.lookup('EXAMPLE', 10), ['Rob Fisher'])
+        self.failUnlessEqual(self.index.lookup('leas', 1), ['release'])
+        self.failUnlessEqual(self.index.lookup('xyz', 10), [])
+
+    def test_single_character_is_a_prefix(self):
+        self.failUnlessEqual(self.index.lookup('r', 10), ['release', 'Rob Fisher'])
+
+    def test_remove(self):
+        self.index.remove(1)
+        self.failUnlessEqual(self.index.lookup('leas', 10), ['prerelease'])
+
+    def test_contact_without_name(self):
+        model_completion = completion.ModelCompletion('contacts', None, ['name', 'address'], None)
+        index = completion.CompletionIndex()
+        model_completion._add_rows(index, [(5, '', 'nobody@example.com'), (4, 'Somebody', 'some@example.com')])
+        self.failUnlessEqual(index.lookup('body', 10), ['nobody@example.com', 'Somebody'])
+        self.failUnlessEqual(model_completion._max_id, 5)
+
+
+class FacetsTest(TestCase):
+    def setUp(self):
+        sender = models.Contact.objects.create(name='Sender', address='sender@example.com')
+        for (day, hour) in [(1, 9), (1, 17), (2, 12), (3, 8), (3, 20)]:
+            models.Mail.objects.create(sender=sender, subject='day ' + str(day),
+                                       date=datetime.datetime(2012, 5, day, hour))
+
+    def test_day_histogram(self):
+        histogram = facets.Facets(models.Mail.objects.all()).get_day_histogram()
+        self.failUnlessEqual(histogram, [(datetime.date(2012, 5, 1), 2), (datetime.date(2012, 5, 2), 1),
+                                         (datetime.date(2012, 5, 3), 2)])
+
+    def test_day_histogram_limit(self):
+        # only the most recent mails are counted
+        histogram = facets.Facets(models.Mail.objects.all(), limit=3).get_day_histogram()
+        self.failUnlessEqual(histogram, [(datetime.date(2012, 5, 2), 1), (datetime.date(2012, 5, 3), 2)])
+
+    def test_day_histogram_empty(self):
+        self.failUnlessEqual(facets.Facets(models.Mail.objects.none()).get_day_histogram(), [])
+
+
+class _FakeIndex(object):
+    def __init__(self):
+        self.version = 1
+
+    def get_version(self):
+        return self.version
+
+
+class TextScoresTest(TestCase):
+    def setUp(self):
+        self.get_index = text_index.get_index
+        self.index = _FakeIndex()
+        text_index.get_index = lambda: self.index
+        self.scores = {1: 1.0, 2: 2.0}
+        self.calls = 0
+
+    def tearDown(self):
+        text_index.get_index = self.get_index
+
+    def get_scores(self):
+        self.calls += 1
+        return dict(self.scores)
+
+    def get_stored_scores(self, query_id):
+        return dict(models.TextQueryScore.objects.filter(query=query_id).values_list('mail_id', 'score'))
+
+    def test_new_mails_are_added(self):
+        query_id = text_scores.get_query_id(['build'], self.get_scores)
+        self.failUnlessEqual(text_scores.get_query_id(['build'], self.get_scores), query_id)
+        self.failUnlessEqual(self.calls, 1)
+        # a new batch is indexed; the scores already stored are kept as they are
+        self.index.version = 2
+        self.scores = {1: 1.5, 2: 2.5, 3: 3.0}
+        self.failUnlessEqual(text_scores.get_query_id(['build'], self.get_scores), query_id)
+        self.failUnlessEqual(self.get_stored_scores(query_id), {1: 1.0, 2: 2.0, 3: 3.0})
+
+    def test_old_scores_are_stored_again(self):
+        query_id = text_scores.get_query_id(['build'], self.get_scores)
+        models.TextQuery.objects.filter(id=query_id).update(
+            created=datetime.datetime.now() - text_scores.MAX_AGE - datetime.timedelta(minutes=1))
+        self.index.version = 2
+        self.scores = {2: 2.5, 3: 3.0}
+        self.failUnlessEqual(text_scores.get_query_id(['build'], self.get_scores), query_id)
+        self.failUnlessEqual(self.get_stored_scores(query_id), {2: 2.5, 3: 3.0})
@@ -0,0 +1,582 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+An inverted index over the subject and body of every mail, used for text queries in place of
+the MySQL FULLTEXT index when MAILSHARE_SEARCH_BACKEND is 'index'. Results are ranked with
+BM25 and queries can contain phrases.
+
+The index is a directory of segments. Each segment is a dbm file mapping each word to its
+postings: a list of (mail id, mail length, positions of the word in the mail) tuples,
+marshalled. New mails are written as a new segment after each batch is stored. Segments are
+merged in tiers: whenever MAILSHARE_SEARCH_MERGE_FACTOR segments are of about the same size
+they are merged into one, so each mail is only rewritten a few times however big the index
+grows. A manifest lists the current segments and is replaced atomically, so readers never see
+a half written index; a reader that finds a segment merged away under it reloads the manifest
+and starts again. Only the mail poller, or a rebuild, should add mails.
+
+Mails deleted from the database are appended to a file of deleted ids and dropped from the
+index when their segment is next merged, after which they are removed from the file.
+
+Queries follow the MySQL boolean mode syntax the FULLTEXT backend uses: words are optional
+unless marked with +, words marked with - exclude mails, "quoted words" match a phrase and
+a trailing * matches any word starting with the text before it.
+"""
+
+import anydbm
+import bisect
+import fcntl
+import glob
+import marshal
+import math
+import os
+import re
+from django.db import transaction
+import models
+import settings
+
+MANIFEST_NAME = 'manifest'
+DELETED_NAME = 'deleted'
+SEGMENT_PREFIX = 'segment_'
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# how many times a reader retries when segments are merged away while it reads them
+READ_ATTEMPTS = 3
+
+# errors from opening or reading a segment whose files have been deleted
+_segment_errors = anydbm.error + (IOError,)
+
+_word = re.compile(r'\w+', re.UNICODE)
+_query_clause = re.compile(r'([+-]?)"([^"]*)"|([+-]?)(\S+)')
+
+
+def get_words(text):
+    """Return the list of lower case words in the text, in order."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _word.findall(text.lower())
+
+
+def get_mail_words(subject, body):
+    """
+    Return the list of words indexed for a mail. Position len(subject words) is left empty so
+    that phrases can't match across the end of the subject and the start of the body.
+    """
+    return get_words(subject) + [None] + get_words(body)
+
+
+class _Clause(object):
+    # One part of a query: a word, a word prefix or a phrase, which the mails must, may or
+    # must not contain.
+    REQUIRED = '+'
+    EXCLUDED = '-'
+    OPTIONAL = ''
+
+    def __init__(self, operator, words, prefix=False):
+        self.operator = operator
+        self.words = words
+        self.prefix = prefix
+
+
+def parse_query(query):
+    """Return a list of _Clause objects for the text query."""
+    clauses = []
+    for match in _query_clause.finditer(query):
+        if match.group(2) != None:
+            (operator, text, prefix) = (match.group(1), match.group(2), False)
+        else:
+            (operator, text) = (match.group(3), match.group(4))
+            prefix = text.endswith('*')
+        words = get_words(text)
+        if len(words) > 0:
+            # a prefix only applies to a single word, as in MySQL
+            clauses.append(_Clause(operator, words, prefix and len(words) == 1))
+    return clauses
+
+
+# Prefix of the keys holding the number of postings of each term, in indexes that store them.
+# Words never contain it.
+COUNT_PREFIX = '#'
+
+
+def _put_postings(segment, word, postings, store_counts):
+    key = word.encode('utf-8')
+    segment[key] = marshal.dumps(postings)
+    if store_counts:
+        segment[COUNT_PREFIX + key] = str(len(postings))
+
+
+def _write_segment(path, postings, store_counts):
+    # postings maps words to lists of postings
+    segment = anydbm.open(path, 'n')
+    for (word, word_postings) in postings.iteritems():
+        word_postings.sort()
+        _put_postings(segment, word, word_postings, store_counts)
+    segment.close()
+
+
+class _Segment(object):
+    def __init__(self, path):
+        self._db = anydbm.open(path, 'r')
+        self._words = None
+
+
+    def close(self):
+        self._db.close()
+
+
+    def get_postings(self, word):
+        key = word.encode('utf-8')
+        if not self._db.has_key(key):
+            return []
+        return marshal.loads(self._db[key])
+
+
+    def get_count(self, word):
+        # the number of postings of the word, if the index stores counts
+        key = COUNT_PREFIX + word.encode('utf-8')
+        if not self._db.has_key(key):
+            return 0
+        return int(self._db[key])
+
+
+    def get_words(self):
+        # all the words in the segment, sorted; only needed for prefix queries and merging
+        if self._words == None:
+            self._words = sorted(key.decode('utf-8') for key in self._db.keys()
+                                 if not key.startswith(COUNT_PREFIX))
+        return self._words
+
+
+    def get_words_with_prefix(self, prefix):
+        words = self.get_words()
+        result = []
+        i = bisect.bisect_left(words, prefix)
+        while i < len(words) and words[i].startswith(prefix):
+            result.append(words[i])
+            i += 1
+        return result
+
+
+class SearchIndex(object):
+    """
+    An inverted index stored in the directory path. Subclasses can index other terms by
+    overriding the methods that make and read postings.
+    """
+
+    # whether segments also store the number of postings of each word
+    store_counts = False
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._manifest = None
+        self._manifest_version = None
+        self._segments = {}
+        self._deleted = set()
+        self._deleted_version = None
+
+
+    def _get_filename(self, name):
+        return os.path.join(self.path, name)
+
+
+    def _load_manifest(self):
+        # Reload the manifest if another process has replaced it, closing segments that have
+        # been merged away.
+        filename = self._get_filename(MANIFEST_NAME)
+        try:
+            stat = os.stat(filename)
+            version = (stat.st_mtime, stat.st_ino)
+        except OSError:
+            version = None
+        if self._manifest == None or version != self._manifest_version:
+            manifest = {'segments': [], 'next_segment': 1}
+            if version != None:
+                manifest_file = open(filename, 'rb')
+                manifest = marshal.load(manifest_file)
+                manifest_file.close()
+            names = set(name for (name, mail_count, total_length) in manifest['segments'])
+            for name in self._segments.keys():
+                if name not in names:
+                    self._segments.pop(name).close()
+            self._manifest = manifest
+            self._manifest_version = version
+        return self._manifest
+
+
+    def get_version(self):
+        """Return a number that changes whenever mails are added to the index or merged."""
+        return self._load_manifest()['next_segment']
+
+
+    def _save_manifest(self, manifest):
+        filename = self._get_filename(MANIFEST_NAME)
+        temp_filename = filename + '_tmp'
+        temp_file = open(temp_filename, 'wb')
+        marshal.dump(manifest, temp_file)
+        temp_file.close()
+        os.rename(temp_filename, filename)
+        self._manifest = None
+
+
+    def _get_segment(self, name):
+        if name not in self._segments:
+            self._segments[name] = _Segment(self._get_filename(name))
+        return self._segments[name]
+
+
+    def _read(self, read_segments, *args):
+        """
+        Return read_segments(manifest, segments, *args) for the current manifest and its
+        segments. A merge by another process can delete segments after the manifest listing
+        them was loaded, so if reading a segment fails the manifest is reloaded and
+        read_segments is called again.
+        """
+        for attempt in range(READ_ATTEMPTS):
+            manifest = self._load_manifest()
+            try:
+                segments = [self._get_segment(name) for (name, mail_count, total_length) in manifest['segments']]
+                return read_segments(manifest, segments, *args)
+            except _segment_errors:
+                if attempt == READ_ATTEMPTS - 1:
+                    raise
+                for name in self._segments.keys():
+                    self._segments.pop(name).close()
+                self._manifest = None
+
+
+    def _delete_segment_files(self, name):
+        if name in self._segments:
+            self._segments.pop(name).close()
+        # some dbm modules use more than one file
+        for filename in glob.glob(self._get_filename(name) + '*'):
+            os.remove(filename)
+
+
+    def _open_deleted(self, mode, lock):
+        # Open the file of deleted ids locked, since the web server appends to it while the
+        # poller prunes it. Closing the file releases the lock.
+        deleted_file = open(self._get_filename(DELETED_NAME), mode)
+        fcntl.flock(deleted_file, lock)
+        return deleted_file
+
+
+    def get_deleted(self):
+        """Return the set of ids of mails that have been deleted from the index."""
+        filename = self._get_filename(DELETED_NAME)
+        try:
+            stat = os.stat(filename)
+            version = (stat.st_size, stat.st_mtime, stat.st_ino)
+        except OSError:
+            version = None
+        if version != self._deleted_version:
+            self._deleted = set()
+            if version != None:
+                deleted_file = self._open_deleted('r', fcntl.LOCK_SH)
+                self._deleted = set(int(line) for line in deleted_file if line.strip() != '')
+                deleted_file.close()
+            self._deleted_version = version
+        return self._deleted
+
+
+    def delete(self, mail_ids):
+        """Remove mails from the index."""
+        if len(mail_ids) == 0:
+            return
+        deleted_file = self._open_deleted('a', fcntl.LOCK_EX)
+        deleted_file.write(''.join(str(mail_id) + '\n' for mail_id in mail_ids))
+        deleted_file.close()
+
+
+    def _prune_deleted(self, mail_ids):
+        # Forget deleted mails that a merge has dropped from the index.
+        if len(mail_ids) == 0:
+            return
+        deleted_file = self._open_deleted('a+', fcntl.LOCK_EX)
+        deleted_file.seek(0)
+        deleted = [line for line in deleted_file if line.strip() != '' and int(line) not in mail_ids]
+        deleted_file.seek(0)
+        deleted_file.truncate()
+        deleted_file.write(''.join(deleted))
+        deleted_file.close()
+
+
+    def _get_postings(self, mail_id, subject, body):
+        # Return a dictionary mapping each word in a mail to its posting, a (mail id, mail
+        # length, positions of the word) tuple, and the mail's length.
+        words = get_mail_words(subject, body)
+        positions = {}
+        for (position, word) in enumerate(words):
+            if word != None:
+                positions.setdefault(word, []).append(position)
+        postings = dict((word, (mail_id, len(words), word_positions))
+                        for (word, word_positions) in positions.iteritems())
+        return (postings, len(words))
+
+
+    def _get_posting_mail(self, posting):
+        return posting[0]
+
+
+    def _get_posting_length(self, posting):
+        return posting[1]
+
+
+    def add(self, mails):
+        """Index a list of (mail id, subject, body) tuples as a new segment."""
+        if len(mails) == 0:
+            return
+        postings = {}
+        total_length = 0
+        for (mail_id, subject, body) in mails:
+            (mail_postings, length) = self._get_postings(mail_id, subject, body)
+            for (word, posting) in mail_postings.iteritems():
+                postings.setdefault(word, []).append(posting)
+            total_length += length
+
+        manifest = self._load_manifest()
+        name = SEGMENT_PREFIX + '%06d' % manifest['next_segment']
+        _write_segment(self._get_filename(name), postings, self.store_counts)
+        manifest['segments'].append((name, len(mails), total_length))
+        manifest['next_segment'] += 1
+        self._save_manifest(manifest)
+        self.merge_tiers(settings.MAILSHARE_SEARCH_MERGE_FACTOR)
+
+
+    def merge_tiers(self, factor):
+        """
+        Merge segments of about the same size: segments are put in tiers by the power of
+        factor their number of mails is nearest below, and whenever a tier holds factor
+        segments they are merged into one segment of the next tier up.
+        """
+        factor = max(factor, 2)
+        while True:
+            tiers = {}
+            for (name, mail_count, total_length) in self._load_manifest()['segments']:
+                tier = 0
+                while mail_count >= factor:
+                    mail_count /= factor
+                    tier += 1
+                tiers.setdefault(tier, []).append(name)
+            full_tiers = [names for (tier, names) in sorted(tiers.items()) if len(names) >= factor]
+            if len(full_tiers) == 0:
+                return
+            self._merge_segments(full_tiers[0][:factor])
+
+
+    def merge(self, max_segments=1):
+        """
+        Merge the smallest segments together until there are at most max_segments, dropping
+        deleted mails from them.
+        """
+        manifest = self._load_manifest()
+        if len(manifest['segments']) <= max(max_segments, 1):
+            return
+        by_size = sorted(manifest['segments'], key=lambda segment: segment[1])
+        merging = by_size[:len(by_size) - max(max_segments, 1) + 1]
+        self._merge_segments([name for (name, mail_count, total_length) in merging])
+
+
+    def _merge_segments(self, names):
+        # Merge the named segments into a new one, leaving out deleted mails, which can then
+        # be forgotten since each mail is only ever in one segment.
+        manifest = self._load_manifest()
+        segments = [self._get_segment(name) for name in names]
+        deleted = self.get_deleted()
+        dropped = set()
+
+        words = set()
+        for segment in segments:
+            words.update(segment.get_words())
+        mail_lengths = {}
+        new_name = SEGMENT_PREFIX + '%06d' % manifest['next_segment']
+        new_segment = anydbm.open(self._get_filename(new_name), 'n')
+        for word in words:
+            postings = []
+            for segment in segments:
+                for posting in segment.get_postings(word):
+                    if self._get_posting_mail(posting) in deleted:
+                        dropped.add(self._get_posting_mail(posting))
+                    else:
+                        postings.append(posting)
+            if len(postings) > 0:
+                postings.sort()
+                _put_postings(new_segment, word, postings, self.store_counts)
+                for posting in postings:
+                    mail_lengths[self._get_posting_mail(posting)] = self._get_posting_length(posting)
+        new_segment.close()
+
+        manifest['segments'] = [segment for segment in manifest['segments'] if segment[0] not in names]
+        manifest['segments'].append((new_name, len(mail_lengths), sum(mail_lengths.values())))
+        manifest['next_segment'] += 1
+        self._save_manifest(manifest)
+        for name in names:
+            self._delete_segment_files(name)
+        self._prune_deleted(dropped)
+
+
+    def clear(self):
+        """Remove every mail from the index."""
+        manifest = self._load_manifest()
+        names = [name for (name, mail_count, total_length) in manifest['segments']]
+        self._save_manifest({'segments': [], 'next_segment': manifest['next_segment']})
+        for name in names:
+            self._delete_segment_files(name)
+        deleted_filename = self._get_filename(DELETED_NAME)
+        if os.path.exists(deleted_filename):
+            os.remove(deleted_filename)
+
+
+    def _get_matches(self, clause, segments, deleted):
+        # Return a dictionary mapping the id of each mail matching the clause to a
+        # (mail length, number of matches) tuple.
+        matches = {}
+        for segment in segments:
+            if clause.prefix:
+                words = segment.get_words_with_prefix(clause.words[0])
+                for word in words:
+                    for (mail_id, length, positions) in segment.get_postings(word):
+                        (length, count) = matches.get(mail_id, (length, 0))
+                        matches[mail_id] = (length, count + len(positions))
+            elif len(clause.words) == 1:
+                for (mail_id, length, positions) in segment.get_postings(clause.words[0]):
+                    matches[mail_id] = (length, len(positions))
+            else:
+                # a phrase matches where each word follows the one before
+                mail_positions = None
+                for (offset, word) in enumerate(clause.words):
+                    word_positions = {}
+                    for (mail_id, length, positions) in segment.get_postings(word):
+                        if mail_positions == None or mail_id in mail_positions:
+                            word_positions[mail_id] = (length, set(position - offset for position in positions))
+                    if mail_positions == None:
+                        mail_positions = word_positions
+                    else:
+                        for mail_id in mail_positions.keys():
+                            if mail_id in word_positions:
+                                mail_positions[mail_id] = (mail_positions[mail_id][0],
+                                    mail_positions[mail_id][1] & word_positions[mail_id][1])
+                            else:
+                                del mail_positions[mail_id]
+                    if len(mail_positions) == 0:
+                        break
+                for (mail_id, (length, starts)) in mail_positions.iteritems():
+                    if len(starts) > 0:
+                        matches[mail_id] = (length, len(starts))
+        for mail_id in deleted.intersection(matches.keys()):
+            del matches[mail_id]
+        return matches
+
+
+    def search(self, query):
+        """
+        Return a dictionary mapping the id of each mail matching the text query to its BM25
+        relevance score.
+        """
+        return self._read(self._search, parse_query(query))
+
+
+    def _search(self, manifest, segments, clauses):
+        deleted = self.get_deleted()
+        mail_count = max(sum(segment[1] for segment in manifest['segments']) - len(deleted), 1)
+        average_length = max(float(sum(segment[2] for segment in manifest['segments'])) / mail_count, 1.0)
+
+        scores = None
+        optional_scores = {}
+        excluded = set()
+        for clause in clauses:
+            matches = self._get_matches(clause, segments, deleted)
+            if clause.operator == _Clause.EXCLUDED:
+                excluded.update(matches.keys())
+                continue
+            idf = math.log(1.0 + (mail_count - len(matches) + 0.5) / (len(matches) + 0.5))
+            clause_scores = {}
+            for (mail_id, (length, count)) in matches.iteritems():
+                clause_scores[mail_id] = idf * count * (K1 + 1) / (count + K1 * (1 - B + B * length / average_length))
+            if clause.operator == _Clause.REQUIRED:
+                if scores == None:
+                    scores = clause_scores
+                else:
+                    scores = dict((mail_id, score + clause_scores[mail_id])
+                                  for (mail_id, score) in scores.iteritems() if mail_id in clause_scores)
+            else:
+                for (mail_id, score) in clause_scores.iteritems():
+                    optional_scores[mail_id] = optional_scores.get(mail_id, 0) + score
+
+        # as in MySQL, optional words only affect the ranking once a word is required
+        if scores == None:
+            scores = optional_scores
+        else:
+            for mail_id in scores:
+                scores[mail_id] += optional_scores.get(mail_id, 0)
+        for mail_id in excluded:
+            scores.pop(mail_id, None)
+        return scores
+
+
+_index = None
+
+def get_index():
+    """Return the SearchIndex at MAILSHARE_SEARCH_INDEX_PATH, opening it if needed."""
+    global _index
+    if _index == None:
+        _index = SearchIndex(settings.MAILSHARE_SEARCH_INDEX_PATH)
+    return _index
+
+
+def is_enabled():
+    return settings.MAILSHARE_SEARCH_BACKEND == 'index'
+
+
+# mails stored in the current transaction, indexed once it is committed
+_pending = []
+
+def add_mails(mails):
+    """
+    Index newly stored Mail objects. Inside a transaction they are indexed by write_pending
+    once it has been committed, so that rolled back mails are never indexed.
+    """
+    if not is_enabled():
+        return
+    _pending.extend((m.id, m.subject, m.body) for m in mails)
+    if not transaction.is_managed():
+        write_pending()
+
+
+def write_pending():
+    """Index the mails stored by a transaction that has been committed."""
+    if len(_pending) > 0:
+        get_index().add(_pending)
+        del _pending[:]
+
+
+def discard_pending():
+    """Forget the mails stored by a transaction that has been rolled back."""
+    del _pending[:]
+
+
+def mail_deleted(sender, instance, **kwargs):
+    """Remove a deleted mail from the index."""
+    if is_enabled():
+        get_index().delete([instance.id])
+
+
+def add_all_mails(index, chunk_size=1000, verbose=False):
+    """Throw away everything in a SearchIndex and add every mail in the database to it."""
+    index.clear()
+    mail_ids = list(models.Mail.objects.order_by('id').values_list('id', flat=True))
+    for start in range(0, len(mail_ids), chunk_size):
+        chunk = mail_ids[start:start + chunk_size]
+        index.add(list(models.Mail.objects.filter(id__in=chunk).values_list('id', 'subject', 'body')))
+        if verbose:
+            print 'Indexed ' + str(start + len(chunk)) + ' of ' + str(len(mail_ids)) + ' mails'
+    index.merge()
+
+
+def rebuild(chunk_size=1000, verbose=False):
+    """Throw the index away and index every mail in the database again."""
+    add_all_mails(get_index(), chunk_size, verbose)
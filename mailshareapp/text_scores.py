@@ -0,0 +1,145 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Stores the scores of the mails matching text queries answered by Mailshare's search index in
+the TextQueryScore table, so that a search joins to them in the database rather than sending
+MySQL the id of every matching mail, and can be ordered by relevance with an index.
+
+Scores are stored once for each set of text queries. When mails have been added to the index
+since, only the scores of the new mails are added to them, so a poller indexing a batch at a
+time doesn't make the next search rewrite every score. The scores of the older mails are then
+slightly out of date, since the weight of each word depends on the whole index, so once they
+are MAX_AGE old all the scores are stored again. Scores not brought up to date within MAX_AGE
+are removed.
+"""
+
+import datetime
+import hashlib
+from django.db import connection, transaction, IntegrityError
+import models
+import text_index
+
+# how long scores are topped up with new mails before being stored again from scratch, and
+# how long scores for an old version of the index are kept for searches still using them
+MAX_AGE = datetime.timedelta(hours=1)
+
+# rows inserted per INSERT
+CHUNK_SIZE = 1000
+
+
+def _get_key(texts):
+    return hashlib.sha1(repr(sorted(texts))).hexdigest()
+
+
+def _find_query(key):
+    queries = list(models.TextQuery.objects.filter(key=key))
+    if len(queries) == 0:
+        return None
+    return queries[0]
+
+
+def _get_last_mail_id(scores, last_mail_id=0):
+    # Mails are indexed in the order they are stored, so mails added to the index later have
+    # higher ids than any scored so far.
+    return max(scores.keys() + [last_mail_id])
+
+
+def _insert_scores(query_id, scores):
+    qn = connection.ops.quote_name
+    rows = [(query_id, mail_id, score) for (mail_id, score) in scores.iteritems()]
+    cursor = connection.cursor()
+    for start in range(0, len(rows), CHUNK_SIZE):
+        cursor.executemany(
+            'INSERT INTO ' + qn(models.TextQueryScore._meta.db_table) +
+            ' (' + qn('query_id') + ', ' + qn('mail_id') + ', ' + qn('score') + ') VALUES (%s, %s, %s)',
+            rows[start:start + CHUNK_SIZE])
+
+
+def _delete_scores(query_ids, delete_queries=False):
+    # Django would load every score to delete them, so they are deleted with SQL.
+    qn = connection.ops.quote_name
+    placeholders = ', '.join(['%s'] * len(query_ids))
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM ' + qn(models.TextQueryScore._meta.db_table) +
+                   ' WHERE ' + qn('query_id') + ' IN (' + placeholders + ')', query_ids)
+    if delete_queries:
+        cursor.execute('DELETE FROM ' + qn(models.TextQuery._meta.db_table) +
+                       ' WHERE ' + qn('id') + ' IN (' + placeholders + ')', query_ids)
+
+
+def _delete_old_queries(version):
+    # Remove the scores of queries last brought up to date on older versions of the index.
+    query_ids = list(models.TextQuery.objects.exclude(version=version).filter(
+        created__lt=datetime.datetime.now() - MAX_AGE).values_list('id', flat=True))
+    if len(query_ids) == 0:
+        return
+    _delete_scores(query_ids, delete_queries=True)
+
+
+def _create_query(key, version, get_scores):
+    # Store the scores of a new query, returning its id.
+    scores = get_scores()
+    try:
+        # the scores are committed with the query so that no other process sees only some of them
+        with transaction.commit_on_success():
+            query = models.TextQuery.objects.create(key=key, version=version,
+                                                    last_mail_id=_get_last_mail_id(scores))
+            _insert_scores(query.id, scores)
+    except IntegrityError:
+        # another process has stored the same queries meanwhile
+        query = _find_query(key)
+        if query == None:
+            raise
+        return query.id
+    with transaction.commit_on_success():
+        _delete_old_queries(version)
+    return query.id
+
+
+def _update_query(query, version, get_scores):
+    # Bring the scores of the query up to date with the index, either adding the scores of
+    # mails indexed since or, once they are MAX_AGE old, storing them all again. Only one
+    # process updates the query from a given version; any other uses the scores as they are.
+    scores = get_scores()
+    rescore = query.created < datetime.datetime.now() - MAX_AGE
+    if not rescore:
+        scores = dict((mail_id, score) for (mail_id, score) in scores.iteritems() if mail_id > query.last_mail_id)
+    with transaction.commit_on_success():
+        updates = {'version': version, 'last_mail_id': _get_last_mail_id(scores, query.last_mail_id)}
+        if rescore:
+            updates['created'] = datetime.datetime.now()
+        if models.TextQuery.objects.filter(id=query.id, version=query.version).update(**updates) == 0:
+            return
+        if rescore:
+            _delete_scores([query.id])
+        _insert_scores(query.id, scores)
+
+
+def get_query_id(texts, get_scores):
+    """
+    Return the id of the TextQuery holding the combined scores of the text queries, storing
+    or updating them first if they aren't up to date with the current version of the index.
+    get_scores is a function returning a dictionary mapping mail ids to their scores.
+    """
+    version = text_index.get_index().get_version()
+    key = _get_key(texts)
+    query = _find_query(key)
+    if query == None:
+        return _create_query(key, version, get_scores)
+    if query.version != version:
+        _update_query(query, version, get_scores)
+    return query.id
+
+
+def join_scores(query_set, query_id):
+    """Return the query set limited to the mails with scores in the TextQuery with the id query_id."""
+    table = models.TextQueryScore._meta.db_table
+    return query_set.extra(tables=[table], where=[
+        table + '.mail_id = ' + models.Mail._meta.db_table + '.id', table + '.query_id = %s'],
+        params=[query_id])
+
+
+def order_by_score(query_set):
+    """Return the query set, joined by join_scores, ordered most relevant first."""
+    return query_set.extra(order_by=['-' + models.TextQueryScore._meta.db_table + '.score',
+                                     '-' + models.Mail._meta.db_table + '.id'])
@@ -0,0 +1,156 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+An index of the three character sequences (trigrams) in the subject and body of every mail,
+used when MAILSHARE_EXACT_SEARCH_BACKEND is 'index' to narrow exact text searches down to
+the mails that could match before MySQL checks them with LIKE. Without it, those searches
+read the subject or body of every mail in the database.
+
+Any mail containing some text contains all of the text's trigrams, so the candidates are
+the mails with every trigram of the text searched for. Text is indexed and searched lower
+case and without accents, so that the candidates include everything MySQL's case and accent
+insensitive comparison could match. Text shorter than three characters can't be narrowed.
+
+The index is stored in the same way as text_index, in segments listed by a manifest, with
+each term being a field letter followed by a trigram. Searches that would leave more than
+MAILSHARE_TRIGRAM_CANDIDATE_LIMIT candidates aren't narrowed, since the list of ids would
+cost MySQL more than checking the mails.
+"""
+
+import unicodedata
+from django.db import transaction
+import text_index
+import settings
+
+SUBJECT = 's'
+BODY = 'b'
+
+_fields = {'subject': SUBJECT, 'body': BODY}
+
+# Once the candidates are this many times fewer than the postings of the next rarest trigram,
+# they are left for MySQL to check rather than narrowed down further.
+READ_RATIO = 8
+
+
+def normalize(text):
+    """Return the text lower case and with accents removed, as unicode."""
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(character for character in text if not unicodedata.combining(character))
+
+
+def get_trigrams(field, text):
+    """Return the set of terms for the trigrams of the text in the field, SUBJECT or BODY."""
+    text = normalize(text)
+    return set(field + text[i:i+3] for i in range(len(text) - 2))
+
+
+class TrigramIndex(text_index.SearchIndex):
+    """
+    A trigram index stored in the directory path. Each trigram only needs to be found once
+    per mail, so its postings are just mail ids, and each segment stores how many there are
+    so that the rarest trigrams can be read first.
+    """
+    store_counts = True
+
+    def _get_postings(self, mail_id, subject, body):
+        trigrams = get_trigrams(SUBJECT, subject) | get_trigrams(BODY, body)
+        return (dict((trigram, mail_id) for trigram in trigrams), 0)
+
+
+    def _get_posting_mail(self, posting):
+        return posting
+
+
+    def _get_posting_length(self, posting):
+        return 0
+
+
+    def get_candidates(self, field_name, text, limit):
+        """
+        Return the set of ids of mails whose field, 'subject' or 'body', might contain the
+        text, or None if the text is too short to narrow them down or there might be more
+        than limit of them, in which case listing them would cost more than it saves.
+        """
+        trigrams = get_trigrams(_fields[field_name], text)
+        if len(trigrams) == 0:
+            return None
+        return self._read(self._get_candidates, trigrams, limit)
+
+
+    def _get_candidates(self, manifest, segments, trigrams, limit):
+        # Each mail is in only one segment, so the trigrams can be intersected segment by
+        # segment. The rarest trigram in each segment bounds the number of candidates.
+        segment_counts = []
+        for segment in segments:
+            segment_counts.append(sorted((segment.get_count(trigram), trigram) for trigram in trigrams))
+        if sum(counts[0][0] for counts in segment_counts) > limit:
+            return None
+        candidates = set()
+        for (segment, counts) in zip(segments, segment_counts):
+            segment_candidates = None
+            for (count, trigram) in counts:
+                if segment_candidates == None:
+                    segment_candidates = set(segment.get_postings(trigram))
+                elif count > len(segment_candidates) * READ_RATIO:
+                    # checking the few candidates left is cheaper than reading the rest
+                    break
+                else:
+                    segment_candidates.intersection_update(segment.get_postings(trigram))
+                if len(segment_candidates) == 0:
+                    break
+            candidates |= segment_candidates
+        return candidates - self.get_deleted()
+
+
+_index = None
+
+def get_index():
+    """Return the TrigramIndex at MAILSHARE_TRIGRAM_INDEX_PATH, opening it if needed."""
+    global _index
+    if _index == None:
+        _index = TrigramIndex(settings.MAILSHARE_TRIGRAM_INDEX_PATH)
+    return _index
+
+
+def is_enabled():
+    return settings.MAILSHARE_EXACT_SEARCH_BACKEND == 'index'
+
+
+# mails stored in the current transaction, indexed once it is committed
+_pending = []
+
+def add_mails(mails):
+    """
+    Index newly stored Mail objects. Inside a transaction they are indexed by write_pending
+    once it has been committed, so that rolled back mails are never indexed.
+    """
+    if not is_enabled():
+        return
+    _pending.extend((m.id, m.subject, m.body) for m in mails)
+    if not transaction.is_managed():
+        write_pending()
+
+
+def write_pending():
+    """Index the mails stored by a transaction that has been committed."""
+    if len(_pending) > 0:
+        get_index().add(_pending)
+        del _pending[:]
+
+
+def discard_pending():
+    """Forget the mails stored by a transaction that has been rolled back."""
+    del _pending[:]
+
+
+def mail_deleted(sender, instance, **kwargs):
+    """Remove a deleted mail from the index."""
+    if is_enabled():
+        get_index().delete([instance.id])
+
+
+def rebuild(chunk_size=1000, verbose=False):
+    """Throw the index away and index every mail in the database again."""
+    text_index.add_all_mails(get_index(), chunk_size, verbose)
@@ -12,6 +12,7 @@ import people
 import settings
 import teams
 import search
+import search_cache
 
 
 
@@ -61,15 +62,29 @@ def search_view(request):
     search_query = get_string(request, 'query')
     tag_cloud = ''
     top_senders = ''
+    top_recipients = ''
     expanded_html = ''
     
     s = search.Search(request.GET.items())
+    results = search_cache.get_results(s)
+    try:
+        page = results.get_page(settings.MAILSHARE_SEARCH_PAGE_SIZE,
+                                request.GET.get('before'), request.GET.get('after'))
+    except ValueError:
+        # a mangled page key; start from the beginning
+        page = results.get_page(settings.MAILSHARE_SEARCH_PAGE_SIZE)
    
-    if len(s.get_query_set()) == 1:
-        expanded_html = get_expanded_html(s.get_query_set()[0], s)
-    elif len(s.get_query_set()) != 0:
-        tag_cloud = tags.search_results_to_tag_cloud_html(s.get_query_set(), s)
-        top_senders = people.search_results_to_top_senders_html(s.get_query_set(), s)
+    count = results.get_count()
+    if count == 1 and len(page.rows) == 1:
+        expanded_html = get_expanded_html(Mail.objects.get(id=page.rows[0]['id']), s)
+    elif count != 0:
+        f = results.get_facets(settings.MAILSHARE_FACET_ROW_LIMIT)
+        tag_cloud = tags.tags_histogram_to_tag_cloud_html(f.get_tag_histogram(), s)
+        top_senders = people.top_senders_to_html(f.get_top_senders(), s)
+        top_recipients = people.top_recipients_to_html(f.get_top_recipients(), s)
+    explain = ''
+    if settings.DEBUG and request.GET.has_key(search.EXPLAIN_PARAMETER):
+        explain = '\n'.join(s.explain())
     strRequestURL =  "http://"+ request.META['HTTP_HOST']+s.get_rss_url()
     
     t = loader.get_template('search.html')
@@ -79,8 +94,14 @@ def search_view(request):
         'search_html': s.get_html(),
         'tag_cloud': tag_cloud,
         'top_senders' : top_senders,
+        'top_recipients' : top_recipients,
         'expanded_html': expanded_html,
-        'results' : s.get_query_set(),
+        'results' : page.rows,
+        'result_count' : count,
+        'result_count_exact' : results.is_count_exact(),
+        'explain' : explain,
+        'previous_url' : page.get_previous_url(),
+        'next_url' : page.get_next_url(),
         'rssFeedURL' : strRequestURL,
     })
     response = HttpResponse(t.render(c))
@@ -0,0 +1,21 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Recount the per-day team tag and sender counts used for the index page statistics from the
+emails in the database. Run this after upgrading, and after changing MAILSHARE_TEAMS.
+
+python rebuild_rollups.py
+"""
+
+# load the Django environment
+from django.core.management import setup_environ
+import settings
+setup_environ(settings)
+
+import mailshareapp.rollups
+import mailshareapp.tag_cloud_cache
+
+mailshareapp.rollups.rebuild(verbose=True)
+mailshareapp.tag_cloud_cache.update_cached_tag_cloud(0)
+for team_id in mailshareapp.rollups.get_team_ids():
+    mailshareapp.tag_cloud_cache.update_cached_tag_cloud(team_id)
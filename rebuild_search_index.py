@@ -0,0 +1,22 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Index every email in the database for text queries, for use when MAILSHARE_SEARCH_BACKEND
+is 'index', and for exact text searches, when MAILSHARE_EXACT_SEARCH_BACKEND is 'index'.
+Run this after switching to either index, and stop the poller while it runs.
+
+python rebuild_search_index.py
+"""
+
+# load the Django environment
+from django.core.management import setup_environ
+import settings
+setup_environ(settings)
+
+import mailshareapp.text_index
+import mailshareapp.trigram_index
+
+if mailshareapp.text_index.is_enabled():
+    mailshareapp.text_index.rebuild(verbose=True)
+if mailshareapp.trigram_index.is_enabled():
+    mailshareapp.trigram_index.rebuild(verbose=True)
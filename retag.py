@@ -0,0 +1,26 @@
+# License: https://github.com/RobFisher/mailshare/blob/master/LICENSE
+
+"""
+Apply the regular expressions in MAILSHARE_TAGS_REGEX to every email in the database.
+
+python retag.py [--dry-run] [--workers N] [--chunk-size N]
+"""
+
+# load the Django environment
+from django.core.management import setup_environ
+import settings
+setup_environ(settings)
+
+from optparse import OptionParser
+import mailshareapp.process_emails
+
+parser = OptionParser(usage='python retag.py [options]')
+parser.add_option('--dry-run', action='store_true', default=False,
+                  help='report the tags that would be added without adding them')
+parser.add_option('--workers', type='int', default=None,
+                  help='number of worker processes (default MAILSHARE_PARSE_WORKERS)')
+parser.add_option('--chunk-size', type='int', default=500,
+                  help='number of emails each worker scans at a time')
+(options, args) = parser.parse_args()
+
+mailshareapp.process_emails.apply_all_regex_tags(options.dry_run, options.workers, options.chunk_size)
@@ -17,6 +17,8 @@ DATABASES = {
         'PASSWORD': 'password',          # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        # Mailshare stores each batch of emails in a transaction, which needs InnoDB tables.
+        'OPTIONS': {'init_command': 'SET default_storage_engine=INNODB'},
     }
 }
 
@@ -26,6 +28,53 @@ MAILSHARE_IMAP_USER = ''
 MAILSHARE_IMAP_PASSWORD = ''
 MAILSHARE_IMAP_MAILBOX = 'INBOX'
 MAILSHARE_IMAP_ENABLE_EXPUNGE = False
+# The maximum number of emails fetched from the IMAP server with one command
+# each time the mailbox is polled.
+MAILSHARE_IMAP_BATCH_SIZE = 10
+# If the IMAP server supports IDLE, wait for it to announce new mail instead of
+# polling. IDLE is reissued after MAILSHARE_IMAP_IDLE_TIMEOUT seconds.
+MAILSHARE_IMAP_USE_IDLE = True
+MAILSHARE_IMAP_IDLE_TIMEOUT = 300
+# Without IDLE, the mailbox is polled every MAILSHARE_POLL_MIN_INTERVAL seconds
+# while mail is arriving, backing off to MAILSHARE_POLL_MAX_INTERVAL seconds
+# while it is quiet.
+MAILSHARE_POLL_MIN_INTERVAL = 5
+MAILSHARE_POLL_MAX_INTERVAL = 120
+# The number of processes used to parse incoming emails. Set this to the number
+# of cores on the polling host to get through a backlog faster; 1 parses in the
+# polling process itself.
+MAILSHARE_PARSE_WORKERS = 1
+# The number of email addresses whose contact ids are remembered by the
+# polling process.
+MAILSHARE_CONTACT_CACHE_SIZE = 10000
+# Each batch of emails is stored in one database transaction. If storing a
+# batch fails it is rolled back and retried this many times. Batches are never
+# retried if any of Mailshare's tables are MyISAM, which can't roll back.
+MAILSHARE_INGEST_RETRIES = 3
+# When an autotag is created, the polling process adds it to existing emails
+# in the background, spending up to this many seconds on it between batches of
+# new emails.
+MAILSHARE_AUTOTAG_JOB_SECONDS = 5
+# The tag cloud, top senders and top recipients shown for search results are
+# worked out from at most this many of the most recent matching emails. None
+# means use all of them.
+MAILSHARE_FACET_ROW_LIMIT = None
+# The number of emails listed on each page of search results.
+MAILSHARE_SEARCH_PAGE_SIZE = 100
+# Search results are counted up to this many emails; beyond it the count is shown
+# as "more than" this number. None means always count them all exactly.
+MAILSHARE_SEARCH_COUNT_LIMIT = 1000
+# The number of searches whose results are kept in memory by each web server
+# process, so that repeated searches don't have to run again. 0 turns this off.
+MAILSHARE_SEARCH_CACHE_SIZE = 100
+# The number of suggestions offered when completing tag and contact names.
+MAILSHARE_COMPLETION_RESULTS = 10
+# How often, in seconds, the web server looks for tags and contacts added by
+# the polling process to offer as completions.
+MAILSHARE_COMPLETION_REFRESH_SECONDS = 10
+# How often, in seconds, the polling process re-ranks completions by how often
+# they are used.
+MAILSHARE_COMPLETION_REBUILD_SECONDS = 3600
 MAILSHARE_ENABLE_DELETE = False
 MAILSHARE_TAGS_REGEX = [
     # mailshare will tag incoming emails with any text in the subject or body
@@ -41,6 +90,35 @@ MAILSHARE_TEAMS = {
 # in it.
 MAILSHARE_CACHE_PATH='/srv/www/mailshare/cache'
 
+# Every email downloaded is kept in this directory so that the database can be
+# rebuilt from it. Emails are compressed and stored in segment files, starting
+# a new segment when the current one reaches MAILSHARE_ARCHIVE_SEGMENT_SIZE
+# bytes.
+MAILSHARE_ARCHIVE_PATH='/srv/www/mailshare/archive'
+MAILSHARE_ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
+MAILSHARE_ARCHIVE_COMPRESSION_LEVEL = 6
+
+# Text queries are answered by MySQL's FULLTEXT index ('mysql') or by
+# Mailshare's own index ('index'), which can also sort results by relevance.
+# The index is kept in MAILSHARE_SEARCH_INDEX_PATH, which must be writeable by
+# the web server; run rebuild_search_index.py after switching to it. New emails
+# are added as small segments, and whenever MAILSHARE_SEARCH_MERGE_FACTOR
+# segments are of about the same size they are merged into one.
+MAILSHARE_SEARCH_BACKEND = 'mysql'
+MAILSHARE_SEARCH_INDEX_PATH = '/srv/www/mailshare/cache/search_index'
+MAILSHARE_SEARCH_MERGE_FACTOR = 10
+# Exact text searches check the subject or body of every email with MySQL
+# ('mysql'), or first narrow them down using an index of the three letter
+# sequences in every email ('index'). The index is kept in
+# MAILSHARE_TRIGRAM_INDEX_PATH, which must be writeable by the web server; run
+# rebuild_search_index.py after switching to it.
+MAILSHARE_EXACT_SEARCH_BACKEND = 'mysql'
+MAILSHARE_TRIGRAM_INDEX_PATH = '/srv/www/mailshare/cache/trigram_index'
+# Exact text searches that the index narrows down to more emails than this are
+# checked by MySQL without it, since the list of emails would cost more than
+# it saves.
+MAILSHARE_TRIGRAM_CANDIDATE_LIMIT = 5000
+
 # A list of functions that will be called with each new email
 MAILSHARE_NEW_EMAIL_HOOKS = []
 